@@ -19,6 +19,8 @@ class PriceForecast:
     start_time: datetime
     end_time: datetime
     demand_window: bool # True if the current price is in a demand window
+    price_low: float = None  # Lower/upper edge of Amber's advanced price forecast band, None when not provided
+    price_high: float = None
 
 @dataclass
 class amber_data:
@@ -35,6 +37,7 @@ class amber_data:
     general_extrapolated_forecast: list[float]
     feedIn_extrapolated_forecast: list[float]
     demand_window_extrapolated_forecast: list[bool]  # True for each 5-min interval that falls in a demand window
+    price_bands: dict = None # {"general"/"feedIn": {"low"/"high": list[float]}} aligned with the extrapolated forecasts, None when not available
 
 def normalise_time(ts: datetime):
     # Amber can return timestamps with small offsets (seconds and
@@ -234,7 +237,10 @@ class AmberAPI:
                         price = i["perKwh"]
                     demand_window = self.demand_window_present(i)
 
-                    interval = PriceForecast(price=price, start_time=start, end_time=end, demand_window=demand_window)   
+                    interval = PriceForecast(price=price, start_time=start, end_time=end, demand_window=demand_window)
+                    if("advancedPrice" in i):
+                        interval.price_low = i["advancedPrice"]["low"]
+                        interval.price_high = i["advancedPrice"]["high"]
                     general_price_forecast.append(interval)
 
                 elif i["channelType"] == "feedIn":
@@ -243,6 +249,9 @@ class AmberAPI:
                     else:
                         price = -i["perKwh"]   
                     interval = PriceForecast(price=price, start_time=start, end_time=end, demand_window=False) 
+                    if("advancedPrice" in i): # Feed in prices are negated, so Amber's low edge is the high feed in price
+                        interval.price_low = -i["advancedPrice"]["high"]
+                        interval.price_high = -i["advancedPrice"]["low"]
                     feed_in_price_forecast.append(interval)
 
             return [general_price_forecast, feed_in_price_forecast]
@@ -303,9 +312,12 @@ class AmberAPI:
         feed_in_points = {}
         demand_window_points = {}
 
-        def add_intervals(intervals, points, time_offset=timedelta(0), demand_points=None):
+        def add_intervals(intervals, points, time_offset=timedelta(0), demand_points=None, field="price"):
             # Add the intervals to the correct time slot in the points dict.
             for interval in intervals:
+                value = getattr(interval, field)
+                if value is None:
+                    continue
                 start_time = normalise_time(interval.start_time) + time_offset
                 end_time = normalise_time(interval.end_time) + time_offset
 
@@ -314,7 +326,7 @@ class AmberAPI:
 
                 for step in range(steps):
                     t = start_time + timedelta(minutes=step * 5)
-                    points[t] = round(interval.price)
+                    points[t] = round(value)
                     if demand_points is not None and self.demand_tarrif:
                         demand_points[t] = bool(interval.demand_window)
 
@@ -385,8 +397,25 @@ class AmberAPI:
                 logger.warning(f"Amber extrapolated forecast required gap fill. Requested bins={N_5min}. Missing bin QTYs: (general={general_missing}, feed-in={feed_missing}).")
                 logger.warning(f"Missing points were filled with default values (general={default_general_price} c/kWh, feed-in={default_feed_in_price} c/kWh). This will impact MPC performance.")
 
+        # Advanced price forecast bands (used by the scenario MPC). Only forecast intervals carry a band,
+        # slots without one (ie the projected past prices) fall back to the extrapolated price.
+        price_bands = {}
+        for channel, forecast_30_min_data, forecast_5_min_data, extrapolated_forecast in (
+            ("general", general_price_forecast_30_min_data, general_price_forecast_5_min_data, general_price_extrapolated_forecast),
+            ("feedIn", feed_in_price_forecast_30_min_data, feed_in_price_forecast_5_min_data, feed_in_price_extrapolated_forecast),
+        ):
+            price_bands[channel] = {}
+            for edge in ("low", "high"):
+                points = {}
+                add_intervals(forecast_30_min_data, points, field=f"price_{edge}")
+                for interval in forecast_5_min_data:
+                    value = getattr(interval, f"price_{edge}")
+                    if value is not None:
+                        points[normalise_time(interval.start_time)] = round(value)
+                price_bands[channel][edge] = [points.get(t, price) for t, price in zip(ordered_times, extrapolated_forecast)]
+
         # Return extended forecast with guaranteed length.
-        return [general_price_extrapolated_forecast, feed_in_price_extrapolated_forecast, demand_window_extrapolated_forecast, ordered_times]
+        return [general_price_extrapolated_forecast, feed_in_price_extrapolated_forecast, demand_window_extrapolated_forecast, ordered_times, price_bands]
 
 
     def get_current_prices(self):
@@ -429,7 +458,7 @@ class AmberAPI:
             feed_in_price = self.data.feedIn_price
 
         if((not estimate and forecast_hrs != None) or self.data == None):
-            [general_extrapolated_forecast, feedIn_extrapolated_forecast, demand_window_extrapolated_forecast, extrapolated_timestamps] = self.get_extrapolated_forecast(
+            [general_extrapolated_forecast, feedIn_extrapolated_forecast, demand_window_extrapolated_forecast, extrapolated_timestamps, price_bands] = self.get_extrapolated_forecast(
                 hours=forecast_hrs,
                 sim_start=sim_start,
                 sim_end=sim_end,
@@ -438,6 +467,7 @@ class AmberAPI:
             general_extrapolated_forecast = self.data.general_extrapolated_forecast
             feedIn_extrapolated_forecast = self.data.feedIn_extrapolated_forecast
             demand_window_extrapolated_forecast = self.data.demand_window_extrapolated_forecast
+            price_bands = self.data.price_bands
 
         self.data = amber_data(
             demand_tarrif_price=self.demand_tarrif_price,
@@ -452,7 +482,8 @@ class AmberAPI:
             feedIn_12hr_forecast_sorted=storted_feed_in_forecast,
             general_extrapolated_forecast=general_extrapolated_forecast,
             feedIn_extrapolated_forecast=feedIn_extrapolated_forecast,
-            demand_window_extrapolated_forecast=demand_window_extrapolated_forecast
+            demand_window_extrapolated_forecast=demand_window_extrapolated_forecast,
+            price_bands=price_bands
             )
         return self.data
 
@@ -464,7 +495,7 @@ amber = AmberAPI("", "", HA_TZ,7)
 fg,ff = amber.get_forecast(30,30)
 r = [[i.demand_window, i.start_time] for i in fg]
 
-g,f,d,t = amber.get_extrapolated_forecast(24)
+g,f,d,t,b = amber.get_extrapolated_forecast(24)
 
 for i in range(len(g)):
     print(f"{d[i]} {g[i]} {t[i]}")
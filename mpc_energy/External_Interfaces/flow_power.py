@@ -2,8 +2,8 @@ from datetime import datetime, time as datetime_time, timezone, timedelta
 from External_Interfaces.amber_api import PriceForecast, amber_data
 from mpc_logger import logger
 import math
+import numpy as np
 import data_helpers
-from collections import defaultdict
 from exceptions import FlowPowerError
 
 
@@ -126,12 +126,12 @@ class FlowPowerInterface:
         Project future buy prices using a time-of-day profile averaged from the 
         last 3 days of history to fill gaps beyond the provided forecast.
         """
-        now = datetime.now(self.ha.local_tz).replace(second=0, microsecond=0)
+        now = data_helpers.round_minutes(datetime.now(self.ha.local_tz), 5) # On the history store's bins
         hist_start = now - timedelta(days=3)
         
         try:
-            history = self.ha.get_history(self.import_price_entity_id, start_time=hist_start, end_time=now)
-            if not history:
+            history = self.ha.get_stored_history(self.import_price_entity_id, start_time=hist_start, end_time=now) # The unit attribute is read from the current state below
+            if not len(history):
                 return import_points
 
             state_payload = self.ha.get_state(self.import_price_entity_id)
@@ -140,20 +140,14 @@ class FlowPowerInterface:
             scale_to_dollars = 0.01 if unit == "c/kWh" else 1.0
 
             # 1. Bin history to 5-minute resolution and group into 30-minute TOD buckets to get true averages.
-            binned_5m = data_helpers.bin_data(history, 5, hist_start, now, interpolation_method="step")
-            tod_bins = defaultdict(list)
-            for b in binned_5m:
-                if b.avg_state is None:
-                    continue
-                try:
-                    val = float(b.avg_state) * scale_to_dollars  # $/kWh
-                    # Snap the 5-minute reading to the start of its 30-minute block for averaging
-                    t_rounded = b.time.replace(second=0, microsecond=0)
-                    t_rounded -= timedelta(minutes=t_rounded.minute % 30)
-                    tod_bins[t_rounded.time()].append(val)
-                except: continue
+            binned_5m = data_helpers.bin_series(history.time, history.state, 5, hist_start, now, interpolation_method="step").values * scale_to_dollars  # $/kWh
+            # Snap each 5-minute reading to the start of its 30-minute block for averaging
+            block_index = np.array([(t.hour * 60 + t.minute) // 30 for t in data_helpers.bin_times(5, hist_start, now)])
+            valid = ~np.isnan(binned_5m)
+            sums = np.bincount(block_index[valid], weights=binned_5m[valid], minlength=48)
+            counts = np.bincount(block_index[valid], minlength=48)
             
-            profile = {tod: sum(vals)/len(vals) for tod, vals in tod_bins.items()}
+            profile = {datetime_time(hour=block // 2, minute=(block % 2) * 30): float(sums[block] / counts[block]) for block in range(48) if counts[block]}
             global_avg = sum(profile.values()) / len(profile) if profile else 0.45
 
             # 2. Initialize a 72h grid (30-min steps) with the profile values.
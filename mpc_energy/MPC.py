@@ -9,6 +9,7 @@ from mpc_logger import logger
 import warnings
 
 import json
+import queue
 from plants.base_plant import BasePlant
 from exceptions import MPCEnergyError, MQTTAuthenticationError, MQTTConnectionError
 import paho.mqtt.client as mqtt
@@ -16,14 +17,33 @@ import const
 import config_manager
 import loads.optional_loads
 import data_helpers
+from solvers.sparse_lp import SparseLP, ROW_EQ, ROW_LE, ROW_RANGE
+from plan_cache import PlanCache
+from solvers.solve_worker import SolveWorker, SolveWorkerPool
+from solvers.codegen import CodegenSolver, structure_key
+from scenarios import ScenarioPlanner
+from exceptions import MPCSolveTimeoutError, MPCWhatIfError
+
+WHAT_IF_REQUEST_TOPIC = "home/mpc/what_if/request"
+WHAT_IF_RESULT_TOPIC = "home/mpc/what_if/result"
+what_if_requests = queue.Queue() # What-if sweep requests from the dashboard, run from the main loop by MPC.process_what_if_requests
 
 mqtt_conn_result = None
 def on_connect(client, userdata, flags, rc, properties=None):
     global mqtt_conn_result
     mqtt_conn_result = rc
+    if rc == 0:
+        client.subscribe(WHAT_IF_REQUEST_TOPIC) # Subscribe on every (re)connect
+
+def on_what_if_request(client, userdata, msg):
+    try:
+        what_if_requests.put(json.loads(msg.payload))
+    except ValueError as e:
+        logger.warning(f"Ignoring malformed what-if request: {e}")
 
 mqtt_client = mqtt.Client()
 mqtt_client.on_connect = on_connect
+mqtt_client.message_callback_add(WHAT_IF_REQUEST_TOPIC, on_what_if_request)
 mqtt_client.username_pw_set(config_manager.MQTT_USER, config_manager.MQTT_PASS) 
 
 try:
@@ -51,6 +71,18 @@ except Exception as e:
                          f"Please ensure the Mosquitto broker is running and the hostname is correct. Error: {e}") from e
 
 class MPC:
+    # Multi-rate horizon resolution: (hours from sim start this step length applies until, step length in minutes)
+    MULTI_RATE_STEPS = [(2, 5), (12, 15), (None, 30)]
+
+    # Costs/rewards a what-if sweep can override: override key -> (MPC attribute, scale from the override's units).
+    # Optional load rewards are overridden with "<load name>.reward_cents_per_kwh".
+    WHAT_IF_PARAMETERS = {
+        "battery_discharge_cost": ("battery_min_export_cost", 1 / 100), # c/kWh, as configured
+        "grid_import_penalty_cost": ("grid_import_penalty_cost", 1.0),  # $/kWh
+        "full_battery_reward": ("full_battery_reward", 1.0),            # $/kWh
+    }
+    WHAT_IF_DEADLINE_SECONDS = 120
+
     def __init__(self, ha, plant: BasePlant, local_tz, demand_tarrif, retailer, optional_loads: list[loads.optional_loads.OptionalLoad]):
         self.plant = plant
         self.ha = ha
@@ -86,6 +118,23 @@ class MPC:
         self.demand_tarrif = demand_tarrif # True if the selected site has a demand tarrif applied
         self.current_effective_price = 0 # Set to zero until we run an optimisation and determine the current effective price based on the MPC plan and current conditions
 
+        # Optimisation backend: "cvxpy" (default) or "sparse" (direct sparse-matrix LP, see solvers/sparse_lp.py)
+        self.solver_backend = config_manager.mpc_solver_backend
+        logger.debug(f"MPC solver backend set to: {self.solver_backend}")
+
+        # Wall-clock deadline (seconds) for solves run in the worker process (see solvers/solve_worker.py), 0 solves in this process
+        self.solve_deadline = float(config_manager.mpc_solve_deadline or 0)
+        self.solve_worker = None
+        self.solve_timeouts = 0
+        self.last_output = None         # Last valid plan and its start time, executed (time-shifted) when a solve misses its deadline
+        self.last_output_start = None
+
+        # Horizon resolution: "uniform" (5 minute steps) or "multi_rate" (see MULTI_RATE_STEPS)
+        self.horizon_mode = config_manager.mpc_horizon_mode
+
+        # Sparse backend formulation: "full" (same LP as the CVXPY template) or "condensed" (see build_condensed_sparse_template)
+        self.formulation = config_manager.mpc_formulation
+
         # User configured values
         self.battery_min_export_cost = config_manager.battery_discharge_cost/100  # $/kWh (Export will only occour ABOVE this value)
         logger.debug(f"Battery discharge cost set to: {self.battery_min_export_cost} $/kWh")
@@ -120,12 +169,44 @@ class MPC:
         self.profit_tomorrow = 0
         self.next_grid_interaction_kwh = 0.0
 
+        # Solver metrics (sparse backend), the first solve is cold and used as the baseline for iterations saved by warm starting
+        self.solver_iterations = 0
+        self.solver_iterations_saved = 0
+        self.cold_solve_iterations = None
+        self.last_solve_start = None # 5 minute aligned start of the last successful sparse solve, used to time-shift the warm start
+
+        # Reuse the previous plan when the inputs haven't changed (see plan_cache.py)
+        self.plan_cache = PlanCache(max_age_minutes=config_manager.mpc_plan_cache_max_age) if config_manager.mpc_plan_cache else None
+
         self.update_forecast_horizon()
+        self.build_horizon_steps()
 
         # Build the CVXPY optimisation template once and reuse it on each run.
         # This avoids repeated canonicalization overhead at every control interval.
         self.build_optimisation_template()
 
+        if(self.solve_deadline > 0):
+            self.solve_worker = SolveWorker()
+            if not self.solve_worker.wait_until_ready(timeout=60):
+                logger.warning("MPC solve worker is still starting, the first solves may miss their deadline.")
+
+        # What-if sweeps (see what_if), the LP and worker pool are only created on the first request
+        self.last_inputs = None # Parameter values and raw prices of the last successful run
+        self.what_if_lp = None
+        self.what_if_pool = None
+        self.what_if_workers = int(config_manager.mpc_what_if_workers)
+
+        # Plan against several forecast scenarios instead of a single forecast (see scenarios.py)
+        self.scenario_planner = None
+        if(config_manager.mpc_scenario_mode):
+            if self.sparse_lp is None:
+                logger.warning("Scenario MPC requires the sparse solver backend, planning against the single forecast instead.")
+            else:
+                self.scenario_planner = ScenarioPlanner(config_manager.mpc_scenario_count, config_manager.mpc_scenario_workers)
+                if self.plan_cache is not None:
+                    logger.info("The plan cache is not used in scenario mode.")
+                    self.plan_cache = None
+
     def update_forecast_horizon(self):
         """
         Set the MPC horizon to finish at 06:00 on the next-next-next morning
@@ -151,6 +232,54 @@ class MPC:
         #     f"to {self.sim_end.strftime('%Y-%m-%d %H:%M %Z')}"
         # )
              
+    def build_horizon_steps(self):
+        """
+        Set the optimisation step structure. Forecasts are always gathered on the 5 minute grid,
+        in multi-rate mode they are aggregated onto longer steps further out in the horizon with
+        to_steps and the results are expanded back onto the 5 minute grid with to_5min.
+        """
+        n_5min = int(self.N_5min)
+        if(self.horizon_mode == "multi_rate"):
+            step_sizes = []
+            slot = 0
+            for until_hours, step_minutes in self.MULTI_RATE_STEPS:
+                end_slot = n_5min if until_hours is None else min(int(until_hours * self.steps_per_hr), n_5min)
+                slots_per_step = max(1, step_minutes // 5)
+                while slot < end_slot:
+                    size = min(slots_per_step, end_slot - slot)
+                    step_sizes.append(size)
+                    slot += size
+        else:
+            step_sizes = [1] * n_5min
+
+        self.step_sizes = np.array(step_sizes, dtype=int)   # Number of 5 minute slots in each step
+        self.step_offsets = np.concatenate(([0], np.cumsum(self.step_sizes)[:-1]))  # 5 minute slot each step starts at
+        self.N = len(self.step_sizes)                       # Number of optimisation steps
+        self.dt = self.step_sizes * self.dt_5min            # Duration of each step in hours
+        self.step_start_hours = self.step_offsets * self.dt_5min
+        logger.debug(f"MPC horizon uses {self.N} steps ({self.horizon_mode}) covering {n_5min}x5min intervals.")
+
+    def to_steps(self, values, how="mean"):
+        """Aggregate a 5 minute series onto the optimisation steps (mean, or max for masks and requirements)."""
+        values = np.asarray(values, dtype=float)
+        if self.N == int(self.N_5min):
+            return values
+        if how == "max":
+            return np.maximum.reduceat(values, self.step_offsets)
+        return np.add.reduceat(values, self.step_offsets) / self.step_sizes
+
+    def to_5min(self, values):
+        """Expand a per-step (N) or per-step-boundary (N+1, ie SOC) series back onto the 5 minute grid."""
+        values = np.asarray(values, dtype=float)
+        if self.N == int(self.N_5min):
+            return values
+        if len(values) == self.N:
+            return np.repeat(values, self.step_sizes)
+        if len(values) == self.N + 1:
+            boundaries = np.concatenate(([0], np.cumsum(self.step_sizes)))
+            return np.interp(np.arange(int(self.N_5min) + 1), boundaries, values)
+        return values
+
     def update_limits(self):
         # Battery Settings
         self.battery_capacity = self.plant.rated_capacity  # kWh
@@ -173,18 +302,18 @@ class MPC:
 
         # ---------- Historical Data ---------- 
         #self.historical_data = self.plant.historical_data(hours=6) # Get the last 6 hours of historical data (Primarily used for displaying historical data on plot)
-        self.historical_data = self.plant.historical_data(hours=0.25)
+        self.historical_data = self.plant.recent_history(hours=0.25) # Sliced from the profit history the plant keeps current, for the plot
         self.daily_profit = self.plant.daily_net_profit
 
         # ---------- Forecasts ----------
         # Load Forecast - already debiased from optional loads
-        load_power_states = self.plant.forecast_load_power(
+        load_power = self.plant.forecast_load_power(
             forecast_hours_from_now=self.forecast_hrs,
             forecast_start_time=self.sim_start,
             forecast_end_time=self.sim_end
         )
         
-        self.load_5min = [powerstate.avg_state*(1+self.load_inflation_percentage/100.0) for powerstate in load_power_states]
+        self.load_5min = load_power*(1+self.load_inflation_percentage/100.0)
         
         # Solar Forecast
         self.solar_5min = self.plant.forecast_solar_power(
@@ -195,14 +324,15 @@ class MPC:
 
         # Inject the current real load and solar values into the sim
         if(inject_real_values):
-            # Inject the avg of the last 5 minutes of solar and load power
-            self.solar_5min[0] = (self.solar_5min[0] + (self.historical_data["solar_power"][-1] if self.historical_data["solar_power"] else self.solar_5min[0])) / 2 # Avgerage the last 5 minutes of solar with the forecast to make a more realistic value for the current timestep
-            self.load_5min[0] = self.historical_data["load_power"][-1]
+            # Inject the avg of the last 5 minutes of solar and load power, from the values read every control loop
+            recent_solar = self.plant.recent_solar_power.average()
+            recent_load = self.plant.recent_load_power.average()
+            self.solar_5min[0] = (self.solar_5min[0] + (recent_solar if recent_solar is not None else self.solar_5min[0])) / 2 # Avgerage the last 5 minutes of solar with the forecast to make a more realistic value for the current timestep
+            self.load_5min[0] = recent_load if recent_load is not None else self.plant.load_power
             for load in self.optional_loads:
                 try:  
                     if(load.debias_load):
-                        opt_load_history = load.get_historical_power(hours=0.25)
-                        opt_load_recent_avg = opt_load_history[0].avg_state if opt_load_history and len(opt_load_history) > 0 and opt_load_history[0].avg_state is not None else 0.0
+                        opt_load_recent_avg = load.get_recent_power() or 0.0
                         self.load_5min[0] = self.load_5min[0] - opt_load_recent_avg
                 except Exception as e:
                     logger.warning(f"Failed to debias optional load '{load.name}' from the load forecast. Error: {e}")
@@ -214,7 +344,7 @@ class MPC:
         if(max(self.load_5min) > self.grid_import_limit or min(self.load_5min) < 0):
             logger.warning(f"Some load values fall outside of limits, Max Load: {max(self.load_5min)}, Min Load: {min(self.load_5min)}. Clipping to ensure solver feasability, please report this if it occours frequently.")
 
-        self.load_5min = [min(max(load, 0.0), self.grid_import_limit)  for load in self.load_5min] # Don't allow negative load or solar or load greater than import limit
+        self.load_5min = np.clip(self.load_5min, 0.0, self.grid_import_limit) # Don't allow negative load or solar or load greater than import limit
         self.solar_5min = [max(solar, 0.0) for solar in self.solar_5min]
         
         # Amber Forecast (forecast hrs is set in main.py in the get_data call)
@@ -239,6 +369,14 @@ class MPC:
                 
                 self.prices_buy[i] = self.prices_sell[i] + 0.10 # Add a small premium to ensure buy price is above sell price to avoid weird solver behaviour.
 
+        self.effective_prices_buy, self.effective_prices_sell = self.effective_prices(self.prices_buy, self.prices_sell)
+
+        #self.prices_buy[0:5] = 0.03 #Testing
+        #self.prices_sell[0:5] = 0.01
+        #self.soc_init = 0.95*self.soc_max
+
+    def effective_prices(self, prices_buy, prices_sell):
+        """Return the uncertainty-adjusted (effective) buy and sell prices the optimiser plans against."""
         # Build uncertainty-adjusted prices so near-term intervals are valued more than
         # far-future forecast intervals (which are less reliable).
         hours_from_now = np.arange(int(self.N_5min)) * self.dt_5min
@@ -267,14 +405,11 @@ class MPC:
                 1 + (max_uncertainty_adjustment/100),
             )
 
-        self.effective_prices_buy = np.multiply(self.prices_buy, buy_price_uncertainty_factor)
-        self.effective_prices_sell = np.multiply(self.prices_sell, sell_price_uncertainty_factor)
+        effective_prices_buy = np.multiply(prices_buy, buy_price_uncertainty_factor)
+        effective_prices_sell = np.multiply(prices_sell, sell_price_uncertainty_factor)
 
-        self.effective_prices_sell = self.effective_prices_sell + 0.00001 # Increase prices slightly to allow for export at slight benefit
-
-        #self.prices_buy[0:5] = 0.03 #Testing
-        #self.prices_sell[0:5] = 0.01
-        #self.soc_init = 0.95*self.soc_max
+        effective_prices_sell = effective_prices_sell + 0.00001 # Increase prices slightly to allow for export at slight benefit
+        return effective_prices_buy, effective_prices_sell
 
     def apply_load_mismatch_ramp(self, load_forecast):
         """
@@ -310,18 +445,20 @@ class MPC:
         return adjusted_forecast
    
     def build_optimisation_template(self):
-        n = int(self.N_5min)
+        n = int(self.N)
+        dt = self.dt
 
         # Variables
-        self.p_charge = cp.Variable(n, nonneg=True)
-        self.p_discharge = cp.Variable(n, nonneg=True)
-        self.soc = cp.Variable(n + 1)
-        self.solar_used = cp.Variable(n, nonneg=True)
-        self.solar_curtail = cp.Variable(n, nonneg=True)
-        self.grid_import = cp.Variable(n, nonneg=True)
-        self.grid_export = cp.Variable(n, nonneg=True)
-        self.peak_demand = cp.Variable(nonneg=True)
-        self.inverter_power = cp.Variable(n)
+        self.p_charge = cp.Variable(n, nonneg=True, name="p_charge")
+        self.p_discharge = cp.Variable(n, nonneg=True, name="p_discharge")
+        self.soc = cp.Variable(n + 1, name="soc")
+        self.solar_used = cp.Variable(n, nonneg=True, name="solar_used")
+        self.solar_curtail = cp.Variable(n, nonneg=True, name="solar_curtail")
+        self.grid_import = cp.Variable(n, nonneg=True, name="grid_import")
+        self.grid_export = cp.Variable(n, nonneg=True, name="grid_export")
+        self.peak_demand = cp.Variable(nonneg=True, name="peak_demand")
+        self.inverter_power = cp.Variable(n, name="inverter_power")
+        self.soc_next = cp.Variable(n, name="soc_next") # soc[1:], only used by the condensed sparse formulation
 
         # Parameters (updated every run)
         self.soc_init_param = cp.Parameter(nonneg=True, name="soc_init")
@@ -345,7 +482,7 @@ class MPC:
         # Vectorized constraints
         constraints = [
             self.soc[0] == self.soc_init_param,
-            self.soc[1:] == self.soc[:-1] + self.dt_5min * self.discharge_efficiency * self.p_charge - self.dt_5min / self.discharge_efficiency * self.p_discharge,
+            self.soc[1:] == self.soc[:-1] + cp.multiply(dt * self.discharge_efficiency, self.p_charge) - cp.multiply(dt / self.discharge_efficiency, self.p_discharge),
             self.soc[1:] >= self.soc_min_param,
             self.soc[1:] <= self.soc_max_param,
             self.p_charge <= self.p_max_charge_param,
@@ -363,11 +500,11 @@ class MPC:
         
 
         objective_list = [
-            cp.multiply(self.grid_import, self.price_buy_param) * self.dt_5min
-            - cp.multiply(self.grid_export, self.price_sell_param) * self.dt_5min
-            + cp.multiply(self.grid_import, self.grid_import_penalty_cost) * self.dt_5min
-            + cp.multiply(self.battery_min_export_cost, self.p_discharge) * self.dt_5min
-            - cp.multiply(self.charge_maintain_reward, self.soc[0:-1])
+            cp.multiply(dt, cp.multiply(self.grid_import, self.price_buy_param))
+            - cp.multiply(dt, cp.multiply(self.grid_export, self.price_sell_param))
+            + cp.multiply(dt * self.grid_import_penalty_cost, self.grid_import)
+            + cp.multiply(dt * self.battery_min_export_cost, self.p_discharge)
+            - cp.multiply(self.charge_maintain_reward * self.step_sizes, self.soc[0:-1]) # Reward is per 5 minute interval
             - cp.multiply(self.full_battery_reward, cp.multiply(self.solar_eod_reward_mask_param, self.soc[0:-1]))
         ]
 
@@ -396,7 +533,366 @@ class MPC:
 
         self.prob = cp.Problem(cp.Minimize(self.objective_expression), constraints)
 
+        # Problem-specific solver generated for this template (see solvers/codegen.py), used by solve_cvxpy once it's built
+        self.codegen_solver = None
+        if(config_manager.mpc_codegen):
+            try:
+                self.codegen_solver = CodegenSolver(self.prob, structure_key(self))
+            except Exception as e:
+                logger.warning(f"Failed to set up the custom MPC solver, using the regular CVXPY path. Error: {e}")
+
+        self.sparse_lp = None
+        if(self.solver_backend == "sparse"):
+            try:
+                self.sparse_lp = self.build_sparse_template()
+            except Exception as e:
+                self.sparse_lp = None
+                logger.warning(f"Failed to build the sparse LP backend, falling back to the CVXPY backend. Error: {e}")
+
+    def build_sparse_template(self):
+        """
+        Assemble the same LP as build_optimisation_template directly into sparse matrices.
+        The cvxpy variables are reused as column blocks so the solution can be written back
+        into them and read by the rest of the MPC exactly as if CVXPY had solved it.
+        """
+        if self.formulation == "condensed":
+            return self.build_condensed_sparse_template()
+
+        n = int(self.N)
+        dt = self.dt
+        lp = SparseLP(solver=config_manager.mpc_sparse_solver)
+
+        lp.add_variable(self.p_charge, upper=0.0)
+        lp.add_variable(self.p_discharge, upper=0.0)
+        lp.add_variable(self.soc, lower=-np.inf, upper=np.inf) # soc[1:] bounds are set each run, soc[0] is fixed by a row
+        lp.add_variable(self.solar_used, upper=0.0)
+        lp.add_variable(self.solar_curtail)
+        lp.add_variable(self.grid_import, upper=0.0)
+        lp.add_variable(self.grid_export, upper=0.0)
+        lp.add_variable(self.peak_demand)
+        lp.add_variable(self.inverter_power, lower=0.0, upper=0.0)
+
+        lp.rows = {
+            "soc_init": lp.add_rows(1, [(self.soc, [0], 1.0)], ROW_EQ),
+            "soc_dynamics": lp.add_rows(n, [
+                (self.soc, slice(1, None), 1.0),
+                (self.soc, slice(0, n), -1.0),
+                (self.p_charge, None, -dt * self.discharge_efficiency),
+                (self.p_discharge, None, dt / self.discharge_efficiency),
+            ], ROW_EQ),
+            "solar_split": lp.add_rows(n, [(self.solar_used, None, 1.0), (self.solar_curtail, None, 1.0)], ROW_EQ),
+            "inverter_balance": lp.add_rows(n, [
+                (self.solar_used, None, 1.0),
+                (self.p_discharge, None, 1.0),
+                (self.p_charge, None, -1.0),
+                (self.inverter_power, None, -1.0),
+            ], ROW_EQ),
+            # grid_import <= peak_demand only applies inside the demand window, the rhs is set to inf outside of it
+            "peak_demand": lp.add_rows(n, [(self.grid_import, None, 1.0), (self.peak_demand, None, -1.0)], ROW_LE),
+        }
+
+        balance_terms = [
+            (self.grid_import, None, 1.0),
+            (self.inverter_power, None, 1.0),
+            (self.grid_export, None, -1.0),
+        ]
+        for load in self.optional_loads:
+            l_p_var = load.build_sparse(lp, self) # Any failure here falls back to the CVXPY backend so no load is silently dropped
+            balance_terms.append((l_p_var, None, -1.0))
+
+        lp.rows["power_balance"] = lp.add_rows(n, balance_terms, ROW_EQ)
+        lp.compile()
+        return lp
+
+    def build_condensed_sparse_template(self):
+        """
+        A reduced version of the sparse LP with the variables defined by equalities substituted out:
+            solar_curtail   = solar_forecast - solar_used (solar_used <= solar_forecast is its column bound)
+            inverter_power  = solar_used + p_discharge - p_charge, the inverter limit becomes a ranged row
+            soc[0]          = soc_init, only soc[1:] (soc_next) is a variable and its first dynamics row
+                              takes soc_init on the rhs. The reward on soc[0] is a constant (cost_offset).
+        The peak demand variable and rows are only added for sites with a demand tarrif. SOC keeps the
+        banded (one row per step) form, a cumulative sum of battery power would make the SOC bounds a
+        dense lower triangular block. The eliminated outputs are rebuilt by write_sparse_solution.
+        """
+        n = int(self.N)
+        dt = self.dt
+        lp = SparseLP(solver=config_manager.mpc_sparse_solver)
+
+        lp.add_variable(self.p_charge, upper=0.0)
+        lp.add_variable(self.p_discharge, upper=0.0)
+        lp.add_variable(self.soc_next, lower=0.0, upper=0.0)
+        lp.add_variable(self.solar_used, upper=0.0)
+        lp.add_variable(self.grid_import, upper=0.0)
+        lp.add_variable(self.grid_export, upper=0.0)
+        if self.demand_tarrif:
+            lp.add_variable(self.peak_demand)
+
+        previous_soc = np.concatenate(([0], np.arange(n - 1))) # soc_next[k - 1], the first row's coefficient is 0 and soc_init is on its rhs
+        lp.rows = {
+            "soc_dynamics": lp.add_rows(n, [
+                (self.soc_next, None, 1.0),
+                (self.soc_next, previous_soc, np.concatenate(([0.0], np.full(n - 1, -1.0)))),
+                (self.p_charge, None, -dt * self.discharge_efficiency),
+                (self.p_discharge, None, dt / self.discharge_efficiency),
+            ], ROW_EQ),
+            "inverter": lp.add_rows(n, [
+                (self.solar_used, None, 1.0),
+                (self.p_discharge, None, 1.0),
+                (self.p_charge, None, -1.0),
+            ], ROW_RANGE),
+        }
+        if self.demand_tarrif:
+            lp.rows["peak_demand"] = lp.add_rows(n, [(self.grid_import, None, 1.0), (self.peak_demand, None, -1.0)], ROW_LE)
+
+        balance_terms = [
+            (self.grid_import, None, 1.0),
+            (self.solar_used, None, 1.0),
+            (self.p_discharge, None, 1.0),
+            (self.p_charge, None, -1.0),
+            (self.grid_export, None, -1.0),
+        ]
+        for load in self.optional_loads:
+            l_p_var = load.build_sparse(lp, self)
+            balance_terms.append((l_p_var, None, -1.0))
+
+        lp.rows["power_balance"] = lp.add_rows(n, balance_terms, ROW_EQ)
+        lp.compile()
+        return lp
+
+    def update_sparse_values(self, lp=None):
+        """Rewrite the sparse LP vectors (of self.sparse_lp by default) in place from the current cvxpy parameter values."""
+        lp = lp if lp is not None else self.sparse_lp
+        if self.formulation == "condensed":
+            self.update_condensed_sparse_values(lp)
+            return
+
+        rows = lp.rows
+        dt = self.dt
+        n = int(self.N)
+
+        solar_forecast = self.solar_forecast_param.value
+        soc_reward = self.charge_maintain_reward * self.step_sizes + self.full_battery_reward * self.solar_eod_reward_mask_param.value
+
+        lp.set_rhs(rows["soc_init"], self.soc_init_param.value)
+        lp.set_rhs(rows["soc_dynamics"], 0.0)
+        lp.set_rhs(rows["solar_split"], solar_forecast)
+        lp.set_rhs(rows["inverter_balance"], 0.0)
+        lp.set_rhs(rows["peak_demand"], np.where(self.demand_mask_param.value > 0, 0.0, np.inf))
+        lp.set_rhs(rows["power_balance"], self.load_forecast_param.value)
+
+        lp.set_bounds(self.p_charge, upper=self.p_max_charge_param.value)
+        lp.set_bounds(self.p_discharge, upper=self.p_max_discharge_param.value)
+        lp.set_bounds(self.soc, lower=-np.inf, upper=np.inf, index=[0])
+        lp.set_bounds(self.soc, lower=self.soc_min_param.value, upper=self.soc_max_param.value, index=slice(1, None))
+        lp.set_bounds(self.solar_used, upper=np.minimum(solar_forecast, self.solar_dc_max_param.value))
+        lp.set_bounds(self.grid_import, upper=self.grid_import_limit_param.value)
+        lp.set_bounds(self.grid_export, upper=self.grid_export_limit_param.value)
+        lp.set_bounds(self.inverter_power, lower=-self.inverter_p_max_param.value, upper=self.inverter_p_max_param.value)
+
+        lp.reset_cost()
+        lp.add_cost(self.grid_import, (self.price_buy_param.value + self.grid_import_penalty_cost) * dt)
+        lp.add_cost(self.grid_export, -self.price_sell_param.value * dt)
+        lp.add_cost(self.p_discharge, self.battery_min_export_cost * dt)
+        lp.add_cost(self.soc, -soc_reward, index=slice(0, n))
+        lp.add_cost(self.peak_demand, self.demand_peak_price_param.value)
+
+        for load in self.optional_loads:
+            load.update_sparse_values(lp, self)
+
+    def update_condensed_sparse_values(self, lp):
+        rows = lp.rows
+        dt = self.dt
+        n = int(self.N)
+
+        soc_init = self.soc_init_param.value
+        inverter_p_max = self.inverter_p_max_param.value
+        soc_reward = self.charge_maintain_reward * self.step_sizes + self.full_battery_reward * self.solar_eod_reward_mask_param.value
+
+        lp.set_rhs(rows["soc_dynamics"], np.concatenate(([soc_init], np.zeros(n - 1))))
+        if inverter_p_max >= max(self.solar_dc_max_param.value + self.p_max_discharge_param.value, self.p_max_charge_param.value):
+            lp.set_row_bounds(rows["inverter"], -np.inf, np.inf) # The limit can't bind, free rows are dropped by the solver's presolve
+        else:
+            lp.set_row_bounds(rows["inverter"], -inverter_p_max, inverter_p_max)
+        if self.demand_tarrif:
+            lp.set_rhs(rows["peak_demand"], np.where(self.demand_mask_param.value > 0, 0.0, np.inf))
+        lp.set_rhs(rows["power_balance"], self.load_forecast_param.value)
+
+        lp.set_bounds(self.p_charge, upper=self.p_max_charge_param.value)
+        lp.set_bounds(self.p_discharge, upper=self.p_max_discharge_param.value)
+        lp.set_bounds(self.soc_next, lower=self.soc_min_param.value, upper=self.soc_max_param.value)
+        lp.set_bounds(self.solar_used, upper=np.minimum(self.solar_forecast_param.value, self.solar_dc_max_param.value))
+        lp.set_bounds(self.grid_import, upper=self.grid_import_limit_param.value)
+        lp.set_bounds(self.grid_export, upper=self.grid_export_limit_param.value)
+
+        lp.reset_cost()
+        lp.add_cost(self.grid_import, (self.price_buy_param.value + self.grid_import_penalty_cost) * dt)
+        lp.add_cost(self.grid_export, -self.price_sell_param.value * dt)
+        lp.add_cost(self.p_discharge, self.battery_min_export_cost * dt)
+        lp.add_cost(self.soc_next, -soc_reward[1:], index=slice(0, n - 1)) # The reward on soc[k] applies to soc_next[k - 1]
+        lp.cost_offset[:] = -soc_reward[0] * soc_init
+        if self.demand_tarrif:
+            lp.add_cost(self.peak_demand, self.demand_peak_price_param.value)
+
+        for load in self.optional_loads:
+            load.update_sparse_values(lp, self)
+
+    def write_sparse_solution(self, lp=None):
+        """Write the sparse LP's solution into the cvxpy variables, rebuilding the variables the condensed formulation eliminates."""
+        lp = lp if lp is not None else self.sparse_lp
+        lp.write_solution()
+        if self.formulation != "condensed":
+            return
+
+        solar_used = self.solar_used.value
+        self.soc.value = np.concatenate(([self.soc_init_param.value], self.soc_next.value))
+        self.solar_curtail.value = np.maximum(self.solar_forecast_param.value - solar_used, 0.0)
+        self.inverter_power.value = solar_used + self.p_discharge.value - self.p_charge.value
+        if not self.demand_tarrif:
+            self.peak_demand.value = float(np.max(self.demand_mask_param.value * self.grid_import.value, initial=0.0))
+
+    def solve_cvxpy(self, verbose=False, deadline=None):
+        # Prefer ECOS for speed, but fall back to CLARABEL when ECOS reports an
+        # inaccurate solution to avoid propagating unstable plans.
+        if self.solve_worker is not None:
+            deadline = deadline or time.time() + self.solve_deadline
+            status = self.solve_worker.solve_cvxpy(self.prob, cp.ECOS, {"max_iters": 300}, deadline, verbose=verbose)
+            if status == "optimal_inaccurate":
+                logger.warning("ECOS returned optimal_inaccurate; retrying with CLARABEL.")
+                status = self.solve_worker.solve_cvxpy(self.prob, cp.CLARABEL, {}, deadline, verbose=verbose)
+            return status
+
+        if self.codegen_solver is not None and self.codegen_solver.ready():
+            try:
+                status = self.codegen_solver.solve()
+            except Exception as e:
+                status = f"error ({e})"
+            if status == "optimal":
+                logger.debug(f"Custom MPC solver returned {status} in {round(self.codegen_solver.solve_time, 3)} seconds after {self.codegen_solver.iterations} iterations.")
+                return status
+            logger.warning(f"Custom MPC solver returned {status}; retrying with the regular CVXPY path.")
+
+        with warnings.catch_warnings(record=True) as caught_warnings:
+            warnings.simplefilter("always", UserWarning)
+            self.prob.solve(solver=cp.ECOS, warm_start=True, max_iters=300, verbose=verbose) # Increased max iters to allow more time for solving
+            ecos_inaccurate = any("Solution may be inaccurate" in str(w.message) for w in caught_warnings)
+
+        if self.prob.status == "optimal_inaccurate" or ecos_inaccurate:
+            logger.warning(
+                f"ECOS returned {self.prob.status} (inaccurate={ecos_inaccurate}); retrying with CLARABEL."
+            )
+            self.prob.solve(solver=cp.CLARABEL, warm_start=True, verbose=verbose)
+
+        return self.prob.status
+
+    def shift_gather(self, elapsed_slots):
+        """
+        Map each step (N) and step boundary (N+1) of a horizon starting elapsed_slots x 5min
+        later onto the index covering the same time in the previous horizon. Steps past the
+        end of the previous horizon are padded with its final step.
+        """
+        boundaries = np.concatenate((self.step_offsets, [int(self.N_5min)]))
+        step_gather = np.searchsorted(self.step_offsets, self.step_offsets + elapsed_slots, side="right") - 1
+        state_gather = np.searchsorted(boundaries, boundaries + elapsed_slots, side="right") - 1
+        return np.minimum(step_gather, int(self.N) - 1), np.minimum(state_gather, int(self.N))
+
+    def solve_sparse(self, verbose=False, start_time=None, deadline=None):
+        self.update_sparse_values()
+
+        # Shift the previous plan (primal, duals and basis) forward by the elapsed time to warm start the solver
+        elapsed_slots = 0
+        shift_gathers = None
+        if start_time is not None and self.last_solve_start is not None:
+            elapsed_slots = int(round((start_time - self.last_solve_start).total_seconds() / 300))
+            if 0 < elapsed_slots < int(self.N_5min):
+                shift_gathers = self.shift_gather(elapsed_slots)
+
+        if self.solve_worker is not None:
+            status = self.solve_worker.solve_sparse_lp(self.sparse_lp, shift_gathers, deadline or time.time() + self.solve_deadline, verbose=verbose)
+        else:
+            if shift_gathers is not None:
+                self.sparse_lp.shift_warm_start(*shift_gathers)
+            status = self.sparse_lp.solve(verbose=verbose)
+        logger.debug(f"Sparse LP ({self.sparse_lp.solver}) returned {status} in {round(self.sparse_lp.solve_time, 3)} seconds after {self.sparse_lp.iterations} iterations.")
+
+        if status in ("optimal", "optimal_inaccurate"):
+            self.last_solve_start = start_time
+            self.update_solver_metrics(elapsed_slots)
+            self.write_sparse_solution()
+            if(config_manager.mpc_backend_parity_check):
+                self.check_backend_parity()
+        return status
+
+    def solve_scenarios(self, amber_data, deadline):
+        """Solve the forecast scenarios and load the reconciled plan, see scenarios.py. The forecast parameters are restored if none solve."""
+        forecast_params = [self.solar_forecast_param, self.load_forecast_param, self.price_buy_param, self.price_sell_param]
+        forecast_values = [param.value for param in forecast_params]
+
+        scenarios = self.scenario_planner.build(self, amber_data)
+        if self.solve_deadline <= 0:
+            deadline = time.time() + ScenarioPlanner.NO_DEADLINE_SECONDS
+        self.scenario_planner.solve(self, scenarios, deadline)
+        selected = self.scenario_planner.select(self, scenarios)
+        if selected is None:
+            for param, value in zip(forecast_params, forecast_values):
+                param.value = value
+            return "infeasible"
+
+        # Publish the selected scenario's forecasts with its plan so the plan's power balance holds
+        self.scenario_planner.set_parameters(self, selected)
+        self.sparse_lp.load_result(selected.status, selected.x, None, selected.objective_value, 0, self.scenario_planner.solve_time, False)
+        self.write_sparse_solution()
+        return selected.status
+
+    def initial_state_pairs(self):
+        """(initial state parameter, state variable) pairs for the battery and each optional load."""
+        pairs = [(self.soc_init_param, self.soc)]
+        for load in self.optional_loads:
+            pairs += load.initial_state()
+        return pairs
+
+    def update_solver_metrics(self, elapsed_slots):
+        iterations = self.sparse_lp.iterations
+        if self.cold_solve_iterations is None:
+            self.cold_solve_iterations = iterations
+        self.solver_iterations = iterations
+        self.solver_iterations_saved = max(0, self.cold_solve_iterations - iterations) if self.sparse_lp.warm_started else 0
+        if self.sparse_lp.warm_started:
+            logger.debug(f"Warm start shifted by {elapsed_slots}x5min: {iterations} iterations vs {self.cold_solve_iterations} cold ({self.solver_iterations_saved} saved).")
+
+    def check_backend_parity(self):
+        """Solve the same inputs through the CVXPY path and report how far the sparse backend's plan differs."""
+        sparse_values = [(var, var.value) for var in self.prob.variables()] # Includes the variables the condensed formulation rebuilds
+        sparse_objective = self.sparse_lp.objective_value
+        start = time.time()
+        cvxpy_status = self.solve_cvxpy()
+        cvxpy_time = time.time() - start
+
+        if cvxpy_status not in ("optimal", "optimal_inaccurate"):
+            logger.warning(f"Backend parity check: CVXPY returned {cvxpy_status} while the sparse backend returned {self.sparse_lp.status}.")
+        else:
+            cvxpy_objective = float(self.prob.objective.value) # Evaluated from the variables, also set when the custom solver ran
+            objective_diff = abs(cvxpy_objective - sparse_objective)
+            max_diffs = {
+                var.name(): float(np.max(np.abs(np.atleast_1d(var.value) - np.atleast_1d(value))))
+                for var, value in sparse_values
+            }
+            tolerance = 1e-4 * max(1.0, abs(cvxpy_objective))
+            msg = (f"Backend parity check: objective sparse={sparse_objective:.5f} cvxpy={cvxpy_objective:.5f} (diff {objective_diff:.2e}), "
+                   f"solve time sparse={self.sparse_lp.solve_time:.3f}s cvxpy={cvxpy_time:.3f}s, max variable differences: {max_diffs}")
+            if objective_diff > tolerance:
+                logger.warning(msg)
+            else:
+                # Variable differences with a matching objective are alternative optimal plans (LP degeneracy), not a parity failure
+                logger.debug(msg)
+
+        # Keep executing the sparse backend's plan
+        for var, value in sparse_values:
+            var.value = value
+
     def run_optimisation(self, amber_data):
+        """Solve and publish the MPC plan, returns [output, plotted_output]. If the solve misses its deadline the last valid
+        plan is executed instead, or None is returned when there isn't one (see shifted_last_plan)."""
         start_optimisation = time.time()
 
         now = datetime.now(self.local_tz).replace(second=0, microsecond=0)
@@ -457,10 +953,11 @@ class MPC:
                 f"buy={len(price_buy_arr)}, sell={len(price_sell_arr)}"
             )
 
-        self.solar_forecast_param.value = solar_forecast_arr
-        self.load_forecast_param.value = load_forecast_arr
-        self.price_buy_param.value = price_buy_arr
-        self.price_sell_param.value = price_sell_arr
+        # Forecasts are aggregated onto the optimisation steps (a no-op for the uniform 5 minute horizon)
+        self.solar_forecast_param.value = self.to_steps(solar_forecast_arr)
+        self.load_forecast_param.value = self.to_steps(load_forecast_arr)
+        self.price_buy_param.value = self.to_steps(price_buy_arr)
+        self.price_sell_param.value = self.to_steps(price_sell_arr)
         self.grid_import_limit_param.value = float(self.grid_import_limit)
         self.grid_export_limit_param.value = float(self.grid_export_limit)
         self.p_max_charge_param.value = float(self.p_max_charge)
@@ -473,7 +970,7 @@ class MPC:
         demand_mask = np.array((self.demand_window_forecast > 0).astype(float), dtype=float)
         if len(demand_mask) != int(self.N_5min):
             raise RuntimeError(f"Demand mask length ({len(demand_mask)}) must equal N_5min ({int(self.N_5min)})")
-        self.demand_mask_param.value = demand_mask
+        self.demand_mask_param.value = self.to_steps(demand_mask, how="max")
         self.demand_peak_price_param.value = float(self.demand_tarrif_price) if self.demand_tarrif else 0.0
 
         solar_eod_reward_mask = np.zeros(int(self.N_5min), dtype=float)
@@ -484,31 +981,35 @@ class MPC:
         if tomorrow_solar_end_index is not None and tomorrow_solar_end_index > 0:
             solar_eod_reward_mask[tomorrow_solar_end_index] = 1.0 # Encorage the battery to be full by the end of the solar day tomorrow
 
-        self.solar_eod_reward_mask_param.value = solar_eod_reward_mask # Put the mask into the assigned parameter
+        self.solar_eod_reward_mask_param.value = self.to_steps(solar_eod_reward_mask, how="max") # Put the mask into the assigned parameter
 
         # ---------- Solve ----------
-        # Prefer ECOS for speed, but fall back to CLARABEL when ECOS reports an
-        # inaccurate solution to avoid propagating unstable plans.
-        ecos_inaccurate = False
-        def solve(self, verbose=False):
-
-            with warnings.catch_warnings(record=True) as caught_warnings:
-                warnings.simplefilter("always", UserWarning)
-                self.prob.solve(solver=cp.ECOS, warm_start=True, max_iters=300, verbose=verbose) # Increased max iters to allow more time for solving
-                ecos_inaccurate = any("Solution may be inaccurate" in str(w.message) for w in caught_warnings)
-
-            if self.prob.status == "optimal_inaccurate" or ecos_inaccurate:
-                logger.warning(
-                    f"ECOS returned {self.prob.status} (inaccurate={ecos_inaccurate}); retrying with CLARABEL."
-                )
-                self.prob.solve(solver=cp.CLARABEL, warm_start=True, verbose=verbose)
-
-        solve(self)
+        deadline = time.time() + self.solve_deadline # Only enforced when solving in the worker process
+        try:
+            plan_from_cache = self.plan_cache is not None and self.plan_cache.restore(self, now)
+            if plan_from_cache:
+                status = "optimal" # Inputs match the last solve, the cached plan has been written into the variables
+            elif self.scenario_planner is not None:
+                status = self.solve_scenarios(amber_data, deadline)
+                if status not in ("optimal", "optimal_inaccurate"):
+                    logger.warning("No MPC scenario could be solved; planning against the single forecast instead.")
+                    status = self.solve_sparse(start_time=now, deadline=deadline)
+            elif self.sparse_lp is not None:
+                status = self.solve_sparse(start_time=now, deadline=deadline)
+                if status not in ("optimal", "optimal_inaccurate"):
+                    logger.warning(f"Sparse LP backend ({self.sparse_lp.solver}) returned {status}; retrying with the CVXPY backend.")
+                    status = self.solve_cvxpy(deadline=deadline)
+            else:
+                status = self.solve_cvxpy(deadline=deadline)
+        except MPCSolveTimeoutError as e:
+            self.solve_timeouts += 1
+            logger.warning(f"{e} Executing the last valid plan instead.")
+            return self.shifted_last_plan(now) # None if there's no valid plan left, the caller falls back to its rule based policy
 
         # Don't continue if the solver failed
-        if self.prob.status not in ("optimal", "optimal_inaccurate"):
+        if status not in ("optimal", "optimal_inaccurate"):
             # Log parameter state to help debug infeasibility
-            logger.error(f"MPC solve failed with status: {self.prob.status}. Dumping parameters...")
+            logger.error(f"MPC solve failed with status: {status}. Dumping parameters...")
             logger.error(f"  soc_init: {self.soc_init_param.value:.4f}")
             logger.error(f"  soc_min: {self.soc_min_param.value:.4f}")
             logger.error(f"  soc_max: {self.soc_max_param.value:.4f}")
@@ -526,7 +1027,7 @@ class MPC:
                         logger.error(f"    p_max_param[0]: {load.p_max_param.value[0]:.4f}")
             
             logger.error("Solver failed, dumping first 10 values of key parameters for debugging:")
-            for i in range(min(10, int(self.N_5min))):
+            for i in range(min(10, int(self.N))):
                 logger.error(
                     f"  Index {i}: solar={self.solar_forecast_param.value[i]:.2f}, "
                     f"load={self.load_forecast_param.value[i]:.2f}, "
@@ -538,26 +1039,33 @@ class MPC:
             
             
             logger.info("Running Solver again in verbose mode to get more details on the failure...")
-            solve(self, verbose=True)
+            self.solve_cvxpy(verbose=True)
             
-            raise RuntimeError(f"MPC solve failed: {self.prob.status}")
+            raise RuntimeError(f"MPC solve failed: {status}")
         
         else: # Sim successfull 
-            # ---------- Results ----------
-            battery_power = (self.p_discharge.value - self.p_charge.value).tolist()
-
-            grid_import = self.grid_import.value.tolist()
-            grid_export = self.grid_export.value.tolist()
-            for i in range(len(grid_import)):
-                if grid_import[i] > self.power_threshold and grid_export[i] > self.power_threshold:
-                    logger.error(f"Simultaneous import and export detected at index {i}, time: {time_index[i].isoformat()} (import: {grid_import[i]:.2f} kW, export: {grid_export[i]:.2f} kW). This may indicate a problem with the solver or model formulation or buy price is below sell price.")
+            if self.plan_cache is not None and not plan_from_cache:
+                self.plan_cache.store(self, now)
 
-            grid_net = (self.grid_import.value - self.grid_export.value).tolist()
-            self.next_grid_interaction_kwh = self.calculate_next_grid_interaction_kwh(grid_net)
+            # ---------- Results ----------
+            start_post_processing = time.time()
+            # Results are expanded back onto the 5 minute grid (a no-op for the uniform horizon)
+            p_charge = self.to_5min(self.p_charge.value)
+            p_discharge = self.to_5min(self.p_discharge.value)
+            grid_import_power = self.to_5min(self.grid_import.value)
+            grid_export_power = self.to_5min(self.grid_export.value)
+            battery_power = p_discharge - p_charge
+
+            simultaneous = np.flatnonzero((grid_import_power > self.power_threshold) & (grid_export_power > self.power_threshold))
+            for i in simultaneous:
+                logger.error(f"Simultaneous import and export detected at index {i}, time: {time_index[i].isoformat()} (import: {grid_import_power[i]:.2f} kW, export: {grid_export_power[i]:.2f} kW). This may indicate a problem with the solver or model formulation or buy price is below sell price.")
+
+            grid_net = grid_import_power - grid_export_power
+            self.next_grid_interaction_kwh = self.calculate_next_grid_interaction_kwh(grid_net.tolist())
             #hours = np.arange(int(self.N_5min)) * self.dt_5min
 
-            grid_kwh_import_per_interval = self.grid_import.value / self.steps_per_hr 
-            grid_kwh_export_per_interval = self.grid_export.value / self.steps_per_hr 
+            grid_kwh_import_per_interval = grid_import_power / self.steps_per_hr 
+            grid_kwh_export_per_interval = grid_export_power / self.steps_per_hr 
 
             # Per-interval profit ($)
             interval_profit = (
@@ -565,40 +1073,36 @@ class MPC:
                 - grid_kwh_import_per_interval * self.prices_buy
             )
 
-            today = now.date()
-            tomorrow = today + timedelta(days=1)
-
-            forecast_profit_today = 0.0
-            forecast_profit_tomorrow = 0.0
-
-            for t, ts in enumerate(time_index):
-                if ts.date() == today:
-                    forecast_profit_today += interval_profit[t]
-                elif ts.date() == tomorrow:
-                    forecast_profit_tomorrow += interval_profit[t]
+            # Sum the profit by day, 0 = today, 1 = tomorrow (time_index steps the local wall clock in 5 minute increments)
+            day_index = (now.hour * 60 + now.minute + 5 * np.arange(len(time_index))) // (24 * 60)
+            profit_by_day = np.bincount(day_index, weights=interval_profit, minlength=2)
+            forecast_profit_today = profit_by_day[0]
+            forecast_profit_tomorrow = profit_by_day[1]
 
             # Round all the mpc data to 2 dp
-            battery_power = [round(x, 2) for x in battery_power]
-            battery_soc = [round(x, 2) for x in self.soc.value.tolist()]
-            grid_net = [round(x, 2) for x in grid_net]
-            inverter_power = [round(x, 2) for x in self.inverter_power.value.tolist()]
-            solar_forecast_power = [round(x, 2) for x in self.solar_5min]
-            solar_used_power = [round(x, 2) for x in self.solar_used.value.tolist()]
-
-            load_power = [round(load, 2) for load in self.load_5min]
+            battery_power = np.round(battery_power, 2).tolist()
+            battery_soc = np.round(self.to_5min(self.soc.value), 2).tolist()
+            grid_net = np.round(grid_net, 2).tolist()
+            inverter_power = np.round(self.to_5min(self.inverter_power.value), 2).tolist()
+            # Use the forecasts the plan was solved against so each interval's power balance holds in multi-rate mode
+            solar_forecast_power = np.round(self.to_5min(self.solar_forecast_param.value), 2).tolist()
+            solar_used_power = np.round(self.to_5min(self.solar_used.value), 2).tolist()
+
+            load_power = np.round(self.to_5min(self.load_forecast_param.value), 2)
             
             optional_loads_results = {}
             for load in self.optional_loads:
                 try:
-                    res = load.get_results(self.dt_5min)
+                    res = self.expand_load_results(load.get_results(self.dt_5min))
                     if "raw_power" in res:
                         # Aggregating power for the total site load forecast, using the raw load power that hasn't been clipped
-                        load_power = [round(lp + p, 2) for lp, p in zip(load_power, res["raw_power"])]
+                        load_power = np.round(load_power + np.asarray(res["raw_power"], dtype=float), 2)
                     else:
                         logger.error(f"Optional load '{load.name}' did not return 'raw_power' in results, cannot include in total load forecast. Results returned: {res}")
                     optional_loads_results[load.name] = res
                 except Exception as e:
                     logger.warning(f"Failed to get results from optional load '{load.name}'. Error: {e}")
+            load_power = load_power.tolist()
 
             self.profit_remaining_today = round(float(forecast_profit_today), 2)
             self.profit_tomorrow = round(float(forecast_profit_tomorrow), 2)
@@ -659,20 +1163,177 @@ class MPC:
             }            
             mqtt_client.publish("home/mpc/output", json.dumps(plotted_output), retain=True)'''
 
+            logger.debug(f"MPC post-solve processing took {(time.time() - start_post_processing)*1000:.1f} ms.")
             mqtt_client.publish("home/mpc/output", json.dumps(output), retain=True)
         
             self.current_effective_price = self.determine_current_effective_price(output) # Determine the current effective price of electricity based on the MPC plan and current conditions. 
 
             logger.info(f"Solver took {round(time.time()-start_optimisation,2)} seconds to get data, build and solve. The selected mode is: {output['plan_modes'][0]}")
 
+            self.last_output = output
+            self.last_output_start = now
+            self.last_inputs = {
+                "start_time": now,
+                "params": {param.id: np.copy(param.value) for param in self.prob.parameters()},
+                "prices_buy": self.prices_buy.copy(),
+                "prices_sell": self.prices_sell.copy(),
+            }
             return [output, plotted_output]
 
+    def shifted_last_plan(self, now):
+        """The last valid plan shifted to start at now (padded with its final values), executed when a solve misses its deadline.
+        None if there is no previous plan or it has run out."""
+        if self.last_output is None:
+            logger.warning("There is no previous MPC plan to fall back on.")
+            return None
+
+        elapsed_slots = int(round((now - self.last_output_start).total_seconds() / 300))
+        if elapsed_slots >= len(self.last_output["time_index"]):
+            logger.warning("The previous MPC plan has expired.")
+            return None
+
+        def shift(value):
+            if isinstance(value, dict):
+                return {k: shift(v) for k, v in value.items()}
+            if isinstance(value, list) and len(value) >= int(self.N_5min) and elapsed_slots > 0:
+                return value[elapsed_slots:] + value[-1:] * elapsed_slots
+            return value
+
+        output = shift(self.last_output)
+        output["time_index"] = [(now + timedelta(minutes=5 * i)).isoformat() for i in range(len(output["time_index"]))]
+        mqtt_client.publish("home/mpc/output", json.dumps(output), retain=True)
+        return [output, {}]
+
+    # ---------- What-if sweeps ----------
+    def set_what_if_overrides(self, overrides) -> list:
+        """Apply a what-if variant's overrides, returning callables that undo them."""
+        loads = {load.name: load for load in self.optional_loads}
+        undo = []
+        for key, value in overrides.items():
+            if key in self.WHAT_IF_PARAMETERS:
+                attribute, scale = self.WHAT_IF_PARAMETERS[key]
+                undo.append(lambda attribute=attribute, previous=getattr(self, attribute): setattr(self, attribute, previous))
+                setattr(self, attribute, float(value) * scale)
+                continue
+
+            name, _, setting = key.rpartition(".")
+            if name not in loads or setting != "reward_cents_per_kwh":
+                for undo_override in reversed(undo):
+                    undo_override()
+                raise MPCWhatIfError(f"Unknown what-if parameter '{key}'. Expected one of {list(self.WHAT_IF_PARAMETERS)} or '<optional load name>.reward_cents_per_kwh'.")
+            load = loads[name]
+            undo.append(lambda load=load, previous=load.reward_cents_per_kwh: load.set_reward(previous))
+            load.set_reward(float(value))
+        return undo
+
+    def write_what_if_variant(self, lp, overrides):
+        undo = self.set_what_if_overrides(overrides)
+        try:
+            self.update_sparse_values(lp)
+        finally:
+            for undo_override in reversed(undo):
+                undo_override()
+
+    def what_if(self, overrides: list[dict]) -> list[dict]:
+        """
+        Re-solve the last run's inputs once per dict of overrides (keys from WHAT_IF_PARAMETERS or
+        "<optional load name>.reward_cents_per_kwh", an empty dict is the base case) and return the
+        expected profit, battery cycling and grid energy of each variant. The variants share one
+        compiled sparse LP, only its cost vector changes, and are solved across a worker pool.
+        """
+        if self.last_inputs is None:
+            raise MPCWhatIfError("The MPC hasn't completed a run yet, there are no inputs to run a what-if sweep against.")
+        for variant in overrides:
+            for undo_override in self.set_what_if_overrides(variant): # Reject unknown keys before anything is solved
+                undo_override()
+
+        if self.what_if_lp is None:
+            self.what_if_lp = self.build_sparse_template() # Separate from self.sparse_lp so its warm start isn't disturbed, each LP carries its own row maps
+        lp = self.what_if_lp
+
+        # Solve against the snapshot of the last run's inputs, then put the current values back
+        params = self.prob.parameters()
+        current_values = [param.value for param in params]
+        try:
+            for param in params:
+                param.value = self.last_inputs["params"][param.id]
+
+            variants = [lambda variant=variant: self.write_what_if_variant(lp, variant) for variant in overrides]
+            solutions = []
+            if self.what_if_workers > 0:
+                if self.what_if_pool is None:
+                    self.what_if_pool = SolveWorkerPool(self.what_if_workers)
+                for reply, outputs in self.what_if_pool.solve_sparse_lps(lp, variants, time.time() + self.WHAT_IF_DEADLINE_SECONDS):
+                    solutions.append((reply["status"], outputs.get("x"), reply.get("objective_value")))
+            else:
+                for write_variant in variants:
+                    write_variant()
+                    status = lp.solve()
+                    solutions.append((status, None if lp.x is None else np.array(lp.x), lp.objective_value))
+        finally:
+            for param, value in zip(params, current_values):
+                param.value = value
+
+        return [self.what_if_metrics(lp, variant, *solution) for variant, solution in zip(overrides, solutions)]
+
+    def what_if_metrics(self, lp, overrides, status, x, objective_value) -> dict:
+        result = {"overrides": overrides, "status": status}
+        if x is None or status not in ("optimal", "optimal_inaccurate"):
+            return result
+
+        dt = self.dt
+        def energy(var): # kWh over the horizon
+            return float(x[lp.cols(var)] @ dt)
+
+        prices_buy = self.to_steps(self.last_inputs["prices_buy"])
+        prices_sell = self.to_steps(self.last_inputs["prices_sell"])
+        profit = float((x[lp.cols(self.grid_export)] * prices_sell - x[lp.cols(self.grid_import)] * prices_buy) @ dt)
+        charge_kwh = energy(self.p_charge)
+        discharge_kwh = energy(self.p_discharge)
+
+        result.update({
+            "objective": round(float(objective_value), 4),
+            "profit": round(profit, 2), # $ over the whole horizon at the forecast (not effective) prices
+            "grid_import_kwh": round(energy(self.grid_import), 2),
+            "grid_export_kwh": round(energy(self.grid_export), 2),
+            "battery_discharge_kwh": round(discharge_kwh, 2),
+            "battery_cycles": round((charge_kwh + discharge_kwh) / 2 / max(self.battery_capacity, 1e-6), 2),
+        })
+        return result
+
+    def process_what_if_requests(self):
+        """Run any what-if sweeps requested from the dashboard and publish the results."""
+        while not what_if_requests.empty():
+            request = what_if_requests.get()
+            response = {"request_id": request.get("request_id")}
+            start = time.time()
+            try:
+                response["results"] = self.what_if(request.get("overrides") or [{}])
+                response["base_start_time"] = self.last_inputs["start_time"].isoformat()
+            except Exception as e: # A failed sweep is reported to the dashboard, it mustn't affect control
+                logger.warning(f"What-if sweep failed: {e}")
+                response["error"] = str(e)
+            response["solve_time"] = round(time.time() - start, 2)
+            logger.info(f"What-if sweep of {len(request.get('overrides') or [{}])} variants took {response['solve_time']} seconds.")
+            mqtt_client.publish(WHAT_IF_RESULT_TOPIC, json.dumps(response))
+
+    def expand_load_results(self, res):
+        """Expand an optional load's per-step result lists onto the 5 minute grid."""
+        if self.N == int(self.N_5min):
+            return res
+        return {
+            key: [round(float(x), 2) for x in self.to_5min(value)] if isinstance(value, list) and len(value) in (self.N, self.N + 1) else value
+            for key, value in res.items()
+        }
+
     def convert_to_python(self, obj): # Convert all np objects to python objects
         if isinstance(obj, np.ndarray):
             return obj.tolist()
         if isinstance(obj, dict):
             return {k: self.convert_to_python(v) for k, v in obj.items()}
         if isinstance(obj, list):
+            if all(type(v) in (float, int, str, bool) for v in obj):
+                return obj # Already plain python, ie the plan arrays produced by tolist()
             return [self.convert_to_python(v) for v in obj]
         return obj
     
@@ -735,12 +1396,40 @@ class MPC:
                 raise Exception(error_msg) from None
             return "Unable to determine"
         
-    def determine_plan_modes(self, output): # Determine the control modes for the whole plan
-        plan_modes = []
-        for i in range(len(output["inverter_power"])):
-            mode = self.determine_control_mode(output, increment=i, control_active=False)
-            plan_modes.append(mode)
-        return plan_modes
+    def determine_plan_modes(self, output, power_threshold=0.2): # Determine the control modes for the whole plan
+        """
+        Vectorised version of determine_control_mode (with control_active=False) for every step of the plan.
+        The conditions and their precedence must be kept in sync with determine_control_mode, which is still
+        used for the single step that gets actuated.
+        """
+        inverter_power = np.asarray(output["inverter_power"], dtype=float)
+        used_solar_power = np.asarray(output["solar_used"], dtype=float)
+        solar_available = np.asarray(output["solar_forecast"], dtype=float)
+        load_power = np.asarray(output["load_power"], dtype=float)
+        grid_net = np.asarray(output["grid_net"], dtype=float) # if grid_net is positive we are importing power 
+        battery_power = np.asarray(output["battery_power"], dtype=float)
+        approx_equal = data_helpers.approx_equal # Works element-wise on arrays
+
+        conditions = [
+            (approx_equal(inverter_power, used_solar_power) & (used_solar_power >= load_power + power_threshold) & (grid_net <= -power_threshold))
+                | (approx_equal(inverter_power, self.plant.max_inverter_power) & (used_solar_power > self.plant.max_inverter_power)),
+            approx_equal(inverter_power, load_power) & approx_equal(load_power, used_solar_power) & (used_solar_power + power_threshold <= solar_available),
+            approx_equal(inverter_power, load_power) & approx_equal(used_solar_power + battery_power, load_power),
+            (inverter_power >= used_solar_power + power_threshold) & (inverter_power >= load_power + power_threshold),
+            (grid_net <= -power_threshold) & (used_solar_power >= inverter_power + power_threshold),
+            (grid_net >= power_threshold) & (inverter_power > -self.power_threshold),
+            grid_net >= power_threshold,
+        ]
+        modes = [
+            self.plant.ControlMode.EXPORT_ALL_SOLAR,
+            self.plant.ControlMode.SOLAR_TO_LOAD,
+            self.plant.ControlMode.SELF_CONSUMPTION,
+            self.plant.ControlMode.DISPATCH,
+            self.plant.ControlMode.EXPORT_EXCESS_SOLAR,
+            self.plant.ControlMode.PARTIAL_GRID_IMPORT,
+            self.plant.ControlMode.GRID_IMPORT,
+        ]
+        return np.select(conditions, np.array(modes, dtype=object), default="Unable to determine").tolist()
     
     def calculate_next_grid_interaction_kwh(self, grid_net):
         """Return the upcoming contiguous import/export interaction energy in kWh."""
@@ -769,7 +1458,12 @@ class MPC:
         return round(float(interaction_kwh), 2)
 
     def run(self, amber_data):
-        [output, plotted_output] = self.run_optimisation(amber_data)
+        result = self.run_optimisation(amber_data)
+        if result is None: # The solve missed its deadline with no valid plan to fall back on
+            logger.warning("Falling back to self consumption.")
+            self.plant.self_consumption()
+            return None, self.plant.ControlMode.SELF_CONSUMPTION
+        [output, plotted_output] = result
         control_mode = self.determine_control_mode(output)
         logger.debug(f"Determined control mode: {control_mode} based on MPC plan, with load: {output['load_power'][0]} kW, solar forecast: {output['solar_forecast'][0]} kW, solar used: {output['solar_used'][0]} kW, inverter power: {output['inverter_power'][0]} kW, grid net: {output['grid_net'][0]} kW, battery power: {output['battery_power'][0]} kW.")
         return output, control_mode
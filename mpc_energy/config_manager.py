@@ -137,3 +137,23 @@ spike_price_warning_level = get_entity_id("spike_price_warning_level", default=5
 notification_target = get_entity_id("notification_target", default="")
 notification_target_option = get_entity_id("notification_target_option", default="both")
 log_level = get_entity_id("log_level", default="info")
+ha_websocket_states = get_entity_id("ha_websocket_states", default=True) # Keep entity states current over HA's websocket API instead of a REST request per read
+ha_tick_snapshots = get_entity_id("ha_tick_snapshots", default=True) # Read every entity with one GET /api/states per control loop for reads the websocket doesn't serve
+ha_load_statistics = get_entity_id("ha_load_statistics", default=True) # Build load profiles from HA's 5 minute statistics instead of the raw state history when available
+ha_history_store = get_entity_id("ha_history_store", default=True) # Keep 5 minute binned history in /data so only the gap since the last write is fetched from HA
+
+# Optimiser settings (Web UI)
+mpc_solver_backend = get_entity_id("mpc_solver_backend", default="cvxpy") # "cvxpy" or "sparse" (direct sparse-matrix LP)
+mpc_sparse_solver = get_entity_id("mpc_sparse_solver", default="highs") # Solver used by the sparse backend: "highs", "osqp" or "clarabel"
+mpc_formulation = get_entity_id("mpc_formulation", default="full") # Sparse backend LP: "full" (same as the CVXPY model) or "condensed" (equality-defined variables substituted out)
+mpc_codegen = get_entity_id("mpc_codegen", default=False) # Generate and compile a problem-specific solver for the CVXPY path with cvxpygen (cached in /data/mpc_codegen)
+mpc_backend_parity_check = get_entity_id("mpc_backend_parity_check", default=False) # Re-solve through CVXPY and log the difference when using the sparse backend
+online_load_profile = get_entity_id("online_load_profile", default=True) # Update the load profile every 5 minutes from the load power read each loop, seeded (and saved in /data) instead of rebuilt from the history daily
+mpc_solve_deadline = get_entity_id("mpc_solve_deadline", default=0) # Seconds, solve in a worker process and execute the last plan if the deadline is missed (0 = solve in the main process)
+mpc_plan_cache = get_entity_id("mpc_plan_cache", default=False) # Reuse the previous (time-shifted) plan when the MPC inputs haven't changed
+mpc_plan_cache_max_age = get_entity_id("mpc_plan_cache_max_age", default=15) # Minutes a cached plan can be reused for before a fresh solve is forced
+mpc_horizon_mode = get_entity_id("mpc_horizon_mode", default="uniform") # "uniform" (5 minute steps) or "multi_rate" (5/15/30 minute steps further into the horizon)
+mpc_scenario_mode = get_entity_id("mpc_scenario_mode", default=False) # Plan against several solar/load/price forecast scenarios (sparse backend only)
+mpc_scenario_count = get_entity_id("mpc_scenario_count", default=3) # Number of forecast scenarios solved each run
+mpc_scenario_workers = get_entity_id("mpc_scenario_workers", default=2) # Worker processes the scenarios are solved on (0 = solve them one after another in the main process)
+mpc_what_if_workers = get_entity_id("mpc_what_if_workers", default=2) # Worker processes what-if sweeps from the dashboard are solved on (0 = solve in the main process)
@@ -1,9 +1,13 @@
 # This file is used to manipulate and manage data from HA entities. 
 import datetime
-import pandas as pd
+import math
+import time
+import warnings
+from collections import deque
+import numpy as np
 
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any
 
 @dataclass
@@ -24,9 +28,144 @@ def round_minutes(time: datetime.datetime, nearest_minute: int) -> datetime.date
 def approx_equal(a, b, threshold = 0.2):
     return abs(a-b) < threshold
 
+@dataclass(slots=True)
+class BinnedSeries:
+    times: np.ndarray   # int64 epoch seconds of each bin's start (the bins from bin_times)
+    values: np.ndarray  # float64 average of each bin
+
+    def __len__(self):
+        return len(self.values)
+
+@dataclass
+class DayProfile:
+    """A value per time of day bin (ie the average load power), indexed by the bin's slot: minutes since midnight // step_minutes."""
+    values: np.ndarray                  # float64 per slot
+    step_minutes: int = 5
+    daily: np.ndarray | None = None     # (days, slots) of the daily values the profile was averaged from, NaN where missing
+    start: datetime.date | None = None  # Date of daily's first row
+    quantiles: dict = field(default_factory=dict, repr=False) # Cache of quantile profiles, a profile is never changed once built
+    energy_index: np.ndarray | None = field(default=None, repr=False) # Cumulative energy at the start of each slot, see energy
+
+    def __len__(self):
+        return len(self.values)
+
+    def slot(self, time: datetime.datetime) -> int:
+        return (time.hour * 60 + time.minute) // self.step_minutes
+
+    def slots(self, start: datetime.datetime, steps: int) -> np.ndarray:
+        """Slots of the steps consecutive bins from start. Steps are step_minutes of elapsed time, so across a
+        DST change the slots follow the wall clock's jump."""
+        if self.crosses_dst(start, steps):
+            utc_start = start.astimezone(datetime.timezone.utc)
+            step = datetime.timedelta(minutes=self.step_minutes)
+            return np.array([self.slot((utc_start + step * i).astimezone(start.tzinfo)) for i in range(steps)])
+        return (self.slot(start) + np.arange(steps)) % len(self)
+
+    def crosses_dst(self, start: datetime.datetime, steps: int) -> bool:
+        if start.tzinfo is None or not steps:
+            return False
+        end = start.astimezone(datetime.timezone.utc) + datetime.timedelta(minutes=self.step_minutes * steps)
+        return end.astimezone(start.tzinfo).utcoffset() != start.utcoffset()
+
+    def energy(self, start: datetime.datetime, steps: int) -> float:
+        """Energy (value x hours, ie kWh of a kW profile) of the steps consecutive bins from start, slots without
+        a value count as the average slot. Answered in O(1) from a cyclic prefix sum of the profile."""
+        if self.energy_index is None:
+            values = np.where(np.isnan(self.values), np.nanmean(self.values), self.values) * (self.step_minutes / 60)
+            self.energy_index = np.concatenate(([0.0], np.cumsum(values)))
+        index = self.energy_index
+        if self.crosses_dst(start, steps):
+            return float(np.diff(index)[self.slots(start, steps)].sum())
+
+        days, rest = divmod(steps, len(self))
+        first = self.slot(start)
+        end = first + rest
+        if end <= len(self):
+            return float(days * index[-1] + index[end] - index[first])
+        return float(days * index[-1] + index[-1] - index[first] + index[end - len(self)]) # Wraps past midnight
+
+    def day_energy(self) -> float:
+        """Energy of the whole day, see energy."""
+        return self.energy(datetime.datetime.min, len(self))
+
+    def quantile(self, q) -> np.ndarray:
+        """Per slot quantile of the daily values, slots without any fall back to the profile's value."""
+        if self.daily is None:
+            return self.values
+        if q not in self.quantiles:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning) # All-NaN slots
+                values = np.nanquantile(self.daily, q, axis=0)
+            self.quantiles[q] = np.where(np.isnan(values), self.values, values)
+        return self.quantiles[q]
+
+class RollingAverage:
+    """Average of the values added in the last window_seconds, kept as a running sum so adding and reading are O(1)."""
+    def __init__(self, window_seconds=300):
+        self.window_seconds = window_seconds
+        self.samples = deque() # (timestamp, value), oldest first
+        self.total = 0.0
+
+    def add(self, value, timestamp=None):
+        if value is None or math.isnan(value):
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        self.samples.append((timestamp, float(value)))
+        self.total += float(value)
+        self.evict(timestamp)
+
+    def evict(self, now):
+        while self.samples and self.samples[0][0] <= now - self.window_seconds:
+            self.total -= self.samples.popleft()[1]
+        if not self.samples:
+            self.total = 0.0 # Clear the float error the running sum picks up
+
+    def average(self, now=None) -> float | None:
+        """The window's average, None if nothing was added in it."""
+        self.evict(time.time() if now is None else now)
+        return self.total / len(self.samples) if self.samples else None
+
+class BinAverages:
+    """Averages of the values added in each bin_seconds bin (aligned to the epoch). A bin is kept until it's
+    taken with pop_completed or pop, or is older than keep_seconds, so a late reader still gets all of it."""
+    def __init__(self, bin_seconds=300, keep_seconds=3600):
+        self.bin_seconds = bin_seconds
+        self.keep_seconds = keep_seconds
+        self.bins = {} # bin start -> [sum, count, timestamp of the first value]
+
+    def add(self, value, timestamp=None):
+        if value is None or math.isnan(value):
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        start = timestamp // self.bin_seconds * self.bin_seconds
+        if start not in self.bins:
+            self.bins[start] = [0.0, 0, timestamp]
+            for old in [old for old in self.bins if old < timestamp - self.keep_seconds]:
+                del self.bins[old]
+        self.bins[start][0] += float(value)
+        self.bins[start][1] += 1
+
+    def pop(self, start) -> float | None:
+        """Remove a bin and return its average, None if nothing was added in it."""
+        entry = self.bins.pop(start, None)
+        return entry[0] / entry[1] if entry else None
+
+    def pop_completed(self, now=None, max_gap=None) -> list[tuple[float, float]]:
+        """Remove the bins that have ended by now and return their (start, average), oldest first. Bins whose first
+        value was added more than max_gap seconds (default half a bin) after their start, ie only partly recorded, are dropped."""
+        now = time.time() if now is None else now
+        max_gap = self.bin_seconds / 2 if max_gap is None else max_gap
+        completed = []
+        for start in sorted(start for start in self.bins if start + self.bin_seconds <= now):
+            total, count, first = self.bins.pop(start)
+            if first <= start + max_gap:
+                completed.append((start, total / count))
+        return completed
+
 def bin_data(history, bin_period, start_bin_datetime, end_bin_datetime, string_state=False, interpolation_method="linear") -> list[BinnedStateClass]: 
     """
-    Takes a list of historical state data and bins it into specified time intervals, averaging the state values within each bin. Handles both numeric and string states. Also fills in missing bins with None values and can interpolate those values if desired.
+    Takes a list of historical state data and bins it into specified time intervals, averaging the state values within each bin. Handles both numeric and string states. Also fills in missing bins and can interpolate those values if desired.
+    Numeric states are binned by bin_series, callers with history arrays should use it directly.
 
     history[x].state    -> numeric value (string or float)
     history[x].time     -> datetime object (tz-aware)
@@ -42,100 +181,130 @@ def bin_data(history, bin_period, start_bin_datetime, end_bin_datetime, string_s
             ...
         ]
     """
+    times = bin_times(bin_period, start_bin_datetime, end_bin_datetime)
     bin_delta = datetime.timedelta(minutes=bin_period)
-    if end_bin_datetime < start_bin_datetime:
-        raise ValueError(f"end_bin_datetime: '{end_bin_datetime}' must be greater than or equal to start_bin_datetime: '{start_bin_datetime}'")
-    bin_qty = int(((end_bin_datetime - start_bin_datetime).total_seconds()) // bin_delta.total_seconds()) + 1
 
-    # Remove any invalid states from the history list (Unavailable, None, etc)
-    clean_history = []
-    for hist in history:
-        try:
-            if hist.state is not None:
-                if not string_state:
-                    hist.state = float(hist.state)
-                clean_history.append(hist)
-        except (ValueError, TypeError):
-            pass  # drop unknown/unavailable/etc
-            
-
-    binned_history = []
-    current_bin_datetime = start_bin_datetime
-
-    # Build the binned history skeleton with empty states and correct time bins
-    for i in range(bin_qty):
-        binned_history.append(BinnedStateClass(avg_state=None, states=[], time=current_bin_datetime))
-        current_bin_datetime = current_bin_datetime + bin_delta
-    
-    i = 0 # Incrementer for binned_history
-    for state in clean_history:
+    if not string_state:
+        # Remove any invalid states from the history list (Unavailable, None, etc)
+        offsets, states = [], []
+        for hist in history:
+            try:
+                states.append(float(hist.state))
+                offsets.append((hist.time - start_bin_datetime).total_seconds()) # Time delta between start bin time and the state's time
+            except (ValueError, TypeError):
+                pass  # drop unknown/unavailable/etc
+        states = np.array(states, dtype=float)
+        bin_index = (np.array(offsets, dtype=float) // bin_delta.total_seconds()).astype(np.int64)
+        in_range = (bin_index >= 0) & (bin_index < len(times)) & ~np.isnan(states)
+        bin_index, states = bin_index[in_range], states[in_range]
+
+        averages = _bin_averages(
+            np.bincount(bin_index, weights=states, minlength=len(times)),
+            np.bincount(bin_index, minlength=len(times)),
+            interpolation_method,
+        )
+        order = np.argsort(bin_index, kind="stable")
+        states_per_bin = np.split(states[order], np.searchsorted(bin_index[order], np.arange(1, len(times))))
+        return [BinnedStateClass(states=states_per_bin[i].tolist(), avg_state=float(averages[i]), time=times[i]) for i in range(len(times))]
+
+    binned_history = [BinnedStateClass(avg_state=None, states=[], time=bin_time) for bin_time in times]
+    for state in history:
+        if state.state is None:
+            continue
         delta = state.time - start_bin_datetime # Time delta between start bin time and current state time
         bin_index = int(delta.total_seconds() // bin_delta.total_seconds())
-        #print(f"Delta{delta}  idx:{bin_index} binqty:{bin_qty}")
-
-        if 0 <= bin_index < bin_qty:
+        if 0 <= bin_index < len(binned_history):
             binned_history[bin_index].states.append(state.state)
 
-    #for interval in binned_history: # Print for debuging
-    #    print(interval.states)
-
-    if not string_state: # If the state is a string, don't try an average it
-        for interval in binned_history:
-            if(len(interval.states) == 0):
-                interval.avg_state = None
-                #raise Exception(f"Failed to get state data for {interval.time} time period")
-            else:
-                interval.avg_state = round(sum(interval.states) / len(interval.states), 2)
-        
-        # Interpolation
-        values = [b.avg_state for b in binned_history]
-        values = interpolate_values(values, method=interpolation_method)  
-        for i, interval in enumerate(binned_history):
-            interval.avg_state = round(values[i], 2)
-
-    else: # If the state is a string
-        last_known_state = "Unknown"
-        if(binned_history[0].states):
-            last_known_state = binned_history[0].states[-1]
-
-        for bin in binned_history:
-            if(bin.states):
-                bin.avg_state = bin.states[-1]
-                last_known_state = bin.states[-1]
-            else:
-                bin.avg_state = last_known_state # If there is no state update in the binned time, the state mustn't have changed so use the last known value
-
-        #print(f"avg: {interval.state} states: {interval.states}")
-
-    #for i in range(len(avg_day)): # Print average for each day and each time
-    #    print(avg_day[i].state)
-    #    print(avg_day[i].states)       
+    # If the state is a string, don't try an average it
+    last_known_state = "Unknown"
+    if(binned_history[0].states):
+        last_known_state = binned_history[0].states[-1]
+
+    for bin in binned_history:
+        if(bin.states):
+            bin.avg_state = bin.states[-1]
+            last_known_state = bin.states[-1]
+        else:
+            bin.avg_state = last_known_state # If there is no state update in the binned time, the state mustn't have changed so use the last known value
 
     return binned_history
 
-def interpolate_values(values, method="linear"):
-    '''takes a list of numeric values with possible None values to interpolate and interpolates the None values using the specified method. Returns a list of the same length with no None values.'''
-    s = pd.Series(values)
-    # Ensure the series is numeric to avoid "Series cannot interpolate with object dtype" 
-    # which occurs when the list contains only None values or mixed types.
-    s = pd.to_numeric(s, errors='coerce')
+def bin_times(bin_period, start_bin_datetime, end_bin_datetime) -> list[datetime.datetime]:
+    """Start time of each bin from start_bin_datetime to end_bin_datetime."""
+    bin_delta = datetime.timedelta(minutes=bin_period)
+    if end_bin_datetime < start_bin_datetime:
+        raise ValueError(f"end_bin_datetime: '{end_bin_datetime}' must be greater than or equal to start_bin_datetime: '{start_bin_datetime}'")
+    bin_qty = int(((end_bin_datetime - start_bin_datetime).total_seconds()) // bin_delta.total_seconds()) + 1
+    return [start_bin_datetime + i * bin_delta for i in range(bin_qty)]
+
+def bin_edges(times, bin_period) -> np.ndarray:
+    """Epoch seconds of each bin's start plus the last bin's end. The bins are in wall clock time, so they stay aligned to the time of day across DST changes."""
+    return np.array([t.timestamp() for t in times] + [(times[-1] + datetime.timedelta(minutes=bin_period)).timestamp()])
+
+def bin_series(state_times, states, bin_period, start_bin_datetime, end_bin_datetime, interpolation_method="linear", time_weighted=False) -> BinnedSeries:
+    """
+    Bins numeric history arrays (epoch seconds and float states, NaN for unavailable) into the bins
+    from bin_times, averaging the states within each bin. Empty bins are filled by fill_gaps.
+
+    time_weighted=False averages the samples that fall in each bin, as bin_data always has.
+    time_weighted=True treats each state as held until the next one (as HA records them) and
+    averages over the part of each bin the states cover, so a bin with no state change gets the
+    held value rather than being interpolated.
+    """
+    edges = bin_edges(bin_times(bin_period, start_bin_datetime, end_bin_datetime), bin_period)
+    bin_qty = len(edges) - 1
+    state_times = np.asarray(state_times, dtype=float)
+    states = np.asarray(states, dtype=float)
+
+    if time_weighted and len(states):
+        # Integrate the step held states up to every edge, a bin's average is its integral over the time it is covered
+        valid = ~np.isnan(states)
+        held = np.where(valid, states, 0.0)
+        durations = np.diff(state_times)
+        integral = np.concatenate(([0.0], np.cumsum(held[:-1] * durations)))
+        covered = np.concatenate(([0.0], np.cumsum(valid[:-1] * durations)))
+
+        index = np.searchsorted(state_times, edges, side="right") - 1 # The state held at each edge
+        after_first = index >= 0 # Nothing is known before the first state
+        index = np.maximum(index, 0)
+        held_for = np.where(after_first, edges - state_times[index], 0.0)
+        edge_integral = np.where(after_first, integral[index] + held[index] * held_for, 0.0)
+        edge_covered = np.where(after_first, covered[index] + valid[index] * held_for, 0.0)
+
+        sums = np.diff(edge_integral)
+        counts = np.diff(edge_covered)
+    else:
+        valid = ~np.isnan(states) # Drop unknown/unavailable/etc
+        bin_index = np.searchsorted(edges, state_times[valid], side="right") - 1
+        in_range = (bin_index >= 0) & (bin_index < bin_qty)
+        sums = np.bincount(bin_index[in_range], weights=states[valid][in_range], minlength=bin_qty)
+        counts = np.bincount(bin_index[in_range], minlength=bin_qty)
+
+    return BinnedSeries(times=edges[:-1].astype(np.int64), values=_bin_averages(sums, counts, interpolation_method))
+
+def _bin_averages(sums, counts, interpolation_method) -> np.ndarray:
+    """Each bin's average rounded to 2 dp, with the empty bins filled."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = np.where(counts > 0, np.round(sums / counts, 2), np.nan)
+    return np.round(fill_gaps(averages, method=interpolation_method), 2)
+
+def fill_gaps(values, method="linear") -> np.ndarray:
+    '''Fills the NaN values of an array using the specified method, values before the first or after the last known value take that value. All NaN stays NaN.'''
+    values = np.asarray(values, dtype=float)
+    known = ~np.isnan(values)
+    if known.all() or not known.any():
+        return values
+    known_index = np.flatnonzero(known)
 
     if method == "linear":
-        # 5, None, None, None, 6 → 5, 5.25, 5.5, 5.75, 6
-        return (
-            s.interpolate(method="linear")
-            .bfill()
-            .ffill()
-            .tolist()
-        )
+        # 5, NaN, NaN, NaN, 6 → 5, 5.25, 5.5, 5.75, 6
+        return np.interp(np.arange(len(values)), known_index, values[known_index])
 
     elif method == "step":
-        # 5, None, None, None, 6 → 5, 5, 5, 5, 6
-        return (
-            s.ffill()   # forward fill
-            .bfill()   # in case the first values are None
-            .tolist()
-        )
+        # 5, NaN, NaN, NaN, 6 → 5, 5, 5, 5, 6
+        last_known = np.maximum.accumulate(np.where(known, np.arange(len(values)), known_index[0])) # forward fill, leading NaNs take the first value
+        return values[last_known]
 
     else:
         raise ValueError("method must be 'linear' or 'step'")
@@ -39,5 +39,11 @@ class MQTTConnectionError(MPCEnergyError):
 class MQTTAuthenticationError(MPCEnergyError):
     """Base exception for MQTT connection failures."""
 
+class MPCSolveTimeoutError(MPCEnergyError):
+    """Raised when the MPC solve does not finish before its wall-clock deadline."""
+
 class OptionalLoadUnavailableError(MPCEnergyError):
-    """Raised when an optional load's required entity is unavailable or its state is invalid."""
\ No newline at end of file
+    """Raised when an optional load's required entity is unavailable or its state is invalid."""
+
+class MPCWhatIfError(MPCEnergyError):
+    """Raised when a what-if sweep can't be run, ie an unknown parameter override."""
\ No newline at end of file
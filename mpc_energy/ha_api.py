@@ -1,11 +1,17 @@
 import requests
+import numpy as np
+import pandas as pd
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from mpc_logger import logger
 from exceptions import *
 import config_manager
+from ha_ws import HomeAssistantWS, call_once
+import history_store
 
 
 @dataclass
@@ -13,11 +19,34 @@ class History:
     state: float
     time: datetime
 
+@dataclass
+class HistoryArrays:
+    state: np.ndarray   # float64, NaN where the state isn't a number (unavailable, unknown)
+    time: np.ndarray    # int64 epoch seconds
+
+    def __len__(self):
+        return len(self.time)
+
+@dataclass
+class StatisticsArrays:
+    time: np.ndarray    # int64 epoch seconds of the start of each period
+    mean: np.ndarray    # float64, NaN for periods without a value
+    min: np.ndarray
+    max: np.ndarray
+
+    def __len__(self):
+        return len(self.time)
+
 DEFAULT_TZ = ZoneInfo("Australia/Brisbane") 
+STATISTICS_PERIOD_SECONDS = 300 # HA's short-term (5 minute) statistics, kept for the recorder's purge_keep_days
+STATISTICS_MIN_SPAN = timedelta(hours=6) # Shorter histories are read raw, the latest statistics period isn't compiled until it has ended
+HISTORY_CHUNK = timedelta(days=1) # Longer raw histories are fetched as concurrent chunks of this (see fetch_history_arrays)
+HISTORY_CHUNK_WORKERS = 4
 
 class HomeAssistantAPI:
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, subscribe_states=False, tick_snapshots=False, use_statistics=False, store_history=False):
         self.base_url = base_url.rstrip('/')
+        self.token = token
         self.headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
@@ -26,8 +55,25 @@ class HomeAssistantAPI:
         self.session = requests.Session()
         self.session.headers.update(self.headers)
 
+        self.request_count = 0 # HTTP requests made to the HA API
+        self.tick_request_count = 0 # Requests made during the last tick_snapshot block
+
+        # Every entity's state from a single GET /api/states, only while a tick_snapshot block is running
+        self.tick_snapshots = tick_snapshots
+        self.snapshot_enabled = False
+        self.snapshot = None
+
         self.local_tz = self.get_timezone()
         self.ha_went_down_flag = False
+        self.use_statistics = use_statistics # Read long power histories from HA's 5 minute statistics, see get_mean_history
+        self.history_store = history_store.open_store() if store_history else None # See get_stored_history
+
+        # Serve get_state from a websocket subscription instead of a REST request per read, see ha_ws.py
+        self.ws = None
+        if subscribe_states:
+            ws = HomeAssistantWS(base_url, token)
+            if ws.start():
+                self.ws = ws
 
     def get_timezone(self):
         url = f"{self.base_url}/api/config"
@@ -52,6 +98,7 @@ class HomeAssistantAPI:
 
     def check_api_running(self): #Checks to see if we can connect to the ha api
         url = f"{self.base_url}/api/"
+        self.request_count += 1
         try:
             r = self.session.get(url, headers=self.headers, params=None)
             response = r.json()
@@ -69,6 +116,7 @@ class HomeAssistantAPI:
             if(status_code == 401):
                 raise HAAPIAuthenticationError("Unauthorized when connecting to HA API. Please check your token and ensure it has the necessary permissions.") from None
 
+        self.request_count += 1
         try:
             if(method =='get'):
                 r = self.session.get(url, headers=self.headers, params=params)
@@ -115,8 +163,44 @@ class HomeAssistantAPI:
                     
                 return self.ha_request(url, method, data, params)
 
+    @contextmanager
+    def tick_snapshot(self):
+        """
+        Serve get_state from a single GET /api/states for the duration of the block (a control loop
+        iteration or the plant startup checks) instead of a request per entity. The snapshot is only
+        fetched if a read isn't served by the websocket subscription, and an entity is re-read once
+        a service call has changed it.
+        """
+        self.snapshot_enabled = self.tick_snapshots
+        start_count = self.request_count
+        try:
+            yield
+        finally:
+            self.snapshot_enabled = False
+            self.snapshot = None
+            self.tick_request_count = self.request_count - start_count
+            logger.debug(f"HA API requests this tick: {self.tick_request_count}")
+
+    def get_all_states(self) -> dict:
+        """Every entity's state, keyed by entity_id."""
+        url = f"{self.base_url}/api/states"
+        return {state["entity_id"]: state for state in self.ha_request(url=url, method='get')}
+
     def get_state(self, entity_id):
-        url = f"{self.base_url}/api/states/{entity_id}"
+        if self.ws is not None:
+            state = self.ws.get_state(entity_id)
+            if state is not None:
+                return state
+            self.ws.track(entity_id) # Later reads are served from the subscription
+
+        if self.snapshot_enabled:
+            if self.snapshot is None:
+                self.snapshot = self.get_all_states()
+            state = self.snapshot.get(entity_id.lower()) # HA entity ids are lower case, the REST API accepts any case
+            if state is not None:
+                return state
+
+        url = f"{self.base_url}/api/states/{entity_id}" # Outside a tick, or the entity wasn't in the snapshot (raises if it doesn't exist)
         return self.ha_request(url=url, method='get')
     
     def get_numeric_state(self, entity_id):
@@ -155,6 +239,10 @@ class HomeAssistantAPI:
 
     def call_service(self, domain, service, data):
         url = f"{self.base_url}/api/services/{domain}/{service}"
+        if self.snapshot is not None and isinstance(data, dict): # The snapshot's state of the changed entity is now stale
+            entity_ids = data.get("entity_id", [])
+            for entity_id in [entity_ids] if isinstance(entity_ids, str) else entity_ids:
+                self.snapshot.pop(entity_id.lower(), None)
         return self.ha_request(url=url, data=data, method='post')
 
     def send_notification(self, title, message, target, channel=None):
@@ -197,29 +285,116 @@ class HomeAssistantAPI:
             }
         )
     
-    def get_history(self, entity_id, start_time=None, end_time=None, type=float) -> list[History]:
-        """Fetch history for a specific entity.
+    def fetch_history(self, entity_ids, start_time, end_time=None, minimal_response=False, no_attributes=False, significant_changes_only=True, log_missing=True) -> dict[str, list[dict]]:
+        """Fetch the raw history states of a list of entities in a single request, returns {entity_id: states}.
         Home Assistant requires:
-        /api/history/period/<start>?end_time=...&filter_entity_id=...
+        /api/history/period/<start>?end_time=...&filter_entity_id=<id>,<id>,...
+
+        Only the state and its time are read, so callers fetching long histories should pass
+        minimal_response (only the first and last states are full state objects, the rest are
+        just state and last_changed) and no_attributes to cut the payload. significant_changes_only=False
+        also returns attribute only changes for the few domains where HA filters them.
         """
         if not start_time:
             raise ValueError("start_time is required for history endpoint")
 
+        entity_ids = list(dict.fromkeys(entity_ids))
         url = self.base_url+f"/api/history/period/{start_time.isoformat()}"
-        params = {"filter_entity_id": entity_id}
+        params = {"filter_entity_id": ",".join(entity_ids)}
         if end_time:
             params["end_time"] = end_time
+        if minimal_response:
+            params["minimal_response"] = "" # HA checks these two flags for presence, not value
+        if no_attributes:
+            params["no_attributes"] = ""
+        if not significant_changes_only:
+            params["significant_changes_only"] = "0"
 
         response = self.ha_request(url=url, method='get', params=params)
+
+        # One list of states per entity with history, in no particular order. The first state of each carries the entity id.
+        response_states = {}
+        for states in response or []:
+            if states:
+                response_states[states[0]["entity_id"].lower()] = states
+
+        histories = {}
+        for requested_id in entity_ids:
+            states = response_states.get(requested_id.lower())
+            if not states and log_missing:
+                logger.warning(f"No history returned for '{requested_id}' between the times of Start: {start_time} and End: {end_time}. If sensor is new, please wait until history can fill up.")
+            histories[requested_id] = states or []
+        return histories
+
+    def get_history(self, entity_id, start_time=None, end_time=None, type=float, minimal_response=False, no_attributes=False, significant_changes_only=True) -> list[History] | dict[str, list[History]]:
+        """Fetch history for a specific entity, or for a list of entities in a single request (see fetch_history).
+
+        A list of entity ids returns {entity_id: list[History]}, type can then also be a dict
+        of {entity_id: type} (entities not in it default to float).
+        """
+        entity_ids = [entity_id] if isinstance(entity_id, str) else entity_id
+        states = self.fetch_history(entity_ids, start_time, end_time, minimal_response, no_attributes, significant_changes_only)
+        histories = {}
+        for requested_id, requested_states in states.items():
+            state_type = type.get(requested_id, float) if isinstance(type, dict) else type
+            histories[requested_id] = self.parse_history(requested_states, state_type)
+
+        return histories[entity_id] if isinstance(entity_id, str) else histories
+
+    def get_history_arrays(self, entity_id, start_time=None, end_time=None, significant_changes_only=True) -> HistoryArrays | dict[str, HistoryArrays]:
+        """Numeric history as arrays (see parse_history_arrays), for a specific entity or {entity_id: HistoryArrays} for a list.
+        Always requests the minimal response without attributes."""
+        entity_ids = [entity_id] if isinstance(entity_id, str) else entity_id
+        histories = self.fetch_history_arrays(entity_ids, start_time, end_time, significant_changes_only=significant_changes_only)
+        return histories[entity_id] if isinstance(entity_id, str) else histories
+
+    def fetch_history_arrays(self, entity_ids, start_time, end_time=None, significant_changes_only=True) -> dict[str, HistoryArrays]:
+        """{entity_id: HistoryArrays} of a list of entities, fetched with the minimal response without attributes.
+
+        Periods longer than HISTORY_CHUNK are split into chunks fetched concurrently over the session, each
+        parsed into arrays as soon as it arrives, so a long window (ie 7 days of 5 second sensors) holds at most
+        HISTORY_CHUNK_WORKERS chunks of JSON at a time and HA's queries overlap instead of running back to back."""
+        if not start_time:
+            raise ValueError("start_time is required for history endpoint")
+        entity_ids = list(dict.fromkeys(entity_ids))
+        end_time = end_time or datetime.now(self.local_tz)
+        chunks = []
+        chunk_start = start_time
+        while chunk_start < end_time:
+            chunks.append((chunk_start, min(chunk_start + HISTORY_CHUNK, end_time)))
+            chunk_start += HISTORY_CHUNK
+        if len(chunks) <= 1:
+            states = self.fetch_history(entity_ids, start_time, end_time, minimal_response=True, no_attributes=True, significant_changes_only=significant_changes_only)
+            return {requested_id: self.parse_history_arrays(requested_states) for requested_id, requested_states in states.items()}
+
+        def fetch_chunk(chunk):
+            chunk_start, chunk_end = chunk
+            states = self.fetch_history(entity_ids, chunk_start, chunk_end, minimal_response=True, no_attributes=True, significant_changes_only=significant_changes_only, log_missing=False)
+            arrays = {}
+            for requested_id, requested_states in states.items():
+                # HA returns the state held at each chunk's start timed at the start, only the first chunk's is kept (as in one long request)
+                if chunk_start != start_time and requested_states and datetime.fromisoformat(requested_states[0]["last_changed"]) == chunk_start:
+                    requested_states = requested_states[1:]
+                arrays[requested_id] = self.parse_history_arrays(requested_states)
+            return arrays
+
+        with ThreadPoolExecutor(max_workers=HISTORY_CHUNK_WORKERS) as pool:
+            parsed = list(pool.map(fetch_chunk, chunks)) # In chunk (time) order
+
+        histories = {}
+        for requested_id in entity_ids:
+            histories[requested_id] = HistoryArrays(
+                state=np.concatenate([arrays[requested_id].state for arrays in parsed]),
+                time=np.concatenate([arrays[requested_id].time for arrays in parsed]),
+            )
+            if not len(histories[requested_id]):
+                logger.warning(f"No history returned for '{requested_id}' between the times of Start: {start_time} and End: {end_time}. If sensor is new, please wait until history can fill up.")
+        return histories
+
+    def parse_history(self, states, type=float) -> list[History]:
         history = []
-        date_format = "%Y-%m-%dT%H:%M:%S"
-        
-        if not response:
-            logger.warning(f"No history returned for '{entity_id}' between the times of Start: {start_time} and End: {end_time}. If sensor is new, please wait until history can fill up.")
-            return history
-        
-        for i in response[0]:
-            state_time = datetime.fromisoformat(i["last_updated"])
+        for i in states:
+            state_time = datetime.fromisoformat(i.get("last_updated") or i["last_changed"]) # Minimal response states only have last_changed
             state_time = state_time.astimezone(self.local_tz)
             if(type == float):
                 try:
@@ -234,7 +409,186 @@ class HomeAssistantAPI:
                 
             history.append(History(state=state_value, time=state_time))
         return history
+
+    def parse_history_arrays(self, states) -> HistoryArrays:
+        """Decode history states straight into a float64 state array (NaN if not numeric) and an int64 epoch seconds time array."""
+        if not states:
+            return HistoryArrays(state=np.empty(0), time=np.empty(0, dtype=np.int64))
+        times = [i.get("last_updated") or i["last_changed"] for i in states] # Minimal response states only have last_changed
+        utc_times = [t[:-6] for t in times if t.endswith("+00:00")]
+        if len(utc_times) == len(times): # HA returns UTC times, which numpy parses several times faster than pandas
+            epoch_seconds = np.array(utc_times, dtype="datetime64[us]").astype("datetime64[s]").astype(np.int64)
+        else:
+            epoch_seconds = pd.to_datetime(times, utc=True, format="ISO8601").as_unit("s").asi8
+
+        values = [i["state"] for i in states]
+        try:
+            values = np.array(values, dtype=float)
+        except (TypeError, ValueError): # Some states are unavailable/unknown
+            values = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype=float)
+        return HistoryArrays(state=values, time=epoch_seconds)
     
+    def ws_command(self, message):
+        """Result of a websocket API command, sent on the state subscription's connection if it's up."""
+        self.request_count += 1
+        if self.ws is not None and self.ws.connected:
+            return self.ws.call(message)
+        return call_once(self.base_url, self.token, message)
+
+    def get_statistics(self, entity_ids, start_time, end_time=None, period="5minute") -> dict[str, StatisticsArrays]:
+        """HA's long-term statistics (mean, min and max per period) for a list of entities in a single request.
+        Only sensors with a measurement state_class have statistics, the others are returned empty.
+        Values are in the statistic's unit, which is the sensor's unit of measurement."""
+        message = {
+            "type": "recorder/statistics_during_period",
+            "start_time": start_time.isoformat(),
+            "statistic_ids": list(entity_ids),
+            "period": period,
+            "types": ["mean", "min", "max"],
+        }
+        if end_time:
+            message["end_time"] = end_time.isoformat()
+        result = self.ws_command(message) or {}
+        return {entity_id: self.parse_statistics(result.get(entity_id, [])) for entity_id in entity_ids}
+
+    def parse_statistics(self, rows) -> StatisticsArrays:
+        if not rows:
+            empty = np.empty(0)
+            return StatisticsArrays(time=np.empty(0, dtype=np.int64), mean=empty, min=empty, max=empty)
+        starts = [row["start"] for row in rows]
+        if isinstance(starts[0], str): # HA before 2023.3 returned ISO times instead of epoch milliseconds
+            times = pd.to_datetime(starts, utc=True, format="ISO8601").as_unit("s").asi8
+        else:
+            times = (np.array(starts, dtype=float) // 1000).astype(np.int64)
+        columns = {key: np.array([row.get(key) for row in rows], dtype=float) for key in ("mean", "min", "max")} # None -> NaN
+        return StatisticsArrays(time=times, **columns)
+
+    def get_statistics_means(self, entity_ids, start_time, end_time) -> dict[str, HistoryArrays]:
+        """HA's 5 minute means, each timed at the start of its period, of the entities with statistics from start_time
+        (the others, ie sensors without a measurement state_class, are left out)."""
+        try:
+            statistics = self.get_statistics(entity_ids, start_time, end_time)
+        except (HAAPIError, HAAPIAuthenticationError) as e:
+            logger.warning(f"Unable to read HA statistics, reading the raw history. Error: {e}")
+            return {}
+        means = {}
+        for entity_id, stats in statistics.items():
+            if len(stats) and np.isfinite(stats.mean).any() and stats.time[0] <= start_time.timestamp() + STATISTICS_PERIOD_SECONDS:
+                means[entity_id] = HistoryArrays(state=stats.mean, time=stats.time)
+            else:
+                logger.debug(f"No HA statistics for '{entity_id}' from {start_time} (it needs a measurement state_class), reading the raw history.")
+        return means
+
+    def get_mean_history(self, entity_id, start_time, end_time) -> HistoryArrays | dict[str, HistoryArrays]:
+        """Numeric history of power entities over a long period, as HA's pre-aggregated 5 minute means when
+        the sensor has statistics covering the period (one state per 5 minutes, instead of every state change),
+        otherwise the raw history (see get_history_arrays). A list of entity ids returns {entity_id: HistoryArrays}."""
+        entity_ids = [entity_id] if isinstance(entity_id, str) else list(entity_id)
+        histories = {}
+        if self.use_statistics and end_time - start_time >= STATISTICS_MIN_SPAN:
+            for requested_id, means in self.get_statistics_means(entity_ids, start_time, end_time).items():
+                covered = means.time[-1] + STATISTICS_PERIOD_SECONDS - means.time[0]
+                if covered >= (end_time - start_time).total_seconds() - 2 * STATISTICS_PERIOD_SECONDS:
+                    histories[requested_id] = means
+                else:
+                    logger.debug(f"HA statistics for '{requested_id}' only cover {round(covered / 3600, 1)} hours of the requested period, reading the raw history.")
+        raw_ids = [i for i in entity_ids if i not in histories]
+        if raw_ids:
+            histories.update(self.get_history_arrays(raw_ids, start_time=start_time, end_time=end_time))
+        return histories[entity_id] if isinstance(entity_id, str) else histories
+
+    def get_stored_history(self, entity_id, start_time, end_time, string_ids=()) -> HistoryArrays | dict:
+        """Numeric history (see get_history_arrays) read through the local history store (see history_store.py),
+        only the gap since the store's last write for each entity is fetched from HA, as 5 minute statistics
+        when it's long (see get_mean_history) or raw. Complete bins read from the store are their averages timed
+        at the bin start, the fetched gap is as fetched.
+
+        A list of entity ids returns {entity_id: HistoryArrays}. string_ids are fetched raw from start_time
+        (in the same request when it can be) and returned as the raw states (see fetch_history) in the same dict.
+        Falls back to get_mean_history without the store."""
+        entity_ids = [entity_id] if isinstance(entity_id, str) else list(entity_id)
+        string_ids = list(string_ids)
+        if self.history_store is None:
+            histories = self.get_mean_history(entity_ids, start_time, end_time) if entity_ids else {}
+            if string_ids:
+                histories.update(self.fetch_history(string_ids, start_time, end_time, minimal_response=True, no_attributes=True))
+            return histories[entity_id] if isinstance(entity_id, str) else histories
+
+        store = self.history_store
+        start_ts, end_ts = start_time.timestamp(), end_time.timestamp()
+        first_bin = history_store.floor_bin(start_ts)
+        complete_until = history_store.floor_bin(min(end_ts, time.time()) + 0.001) # Bins before this have all their data, an end of 23:59:59.999999 completes the day's last bin
+
+        # Where each entity's fetch starts: the end of the stored period if the request starts inside it, otherwise the request's start
+        fetch_from = {}
+        continued = set() # Entities whose gap continues their stored period
+        for requested_id in entity_ids:
+            covered = store.coverage(requested_id)
+            if covered and covered[0] <= first_bin <= covered[1]:
+                if covered[1] < end_ts:
+                    fetch_from[requested_id] = covered[1]
+                    continued.add(requested_id)
+            else:
+                fetch_from[requested_id] = first_bin
+
+        # Long gaps (the first fill) from HA's statistics, for the entities that have them
+        gap_start = dict(fetch_from)
+        fetched = {}
+        long_ids = [i for i, since in fetch_from.items() if complete_until - since >= STATISTICS_MIN_SPAN.total_seconds()]
+        if self.use_statistics and long_ids:
+            since = min(fetch_from[i] for i in long_ids)
+            means = self.get_statistics_means(long_ids, datetime.fromtimestamp(since, self.local_tz), datetime.fromtimestamp(complete_until, self.local_tz))
+            for requested_id, history in means.items():
+                keep = (history.time >= fetch_from[requested_id]) & (history.time < complete_until)
+                if history.time[0] > fetch_from[requested_id] + STATISTICS_PERIOD_SECONDS or not keep.any():
+                    continue # This entity's statistics start after its gap does
+                history = HistoryArrays(state=history.state[keep], time=history.time[keep])
+                statistics_until = int(history.time[-1]) + STATISTICS_PERIOD_SECONDS
+                store.write(requested_id, history.time, history.state, fetch_from[requested_id], statistics_until)
+                fetched[requested_id] = history
+                fetch_from[requested_id] = statistics_until # The raw history fills in after the last compiled period
+                continued.add(requested_id)
+
+        # The rest raw, in a single request from the earliest gap (or start_time for the string_ids), chunked when it's long
+        raw_from = {i: since for i, since in fetch_from.items() if since < end_ts}
+        raw_states, raw_arrays = {}, {}
+        if raw_from or string_ids:
+            request_start = min(list(raw_from.values()) + ([start_ts] if string_ids else []))
+            request_time = datetime.fromtimestamp(request_start, self.local_tz)
+            if raw_from and end_time - request_time > HISTORY_CHUNK:
+                raw_arrays = self.fetch_history_arrays(list(raw_from), request_time, end_time)
+                if string_ids:
+                    raw_states = self.fetch_history(string_ids, start_time, end_time, minimal_response=True, no_attributes=True)
+            else:
+                raw_states = self.fetch_history(list(raw_from) + string_ids, request_time, end_time, minimal_response=True, no_attributes=True)
+                raw_arrays = {i: self.parse_history_arrays(raw_states[i]) for i in raw_from}
+
+        for requested_id, since in raw_from.items():
+            raw = raw_arrays[requested_id]
+            # HA returns the state held at the request's start timed at the start. It isn't a state change, so a
+            # continued gap is stored without it to bin the same as one long request, and it's only returned at start_time.
+            # Only the first state can be it, a change within the start's second has the same (whole second) time.
+            held = np.zeros(len(raw), dtype=bool)
+            held[:1] = (raw.time[:1] == request_start) & (since == request_start)
+            stored = ~held if requested_id in continued else np.ones(len(raw), dtype=bool)
+            store.write(requested_id, raw.time[stored], raw.state[stored], since, complete_until)
+            keep = (raw.time >= since) & ~(held & (since != first_bin))
+            raw = HistoryArrays(state=raw.state[keep], time=raw.time[keep])
+            previous = fetched.get(requested_id)
+            fetched[requested_id] = raw if previous is None else HistoryArrays(state=np.concatenate((previous.state, raw.state)), time=np.concatenate((previous.time, raw.time)))
+
+        # Stored bins up to where each entity's gap started, then what was fetched
+        histories = {}
+        for requested_id in entity_ids:
+            times, values = store.read(requested_id, first_bin, min(gap_start.get(requested_id, end_ts), end_ts))
+            gap = fetched.get(requested_id)
+            if gap is not None:
+                times, values = np.concatenate((times, gap.time)), np.concatenate((values, gap.state))
+            histories[requested_id] = HistoryArrays(state=values, time=times)
+        for requested_id in string_ids:
+            histories[requested_id] = raw_states[requested_id]
+        return histories[entity_id] if isinstance(entity_id, str) else histories
+
     def set_switch_state(self, entity_id: str, state: bool):
         if(state == True):
             self.call_service("switch", "turn_on", {"entity_id": entity_id})
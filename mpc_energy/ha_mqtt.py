@@ -397,6 +397,45 @@ curtailment_reason_sensor = CreateSensor(
     state_class = None
 )
 
+solver_iterations_sensor = CreateSensor(
+    name = "MPC Solver Iterations",
+    unique_id="mpc_solver_iterations",
+    unit_of_measurement="iterations"
+)
+
+solver_iterations_saved_sensor = CreateSensor(
+    name = "MPC Solver Iterations Saved",
+    unique_id="mpc_solver_iterations_saved",
+    unit_of_measurement="iterations"
+)
+
+solve_timeouts_sensor = CreateSensor(
+    name = "MPC Solve Timeouts",
+    unique_id="mpc_solve_timeouts",
+    unit_of_measurement=None,
+    state_class="total_increasing"
+)
+
+plan_cache_hits_sensor = CreateSensor(
+    name = "MPC Plan Cache Hits",
+    unique_id="mpc_plan_cache_hits",
+    unit_of_measurement=None,
+    state_class="total_increasing"
+)
+
+plan_cache_misses_sensor = CreateSensor(
+    name = "MPC Plan Cache Misses",
+    unique_id="mpc_plan_cache_misses",
+    unit_of_measurement=None,
+    state_class="total_increasing"
+)
+
+ha_api_requests_sensor = CreateSensor(
+    name = "HA API Requests Per Loop",
+    unique_id="mpc_ha_api_requests_per_loop",
+    unit_of_measurement="requests"
+)
+
 control_mode_override_selector = CreateSelectInput(
     name="Control Mode Override",
     unique_id="control_mode_override",
@@ -445,6 +484,12 @@ def initalise_entities(): # Initalise entities and get them discovered by the ha
     control_mode_override_duration_selector.set_state("15")
     curtailment_status_sensor.set_state(0)
     curtailment_reason_sensor.set_state("None")
+    solver_iterations_sensor.set_state(0)
+    solver_iterations_saved_sensor.set_state(0)
+    solve_timeouts_sensor.set_state(0)
+    plan_cache_hits_sensor.set_state(0)
+    plan_cache_misses_sensor.set_state(0)
+    ha_api_requests_sensor.set_state(0)
 
     time.sleep(10)
 
@@ -0,0 +1,249 @@
+"""
+Home Assistant WebSocket state subscription.
+
+Keeps an in-memory copy of the state of every entity MPC Energy reads, kept current by HA's
+subscribe_entities command, so HomeAssistantAPI.get_state can be served locally instead of a
+REST request per entity every control loop.
+
+Entities are subscribed to the first time they are read: that read (and any read while the
+connection is down or before the entity's first update has arrived) goes through REST as
+before. The subscription runs in a background thread and reconnects on its own, the state
+table is cleared while disconnected so a stale value is never served.
+
+Commands that are only available over the websocket API (ie recorder/statistics_during_period)
+are sent with call, or with call_once over a short-lived connection when there's no subscription.
+"""
+import importlib.util
+import itertools
+import json
+import threading
+from datetime import datetime, timezone
+from mpc_logger import logger
+from exceptions import HAAPIError, HAAPIAuthenticationError
+
+RECONNECT_SECONDS = 10
+PING_INTERVAL_SECONDS = 30 # A dead connection is detected within ping interval + timeout
+PING_TIMEOUT_SECONDS = 10
+CALL_TIMEOUT_SECONDS = 30
+
+
+def websocket_url(base_url) -> str:
+    """HA's websocket endpoint for a REST base url, ie http://supervisor/core -> ws://supervisor/core/websocket"""
+    url = "ws" + base_url.rstrip('/')[len("http"):] # http -> ws, https -> wss
+    if url.endswith("/core"): # The supervisor proxy serves it at /core/websocket instead of /core/api/websocket
+        return url + "/websocket"
+    return url + "/api/websocket"
+
+
+def call_once(base_url, token, message, timeout=CALL_TIMEOUT_SECONDS):
+    """Send a single command over a new websocket connection and return its result."""
+    if importlib.util.find_spec("websocket") is None:
+        raise HAAPIError("websocket-client is not installed, unable to call the HA websocket API.")
+    import websocket
+
+    try:
+        connection = websocket.create_connection(websocket_url(base_url), timeout=timeout)
+    except Exception as e:
+        raise HAAPIError(f"Unable to connect to the HA websocket API: {e}") from None
+    try:
+        reply = {}
+        while reply.get("type") != "auth_ok":
+            reply = json.loads(connection.recv())
+            if reply.get("type") == "auth_required":
+                connection.send(json.dumps({"type": "auth", "access_token": token}))
+            elif reply.get("type") == "auth_invalid":
+                raise HAAPIAuthenticationError(f"HA websocket authentication failed: {reply.get('message')}")
+
+        connection.send(json.dumps({**message, "id": 1}))
+        while reply.get("id") != 1 or reply.get("type") != "result":
+            reply = json.loads(connection.recv())
+        return _result(message, reply)
+    except websocket.WebSocketException as e:
+        raise HAAPIError(f"HA websocket command '{message.get('type')}' failed: {e}") from None
+    finally:
+        connection.close()
+
+
+def _result(message, reply):
+    if not reply.get("success"):
+        error = reply.get("error") or {}
+        raise HAAPIError(f"HA websocket command '{message.get('type')}' failed: {error.get('message', error)}")
+    return reply.get("result")
+
+
+def _timestamp(value) -> str:
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+
+class HomeAssistantWS:
+    def __init__(self, base_url, token):
+        self.url = websocket_url(base_url)
+        self.token = token
+        self.app = None
+        self.thread = None
+        self.connected = False # Authenticated, the state table is only used while this is set
+        self.stopped = threading.Event()
+
+        self.lock = threading.Lock()
+        self.states = {}            # entity_id -> state in the REST /api/states format
+        self.entity_ids = set()     # Entities to subscribe to, added by track
+        self.message_ids = itertools.count(1)
+        self.updates = 0            # State messages received, for diagnostics
+        self.calls = {}             # message id -> [threading.Event, reply] of commands waiting for their result
+
+    def start(self) -> bool:
+        """Start the subscription thread, returns False if websocket-client isn't installed."""
+        if importlib.util.find_spec("websocket") is None:
+            logger.warning("websocket-client is not installed, Home Assistant states will be read through the REST API.")
+            return False
+        import websocket
+
+        self.app = websocket.WebSocketApp(
+            self.url,
+            on_message=self.on_message,
+            on_close=self.on_close,
+            on_error=self.on_error,
+        )
+        self.thread = threading.Thread(target=self.run, name="ha-websocket", daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self):
+        # run_forever returns (after on_close) whenever the connection drops, reconnect until stopped
+        while not self.stopped.is_set():
+            self.app.run_forever(ping_interval=PING_INTERVAL_SECONDS, ping_timeout=PING_TIMEOUT_SECONDS)
+            self.set_disconnected()
+            self.stopped.wait(RECONNECT_SECONDS)
+
+    def stop(self):
+        self.stopped.set()
+        if self.app is not None:
+            self.app.close()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.set_disconnected()
+
+    # ---------- Reads ----------
+    def get_state(self, entity_id):
+        """The entity's current state, None if it isn't known (not subscribed yet or disconnected)."""
+        if not self.connected:
+            return None
+        with self.lock:
+            state = self.states.get(entity_id.lower()) # HA entity ids are lower case, the REST API accepts any case
+            return dict(state) if state is not None else None
+
+    def track(self, entity_id):
+        """Subscribe to an entity's state changes, the next reads are served locally once its first state arrives."""
+        entity_id = entity_id.lower()
+        with self.lock:
+            if entity_id in self.entity_ids:
+                return
+            self.entity_ids.add(entity_id)
+        if self.connected:
+            self.subscribe([entity_id])
+
+    def call(self, message, timeout=CALL_TIMEOUT_SECONDS):
+        """Send a command on the subscription's connection and wait for its result."""
+        if not self.connected:
+            raise HAAPIError("The HA websocket isn't connected.")
+        message_id = next(self.message_ids)
+        waiting = [threading.Event(), None]
+        self.calls[message_id] = waiting
+        try:
+            self.send({**message, "id": message_id})
+            if not waiting[0].wait(timeout) or waiting[1] is None: # Timed out, or the connection dropped
+                raise HAAPIError(f"No reply from the HA websocket to '{message.get('type')}' within {timeout} seconds.")
+            return _result(message, waiting[1])
+        finally:
+            self.calls.pop(message_id, None)
+
+    # ---------- Connection ----------
+    def send(self, message):
+        try:
+            self.app.send(json.dumps(message))
+        except Exception as e: # The connection dropped, on_close handles the reconnect
+            logger.debug(f"HA websocket send failed: {e}")
+
+    def subscribe(self, entity_ids):
+        self.send({"id": next(self.message_ids), "type": "subscribe_entities", "entity_ids": sorted(entity_ids)})
+
+    def set_disconnected(self):
+        self.connected = False
+        with self.lock:
+            self.states.clear()
+        for waiting in list(self.calls.values()): # Their replies won't arrive, fail them now rather than at the timeout
+            waiting[0].set()
+
+    def on_close(self, app, status_code, message):
+        if self.connected:
+            logger.warning(f"HA websocket disconnected ({status_code}), reading states through the REST API until it reconnects.")
+        self.set_disconnected()
+
+    def on_error(self, app, error):
+        logger.debug(f"HA websocket error: {error}")
+
+    def on_message(self, app, message):
+        message = json.loads(message)
+        message_type = message.get("type")
+
+        if message_type == "event":
+            self.apply(message["event"])
+        elif message_type == "auth_required":
+            self.message_ids = itertools.count(1) # Ids are per connection
+            self.send({"type": "auth", "access_token": self.token})
+        elif message_type == "auth_ok":
+            self.connected = True
+            logger.info(f"Connected to the HA websocket API, subscribing to {len(self.entity_ids)} entities.")
+            with self.lock:
+                entity_ids = list(self.entity_ids)
+            if entity_ids:
+                self.subscribe(entity_ids)
+        elif message_type == "auth_invalid":
+            logger.error(f"HA websocket authentication failed: {message.get('message')}. Reading states through the REST API.")
+            self.stopped.set() # Don't keep reconnecting with the same token
+            app.close()
+        elif message_type == "result" and message.get("id") in self.calls:
+            waiting = self.calls[message["id"]]
+            waiting[1] = message
+            waiting[0].set()
+        elif message_type == "result" and not message.get("success"):
+            logger.warning(f"HA websocket subscription failed: {message.get('error')}")
+
+    # ---------- State table ----------
+    def apply(self, event):
+        """Apply a subscribe_entities event: "a" adds (full state), "c" changes (diff) and "r" removes entities."""
+        with self.lock:
+            for entity_id, compressed in event.get("a", {}).items():
+                last_changed = _timestamp(compressed["lc"])
+                self.states[entity_id] = {
+                    "entity_id": entity_id,
+                    "state": compressed["s"],
+                    "attributes": compressed.get("a", {}),
+                    "last_changed": last_changed,
+                    "last_updated": _timestamp(compressed["lu"]) if "lu" in compressed else last_changed,
+                }
+
+            for entity_id, diff in event.get("c", {}).items():
+                current = self.states.get(entity_id)
+                if current is None:
+                    continue
+                state = dict(current) # Copied so a reader never sees a half applied change
+                added = diff.get("+", {})
+                if "s" in added:
+                    state["state"] = added["s"]
+                if "a" in added or "a" in diff.get("-", {}):
+                    attributes = dict(state["attributes"])
+                    attributes.update(added.get("a", {}))
+                    for key in diff.get("-", {}).get("a", []):
+                        attributes.pop(key, None)
+                    state["attributes"] = attributes
+                if "lc" in added:
+                    state["last_changed"] = state["last_updated"] = _timestamp(added["lc"])
+                if "lu" in added:
+                    state["last_updated"] = _timestamp(added["lu"])
+                self.states[entity_id] = state
+
+            for entity_id in event.get("r", []):
+                self.states.pop(entity_id, None)
+
+            self.updates += 1
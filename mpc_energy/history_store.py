@@ -0,0 +1,134 @@
+"""
+Local store of 5 minute binned entity history.
+
+Every history consumer (profit, load profile, optional load debiasing and level deltas, the
+Flow Power price projection and the dashboard debuggers) used to re-download its whole period
+from HA each time, mostly overlapping what it (or another consumer) had already downloaded.
+The store keeps each complete 5 minute bin's states per entity (their sum and count, and the
+last state) in SQLite under /data,
+with the period it covers, so HomeAssistantAPI.get_stored_history only fetches the gap since
+the last write (and the current, incomplete bin) from HA.
+
+Bins are aligned to multiples of 5 minutes since the epoch, which are 5 minute boundaries in
+every timezone. The store is shared by MPC Energy and the dashboard processes.
+"""
+import sqlite3
+import threading
+import time
+import numpy as np
+from mpc_logger import logger
+
+STORE_PATH = "/data/mpc_history.sqlite"
+BIN_SECONDS = 300
+RETENTION_DAYS = 15 # The load debugger reads up to 14 days before yesterday
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+def floor_bin(timestamp) -> int:
+    return int(timestamp // BIN_SECONDS) * BIN_SECONDS
+
+
+class HistoryStore:
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.last_prune = 0.0
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL") # The dashboard reads while MPC Energy writes
+        # Per bin: the sum and count of its numeric states and the last state (NULL if it wasn't numeric), the state held after the bin
+        self.db.execute("CREATE TABLE IF NOT EXISTS bins (entity_id TEXT NOT NULL, time INTEGER NOT NULL, sum REAL NOT NULL, count INTEGER NOT NULL, last REAL, PRIMARY KEY (entity_id, time)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS coverage (entity_id TEXT PRIMARY KEY, first INTEGER NOT NULL, until INTEGER NOT NULL)")
+        self.db.commit()
+
+    def coverage(self, entity_id) -> tuple[int, int] | None:
+        """(first, until) epoch seconds of the stored period, every bin from first up to until has been written."""
+        with self.lock:
+            row = self.db.execute("SELECT first, until FROM coverage WHERE entity_id = ?", (entity_id.lower(),)).fetchone()
+        return tuple(row) if row else None
+
+    def read(self, entity_id, start, end) -> tuple[np.ndarray, np.ndarray]:
+        """Start times (int64 epoch seconds) and averages of the stored bins with numeric states starting in [start, end).
+        Reading from inside the stored period, the state held at start is counted in the first bin, as HA's history
+        includes it at the start of a request."""
+        entity_id, start = entity_id.lower(), floor_bin(start)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT time, sum, count FROM bins WHERE entity_id = ? AND time >= ? AND time < ? ORDER BY time",
+                (entity_id, start, int(end)),
+            ).fetchall()
+            held = self.db.execute(
+                "SELECT last FROM bins JOIN coverage USING (entity_id) WHERE entity_id = ? AND time < ? AND time >= first ORDER BY time DESC LIMIT 1",
+                (entity_id, start),
+            ).fetchone()
+        data = np.array(rows, dtype=float).reshape(-1, 3)
+        times, sums, counts = data[:, 0].astype(np.int64), data[:, 1], data[:, 2]
+        if held and held[0] is not None and start < end:
+            if len(times) and times[0] == start:
+                sums[0] += held[0]
+                counts[0] += 1
+            else:
+                times, sums, counts = np.insert(times, 0, start), np.insert(sums, 0, held[0]), np.insert(counts, 0, 1)
+        numeric = counts > 0
+        return times[numeric], sums[numeric] / counts[numeric]
+
+    def write(self, entity_id, times, states, start, until):
+        """Bin and store the states (epoch seconds, NaN if not numeric) of [start, until), and extend the coverage
+        when the period joins onto it."""
+        entity_id = entity_id.lower()
+        start, until = floor_bin(start), floor_bin(until)
+        if until <= start:
+            return
+        times, states = np.asarray(times), np.asarray(states, dtype=float)
+        in_period = (times >= start) & (times < until)
+        times, states = times[in_period], states[in_period]
+        bins, index = np.unique(times // BIN_SECONDS * BIN_SECONDS, return_inverse=True)
+        numeric = ~np.isnan(states)
+        sums = np.bincount(index[numeric], weights=states[numeric], minlength=len(bins))
+        counts = np.bincount(index[numeric], minlength=len(bins))
+        last = states[np.searchsorted(index, np.arange(len(bins)), side="right") - 1] # The states are in time order
+        rows = [(entity_id, int(t), float(s), int(c), None if np.isnan(l) else float(l)) for t, s, c, l in zip(bins, sums, counts, last)]
+        try:
+            self._write(entity_id, rows, start, until)
+        except sqlite3.Error as e: # Not stored, the gap is fetched again next time
+            logger.warning(f"Unable to write '{entity_id}' to the history store. Error: {e}")
+            return
+        self.prune()
+
+    def _write(self, entity_id, rows, start, until):
+        with self.lock:
+            covered = self.db.execute("SELECT first, until FROM coverage WHERE entity_id = ?", (entity_id,)).fetchone()
+            if covered and start <= covered[1] and until >= covered[0]: # Overlaps or joins the stored period
+                first, last = min(start, covered[0]), max(until, covered[1])
+            elif covered and until < covered[0]: # Older than the stored period and not joining it, not stored
+                return
+            else: # Newer and not joining the stored period, it stays contiguous by starting again
+                first, last = start, until
+                self.db.execute("DELETE FROM bins WHERE entity_id = ?", (entity_id,))
+            self.db.execute("DELETE FROM bins WHERE entity_id = ? AND time >= ? AND time < ?", (entity_id, start, until))
+            self.db.executemany("INSERT INTO bins VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?)", (entity_id, first, last))
+            self.db.commit()
+
+    def prune(self):
+        """Drop bins older than the retention, at most once an hour."""
+        now = time.time()
+        if now - self.last_prune < PRUNE_INTERVAL_SECONDS:
+            return
+        self.last_prune = now
+        cutoff = floor_bin(now - RETENTION_DAYS * 86400)
+        with self.lock:
+            removed = self.db.execute("DELETE FROM bins WHERE time < ?", (cutoff,)).rowcount
+            self.db.execute("DELETE FROM coverage WHERE until <= ?", (cutoff,))
+            self.db.execute("UPDATE coverage SET first = ? WHERE first < ?", (cutoff, cutoff))
+            self.db.commit()
+        if removed:
+            logger.debug(f"Pruned {removed} history store bins older than {RETENTION_DAYS} days.")
+
+
+def open_store(path=STORE_PATH) -> HistoryStore | None:
+    """The history store, None if it can't be opened (ie /data isn't writable)."""
+    try:
+        return HistoryStore(path)
+    except sqlite3.Error as e:
+        logger.warning(f"Unable to open the history store at {path}, history will be read from HA. Error: {e}")
+        return None
@@ -0,0 +1,151 @@
+"""
+Online load profile.
+
+BasePlant.get_load_avg used to rebuild the average day from the last days of load history once
+every 24 hours, so the profile lagged by up to a day and every rebuild was a burst of history
+fetching and binning. The online profile is seeded once from that batch average
+(BasePlant.update_load_avg), then each 5 minute time of day slot is updated as it completes
+from the load power read every control loop (see BasePlant.update_online_load_profile).
+
+Each slot is an exponentially weighted average of its daily values, weighted as pandas' ewm
+with a span of the days the batch average is over. The last days' values are kept per slot for
+the scenario quantiles. The state is saved under /data so a restart carries on from it, it is
+seeded again from the history when it's older than those days.
+
+RecentBins keeps the last days of a 5 minute series (ie an optional load's level deltas) the same
+way, so it's only extended with the bins since its last update instead of recomputed.
+"""
+import datetime
+import os
+import time
+import numpy as np
+from mpc_logger import logger
+import data_helpers
+
+STATE_PATH = "/data/mpc_load_profile.npz"
+
+
+def load_state(path) -> dict | None:
+    """Arrays saved by save_state, None if there are none or they can't be read."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as state:
+            return {name: state[name] for name in state.files}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unable to read the saved state at {path}, starting again. Error: {e}")
+        return None
+
+
+def save_state(path, **arrays) -> bool:
+    """Save arrays to path, replacing it in one step so a crash mid write never leaves a partial state. False if it can't be written."""
+    try:
+        temporary_path = path + ".tmp.npz"
+        np.savez(temporary_path, **arrays)
+        os.replace(temporary_path, path)
+        return True
+    except OSError as e: # ie /data isn't writable
+        logger.warning(f"Unable to save the state to {path}, it won't be kept after a restart. Error: {e}")
+        return False
+
+
+class OnlineLoadProfile:
+    def __init__(self, entity_id, days, step_minutes=5, path=STATE_PATH):
+        self.entity_id = entity_id
+        self.days = days
+        self.step_minutes = step_minutes
+        self.path = path
+        self.alpha = 2 / (days + 1)
+        self.slots = 24 * 60 // step_minutes
+
+        self.values = None  # Weighted average per slot, None until seeded
+        self.daily = None   # (days, slots) of the last days' values, row date.toordinal() % days, NaN where not seen
+        self.updated = 0.0  # Epoch seconds of the end of the last slot folded in
+        self.profile = None # DayProfile of the current state, built when it's read
+        self.load()
+
+    def ready(self, now=None) -> bool:
+        """Seeded, and updated within the days its values cover."""
+        now = time.time() if now is None else now
+        return self.values is not None and now - self.updated < self.days * 86400
+
+    def seed(self, profile: data_helpers.DayProfile):
+        """Start again from a batch average day, its daily values (if any) fill the last days."""
+        self.values = np.asarray(profile.values, dtype=float).copy()
+        self.daily = np.full((self.days, self.slots), np.nan)
+        if profile.daily is not None and profile.start is not None:
+            for offset, row in enumerate(profile.daily):
+                self.daily[(profile.start.toordinal() + offset) % self.days] = row
+        self.updated = time.time()
+        self.profile = None
+        logger.info(f"Seeded the online load profile from {len(profile.daily) if profile.daily is not None else 0} days of history.")
+        self.save()
+
+    def update(self, bin_start: datetime.datetime, value):
+        """Fold a completed slot's average power into the profile."""
+        if self.values is None or value is None or np.isnan(value):
+            return
+        slot = (bin_start.hour * 60 + bin_start.minute) // self.step_minutes
+        value = max(float(value), 0.0)
+        self.values[slot] += self.alpha * (value - self.values[slot])
+        self.daily[bin_start.toordinal() % self.days, slot] = value
+        self.updated = bin_start.timestamp() + self.step_minutes * 60
+        self.profile = None
+        self.save()
+
+    def get_profile(self) -> data_helpers.DayProfile:
+        if self.profile is None:
+            self.profile = data_helpers.DayProfile(values=np.round(self.values, 2), step_minutes=self.step_minutes, daily=self.daily.copy())
+        return self.profile
+
+    # ---------- Persistence ----------
+    def load(self):
+        state = load_state(self.path)
+        if state is None:
+            return
+        if str(state.get("entity_id")) != self.entity_id or state.get("daily", np.empty(0)).shape != (self.days, self.slots):
+            logger.info("The saved online load profile is for a different load sensor or period, seeding it again from the history.")
+            return
+        self.values = state["values"]
+        self.daily = state["daily"]
+        self.updated = float(state["updated"])
+
+    def save(self):
+        if self.path and not save_state(self.path, entity_id=self.entity_id, values=self.values, daily=self.daily, updated=self.updated):
+            self.path = None # Carry on in memory
+
+
+class RecentBins:
+    """The values of the last days of 5 minute bins with their time of day slots, in a ring indexed by the
+    bin's number since the epoch so a bin overwrites the one a whole window older. Saved to path with a key
+    (ie the entities the values are from), a saved ring with another key or size isn't used."""
+    def __init__(self, key, days, step_minutes=5, path=None):
+        self.key = key
+        self.days = days
+        self.step_seconds = step_minutes * 60
+        self.path = path
+        size = days * 24 * 60 // step_minutes
+        self.times = np.full(size, -1, dtype=np.int64) # Bin start epoch seconds, -1 if empty
+        self.slots = np.zeros(size, dtype=np.int64)
+        self.values = np.full(size, np.nan)
+        self.until = 0 # Epoch seconds of the end of the last bin written
+
+        state = load_state(path)
+        if state is not None and str(state.get("key")) == key and state.get("times", np.empty(0)).shape == (size,):
+            self.times, self.slots, self.values = state["times"], state["slots"], state["values"]
+            self.until = int(state["until"])
+
+    def write(self, times, slots, values):
+        """Add bins (start epoch seconds, time of day slot and value, NaN if unusable) in time order."""
+        if not len(times):
+            return
+        positions = (np.asarray(times) // self.step_seconds) % len(self.times)
+        self.times[positions], self.slots[positions], self.values[positions] = times, slots, values
+        self.until = max(self.until, int(times[-1]) + self.step_seconds)
+        if self.path and not save_state(self.path, key=self.key, times=self.times, slots=self.slots, values=self.values, until=self.until):
+            self.path = None
+
+    def window(self, end) -> tuple[np.ndarray, np.ndarray]:
+        """Slots and values of the bins in the days before end."""
+        inside = (self.times >= end - self.days * 86400) & (self.times < end)
+        return self.slots[inside], self.values[inside]
@@ -5,6 +5,7 @@ import numpy as np
 from datetime import datetime, timedelta
 from mpc_logger import logger
 import data_helpers
+from solvers.sparse_lp import ROW_EQ, ROW_GE
 
 class EVLoad(OptionalLoad):
     EV_MODE_DISABLED = "Charging Disabled"
@@ -130,13 +131,14 @@ class EVLoad(OptionalLoad):
         return changed
 
     def build_cvxpy(self, mpc):
-        self.ev_charge_48hr_reward = np.zeros(int(mpc.N_5min), dtype=float)
-        self.ev_charge_48hr_reward[:int(mpc.steps_per_hr*48)] = self.reward_cents_per_kwh / 100.0 # Only reward EV charging in the first 48 hrs to avoid charging near the end of the forecast horizon.
+        self.reward_window = mpc.step_start_hours < 48
+        self.ev_charge_48hr_reward = np.where(self.reward_window, self.reward_cents_per_kwh / 100.0, 0.0) # Only reward EV charging in the first 48 hrs to avoid charging near the end of the forecast horizon.
 
-        divisor = max(int(mpc.N_5min) * mpc.dt_5min * (self.capacity_kwh), 1.0)
+        divisor = max(float(np.sum(mpc.dt)) * (self.capacity_kwh), 1.0)
         self.charge_maintain_reward = 0.20 / divisor # The numerator is the total reward we want to provide for maintaining charge over the entire forecast horizon
 
-        n = int(mpc.N_5min)
+        n = int(mpc.N)
+        dt = mpc.dt # Per-step durations (hours), constant for the uniform 5 minute horizon
         self.p_ev = cp.Variable(n, nonneg=True, name=f"{self.name}_p_ev")
         self.ev_soc = cp.Variable(n + 1, name=f"{self.name}_ev_soc")
         self.unachievable_kwh = cp.Variable(n, nonneg=True, name=f"{self.name}_unachievable_kwh")
@@ -156,7 +158,7 @@ class EVLoad(OptionalLoad):
 
         constraints = [
             self.ev_soc[0] == self.soc_init_param,
-            self.ev_soc[1:] == self.ev_soc[:-1] + (mpc.dt_5min * self.p_ev) - (mpc.dt_5min * self.draw_forecast_param),
+            self.ev_soc[1:] == self.ev_soc[:-1] + cp.multiply(dt, self.p_ev) - cp.multiply(dt, self.draw_forecast_param),
             self.ev_soc[1:] >= 0,
             self.ev_soc[1:] <= self.soc_upper_limit_param,
             self.ev_soc[1:] >= self.soc_min_required_param - self.unachievable_kwh, # Allow for some unachievable kWh to ensure feasibility if targets can't be met
@@ -166,13 +168,50 @@ class EVLoad(OptionalLoad):
         ]
 
         objective_term = (
-            - cp.sum(cp.multiply(self.ev_charge_48hr_reward, self.p_ev)) * mpc.dt_5min
-            - cp.sum(cp.multiply(self.charge_maintain_reward, self.ev_soc[0:-1])) * mpc.dt_5min
+            - cp.sum(cp.multiply(self.ev_charge_48hr_reward * dt, self.p_ev))
+            - cp.sum(cp.multiply(self.charge_maintain_reward * dt, self.ev_soc[0:-1]))
             + cp.sum(self.unachievable_kwh) * 10000.0  # Large penalty for missing targets
         )
 
         return constraints, objective_term, self.p_ev
     
+    def build_sparse(self, lp, mpc):
+        n = int(mpc.N)
+        dt = mpc.dt
+
+        lp.add_variable(self.p_ev, upper=0.0)
+        lp.add_variable(self.ev_soc, lower=0.0, upper=0.0) # ev_soc[0] is fixed by a row, so its bounds are opened up each run
+        lp.add_variable(self.unachievable_kwh)
+
+        lp.load_rows[self] = {
+            "init": lp.add_rows(1, [(self.ev_soc, [0], 1.0)], ROW_EQ),
+            "dynamics": lp.add_rows(n, [
+                (self.ev_soc, slice(1, None), 1.0),
+                (self.ev_soc, slice(0, n), -1.0),
+                (self.p_ev, None, -dt),
+            ], ROW_EQ),
+            "min_required": lp.add_rows(n, [(self.ev_soc, slice(1, None), 1.0), (self.unachievable_kwh, None, 1.0)], ROW_GE),
+            "optimal_min": lp.add_rows(n, [(self.ev_soc, slice(1, None), 1.0), (self.unachievable_kwh, None, 1.0)], ROW_GE),
+        }
+        return self.p_ev
+
+    def update_sparse_values(self, lp, mpc):
+        n = int(mpc.N)
+        dt = mpc.dt
+        rows = lp.load_rows[self]
+
+        lp.set_rhs(rows["init"], self.soc_init_param.value)
+        lp.set_rhs(rows["dynamics"], -self.draw_forecast_param.value * dt)
+        lp.set_rhs(rows["min_required"], self.soc_min_required_param.value)
+        lp.set_rhs(rows["optimal_min"], self.soc_optimal_min_param.value)
+        lp.set_bounds(self.ev_soc, lower=-np.inf, upper=np.inf, index=[0])
+        lp.set_bounds(self.ev_soc, lower=0.0, upper=self.soc_upper_limit_param.value, index=slice(1, None))
+        lp.set_bounds(self.p_ev, upper=self.p_max_param.value)
+
+        lp.add_cost(self.p_ev, -self.ev_charge_48hr_reward * dt)
+        lp.add_cost(self.ev_soc, -self.charge_maintain_reward * dt, index=slice(0, n))
+        lp.add_cost(self.unachievable_kwh, 10000.0)
+
     def _normalise_ev_mode(self):
         mode = self.EV_MODE_SOLAR_SMART
         if hasattr(self, "ev_charging_mode_selector"):
@@ -197,7 +236,7 @@ class EVLoad(OptionalLoad):
         mode = self._normalise_ev_mode()
 
         if mode == self.EV_MODE_DISABLED:
-            n = int(mpc.N_5min)
+            n = int(mpc.N)
             self.p_max_param.value = np.zeros(n, dtype=float)
             self.soc_init_param.value = float(self.current_ev_soc_kWh or 0.0)
             self.soc_upper_limit_param.value = max(float((self.max_level_limit / 100.0) * self.capacity_kwh), float(self.current_ev_soc_kWh or 0.0))
@@ -225,7 +264,7 @@ class EVLoad(OptionalLoad):
         # Convert SOC% delta to Power (kW): P = -deltaSOC * Capacity * (60/5) / 100
         soc_delta_forecast = self.forecast_level_delta(time_index)
         draw_forecast = -soc_delta_forecast * self.capacity_kwh * 0.12
-        self.draw_forecast_param.value = draw_forecast
+        self.draw_forecast_param.value = mpc.to_steps(draw_forecast)
         
         logger.debug(f"EVLoad '{self.name}' phantom drain forecast: avg={np.mean(draw_forecast)*1000:.1f}W")
         
@@ -257,12 +296,14 @@ class EVLoad(OptionalLoad):
         if self.optimal_daily_min_soc > 0 and self.optimal_min_kwh > self.current_ev_soc_kWh: 
             ev_soc_optimal_min_arr = self.build_ev_optimal_daily_min_mask(time_index, mpc)
         
-        self.p_max_param.value = p_max_arr
+        # The arrays above are built on the 5 minute grid, aggregate them onto the optimisation steps.
+        # Requirements take the max over each step so they are still met by the end of the step.
+        self.p_max_param.value = mpc.to_steps(p_max_arr)
         self.soc_init_param.value = float(self.current_ev_soc_kWh or 0.0)
         # Ensure upper limit is at least as high as current SOC to prevent solver infeasibility if car is over-charged
         self.soc_upper_limit_param.value = max(float((self.max_level_limit / 100.0) * self.capacity_kwh), float(self.current_ev_soc_kWh or 0.0))
-        self.soc_min_required_param.value = ev_soc_min_required_arr # Set the minimum SOC constraint array based on the selected mode and current SOC
-        self.soc_optimal_min_param.value = ev_soc_optimal_min_arr
+        self.soc_min_required_param.value = mpc.to_steps(ev_soc_min_required_arr, how="max") # Set the minimum SOC constraint array based on the selected mode and current SOC
+        self.soc_optimal_min_param.value = mpc.to_steps(ev_soc_optimal_min_arr, how="max")
         
     def update_data(self) -> None:
         """Collects and updates real-time data from Home Assistant."""
@@ -346,6 +387,13 @@ class EVLoad(OptionalLoad):
 
         return required_mask
 
+    def set_reward(self, reward_cents_per_kwh):
+        super().set_reward(reward_cents_per_kwh)
+        self.ev_charge_48hr_reward = np.where(self.reward_window, self.reward_cents_per_kwh / 100.0, 0.0)
+
+    def initial_state(self) -> list:
+        return [(self.soc_init_param, self.ev_soc)]
+
     def get_results(self, dt):
         p_ev = self.p_ev.value
         soc_ev = self.ev_soc.value
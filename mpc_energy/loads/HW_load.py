@@ -7,6 +7,7 @@ import datetime
 import time
 import data_helpers
 from collections import defaultdict
+from solvers.sparse_lp import ROW_EQ
 class HWLoad(OptionalLoad):
     """
     Specialized load for Hot Water systems.
@@ -79,18 +80,22 @@ class HWLoad(OptionalLoad):
 
         logger.debug(f"Updated HWLoad '{self.name}' data: current_power_kw={self.current_power_kw:.2f}kW, max_charge_power_limit={self.max_charge_power_limit:.2f}kW, is_plugged_in={self.is_plugged_in}, raw_temp={raw_temp:.2f}°C, capacity_kwh={self.capacity_kwh:.2f}kWh, current_level_percent={self.current_level_percent:.2f}%, current_charge_kwh={self.current_charge_kwh:.2f}kWh")
 
-    def get_historical_power(self, start=None, end=None, hours=None, bin_period=5):
+    def read_power(self) -> float:
+        try:
+            return float(self.power_entity_id) # A fixed power entered in the UI is already in kW
+        except (ValueError, TypeError):
+            return super().read_power() * self.power_scale_factor
+
+    def get_historical_power_array(self, start=None, end=None, hours=None, bin_period=5):
         """Retrieve and bin historical power usage for this device, applying scale factor."""
-        binned = super().get_historical_power(start, end, hours, bin_period)
-        if binned and self.power_scale_factor != 1.0:
-            for b in binned:
-                if b.avg_state is not None:
-                    b.avg_state *= self.power_scale_factor
-        return binned
+        power = super().get_historical_power_array(start, end, hours, bin_period)
+        if power is None:
+            return None
+        return power * self.power_scale_factor
 
     def build_cvxpy(self, mpc):
-        n = mpc.N_5min
-        dt = mpc.dt_5min
+        n = int(mpc.N)
+        dt = mpc.dt # Per-step durations (hours), constant for the uniform 5 minute horizon
         mpc_soc = mpc.soc
         mpc_soc_min_param = mpc.soc_min_param
 
@@ -108,28 +113,62 @@ class HWLoad(OptionalLoad):
         self.draw_forecast_param.value = np.zeros(n)
         self.p_max_limit_param = cp.Parameter(nonneg=True, name=f"{self.name}_p_max_limit")
         self.p_max_limit_param.value = 0.0
+        self.shortfall_max_param = cp.Parameter(n, nonneg=True, name=f"{self.name}_shortfall_max") # max(0, draw_forecast), a parameter so the problem stays DPP
+        self.shortfall_max_param.value = np.zeros(n)
 
         constraints = [
             self.hw_energy[0] == self.soc_init_param,
-            self.hw_energy[1:] == self.hw_energy[:-1] + (self.p_hw * dt) - (self.draw_forecast_param * dt) + (self.shortfall * dt),
+            self.hw_energy[1:] == self.hw_energy[:-1] + cp.multiply(dt, self.p_hw) - cp.multiply(dt, self.draw_forecast_param) + cp.multiply(dt, self.shortfall),
             self.hw_energy >= -0.001, # Small epsilon to prevent precision-based infeasibility
             self.hw_energy <= self.capacity_param + 0.001,
             self.p_hw <= self.p_max_limit_param,
             # Allow shortfall to only cover positive draws (usage). Gains (solar) can't have shortfall.
-            self.shortfall <= cp.maximum(0, self.draw_forecast_param)
+            self.shortfall <= self.shortfall_max_param
         ]
         
         # Maintenance reward: Tiny incentive to keep the tank full
         # User reward: Incentivize heating when prices are low or solar is excess
         # Shortfall penalty: High cost ensures shortfall is only used to prevent infeasibility.
-        objective_term = -cp.multiply(self.reward_dollars_per_kwh, self.p_hw) * dt \
-                        +cp.multiply(self.shortfall, 10.0)*dt # High Penalty for shortfall
+        objective_term = -cp.multiply(self.reward_dollars_per_kwh * dt, self.p_hw) \
+                        +cp.multiply(10.0 * dt, self.shortfall) # High Penalty for shortfall
 
         return constraints, objective_term, self.p_hw
 
+    def build_sparse(self, lp, mpc):
+        n = int(mpc.N)
+        dt = mpc.dt
+
+        lp.add_variable(self.p_hw, upper=0.0)
+        lp.add_variable(self.hw_energy, lower=-0.001, upper=0.0)
+        lp.add_variable(self.shortfall, upper=0.0)
+
+        lp.load_rows[self] = {
+            "init": lp.add_rows(1, [(self.hw_energy, [0], 1.0)], ROW_EQ),
+            "dynamics": lp.add_rows(n, [
+                (self.hw_energy, slice(1, None), 1.0),
+                (self.hw_energy, slice(0, n), -1.0),
+                (self.p_hw, None, -dt),
+                (self.shortfall, None, -dt),
+            ], ROW_EQ),
+        }
+        return self.p_hw
+
+    def update_sparse_values(self, lp, mpc):
+        dt = mpc.dt
+        draw_forecast = self.draw_forecast_param.value
+        rows = lp.load_rows[self]
+
+        lp.set_rhs(rows["init"], self.soc_init_param.value)
+        lp.set_rhs(rows["dynamics"], -draw_forecast * dt)
+        lp.set_bounds(self.hw_energy, upper=self.capacity_param.value + 0.001)
+        lp.set_bounds(self.p_hw, upper=self.p_max_limit_param.value)
+        lp.set_bounds(self.shortfall, upper=self.shortfall_max_param.value)
+
+        lp.add_cost(self.p_hw, -self.reward_dollars_per_kwh * dt)
+        lp.add_cost(self.shortfall, 10.0 * dt)
+
     def update_mpc_values(self, mpc, time_index):
         self.update_data()
-        n = mpc.N_5min
         
         self.soc_init_param.value = float(self.current_charge_kwh)
         self.capacity_param.value = float(self.capacity_kwh)
@@ -144,7 +183,15 @@ class HWLoad(OptionalLoad):
         # Sign is flipped because hot_water_delta_forecast is + for heating, but draw_forecast is + for cooling.
         draw_forecast = -hot_water_delta_forecast * (self.volume_l * 4.186) / 300.0
         
-        self.draw_forecast_param.value = draw_forecast
+        self.draw_forecast_param.value = mpc.to_steps(draw_forecast)
+        self.shortfall_max_param.value = np.maximum(0, self.draw_forecast_param.value)
+
+    def set_reward(self, reward_cents_per_kwh):
+        super().set_reward(reward_cents_per_kwh)
+        self.reward_dollars_per_kwh = self.reward_cents_per_kwh / 100.0
+
+    def initial_state(self) -> list:
+        return [(self.soc_init_param, self.hw_energy)]
 
     def get_results(self, dt):
         p_hw = self.p_hw.value
@@ -4,11 +4,13 @@ from typing import Any
 import cvxpy as cp
 import numpy as np
 from mpc_logger import logger
+from exceptions import HAAPIError
 from ha_api import HomeAssistantAPI
 import data_helpers
+from load_profile import RecentBins
 import datetime
 import time
-from collections import defaultdict
+import re
 
 DEFAULT_PATH = "/data/optional_loads.json"
 LOAD_CLASSES = {}
@@ -89,10 +91,15 @@ class OptionalLoad:
         self.ha_mqtt = None
         self.local_tz = None
         
+        # Average power over the last 5 minutes, added to every control loop by the plant (see BasePlant.record_recent_values)
+        self.recent_power = data_helpers.RollingAverage(300)
+        self.power_bins = data_helpers.BinAverages(300) # Each bin's power, to debias the online load profile
+
         # Profile Cache
         self.avg_delta_profile = None
         self.last_profile_update_timestamp = 0
         self.last_profile_days_ago = 0
+        self.level_deltas: RecentBins | None = None # The last days' level deltas, extended with the bins since its last update
 
     @classmethod
     def from_dict(cls, item: dict[str, Any]) -> Any:
@@ -112,35 +119,66 @@ class OptionalLoad:
         return False
 
     # --- MPC Interface Stubs ---
+    def read_power(self) -> float:
+        """The current power of the load in kW."""
+        return self.ha.get_numeric_state(self.power_entity_id)
+
+    def record_recent_power(self):
+        if not self.power_entity_id: return
+        try:
+            power = self.read_power()
+            self.recent_power.add(power)
+            self.power_bins.add(power)
+        except HAAPIError as e:
+            logger.debug(f"Unable to read the power of optional load {self.name}: {e}")
+
+    def get_recent_power(self) -> float | None:
+        """Average power over the last 5 minutes, falling back to the history if it hasn't been recorded yet."""
+        average = self.recent_power.average()
+        if average is not None:
+            return average
+        history = self.get_historical_power(hours=0.25)
+        return history[-1].avg_state if history else None
+
     def get_historical_power(self, start=None, end=None, hours=None, bin_period=5):
+        if hours is not None and (start is None or end is None):
+            start, end = data_helpers.get_time_range_from_hours(hours, self.local_tz)
+
+        power = self.get_historical_power_array(start, end, bin_period=bin_period)
+        if power is None: return None
+        return [data_helpers.BinnedStateClass(states=[], avg_state=float(value), time=bin_time) for bin_time, value in zip(data_helpers.bin_times(bin_period, start, end), power)]
+
+    def get_historical_power_array(self, start=None, end=None, hours=None, bin_period=5) -> np.ndarray | None:
+        """Binned power history (bins from data_helpers.bin_times), None if there isn't enough of it."""
         if not self.power_entity_id: return None
         
         if hours is not None and (start is None or end is None):
             start, end = data_helpers.get_time_range_from_hours(hours, self.local_tz)
 
-        history = self.ha.get_history(self.power_entity_id, start_time=start, end_time=end)
-        #logger.debug(f"Raw history for opt load '{self.name}' (entity '{self.power_entity_id}') from {start} to {end}: {history}")
-        if not history: return None
+        history = self.ha.get_stored_history(self.power_entity_id, start_time=start, end_time=end)
+        if not len(history): return None
         
         requested_seconds = max((end - start).total_seconds(), 1.0)
         if len(history) == 1:
             # If there's only one point and it covers the start of our window, it spans the whole duration
-            data_span_seconds = requested_seconds if history[0].time <= start + datetime.timedelta(minutes=5) else 0.0
+            data_span_seconds = requested_seconds if history.time[0] <= (start + datetime.timedelta(minutes=5)).timestamp() else 0.0
         else:
-            data_span_seconds = max((history[-1].time - history[0].time).total_seconds(), 0.0)
+            data_span_seconds = max(float(history.time[-1] - history.time[0]), 0.0)
         coverage = data_span_seconds / requested_seconds
         
         if coverage < 0.5:
             logger.warning(f"Insufficient history coverage ({round(coverage*100)}%) for optional load {self.name} with power entity '{self.power_entity_id}'. Skipping debias.")
             return None
             
-        binned = data_helpers.bin_data(history, bin_period, start, end, interpolation_method="step")
-        return binned
+        return data_helpers.bin_series(history.time, history.state, bin_period, start, end, interpolation_method="step").values
 
-    def get_level_delta_avg(self, days_ago=3, hours_update_interval=24):
+    def get_level_delta_avg(self, days_ago=3, hours_update_interval=1) -> data_helpers.DayProfile | None:
         """
         Calculates the average rate of change (loss/degradation) for the level entity 
         when the device is NOT consuming power.
+
+        The deltas of the last days are kept (and saved under /data, see load_profile.RecentBins), so an update
+        only bins the history since the last one.
         """
         now_ts = time.time()
         if (self.avg_delta_profile is not None and
@@ -156,37 +194,26 @@ class OptionalLoad:
         if not self.level_entity_id:
             return None
 
-        # Get history for both level (SOC/Temp) and Power
-        h_level = self.ha.get_history(self.level_entity_id, start_time=start, end_time=rounded_now)
-        b_level = data_helpers.bin_data(h_level, bin_period, start, rounded_now)
-        
-        # Optional: Get power history to filter out charging periods
-        b_power = []
-        if self.power_entity_id:
-            h_power = self.ha.get_history(self.power_entity_id, start_time=start, end_time=rounded_now)
-            b_power = data_helpers.bin_data(h_power, bin_period, start, rounded_now)
-
-        if not b_level or len(b_level) < 2:
-            return None
-
-        history_by_tod = defaultdict(list)
-        for i in range(1, len(b_level)):
-            l1, l2 = b_level[i-1].avg_state, b_level[i].avg_state
-            
-            # Only look at deltas where level is known and power is negligible (not charging)
-            is_charging = False
-            if i < len(b_power) and b_power[i].avg_state is not None:
-                is_charging = b_power[i].avg_state > 0.05
-
-            if l1 is not None and l2 is not None and not is_charging:
-                delta = l2 - l1
-                history_by_tod[b_level[i].time.time()].append(delta)
-
-        if not history_by_tod: return None
-
-        # Calculate raw averages and apply cyclic smoothing
-        all_tods = [(datetime.datetime.min + datetime.timedelta(minutes=j*5)).time() for j in range(288)]
-        deltas = np.array([np.mean(history_by_tod[t]) if t in history_by_tod else np.nan for t in all_tods])
+        key = f"{self.level_entity_id},{self.power_entity_id or ''}"
+        if self.level_deltas is None or self.level_deltas.key != key or self.level_deltas.days != days_ago:
+            name = re.sub(r"[^a-z0-9]+", "_", self.name.lower()).strip("_")
+            self.level_deltas = RecentBins(key, days_ago, bin_period, path=f"/data/mpc_level_deltas_{name}_{days_ago}d.npz")
+
+        # Only the bins since the last update, from the bin before it for its delta
+        if self.level_deltas.until:
+            start = max(start, datetime.datetime.fromtimestamp(self.level_deltas.until - bin_period * 60, self.local_tz))
+        if start < rounded_now - datetime.timedelta(minutes=bin_period):
+            self.update_level_deltas(start, rounded_now, bin_period)
+
+        slots, deltas = self.level_deltas.window(rounded_now.timestamp())
+        usable = ~np.isnan(deltas)
+        if not usable.any(): return None
+
+        # Calculate raw averages per time of day and apply cyclic smoothing
+        sums = np.bincount(slots[usable], weights=deltas[usable], minlength=288)
+        counts = np.bincount(slots[usable], minlength=288)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            deltas = np.where(counts > 0, sums / counts, np.nan)
         
         if np.isnan(deltas).all():
             deltas = np.zeros(288)
@@ -202,19 +229,48 @@ class OptionalLoad:
         # Constrain to negative only (losses) to ignore phantom gains from sensor noise/balancing
         smoothed = np.minimum(smoothed, 0.0)
 
-        self.avg_delta_profile = {all_tods[j]: smoothed[j] for j in range(288)}
+        self.avg_delta_profile = data_helpers.DayProfile(values=smoothed, step_minutes=bin_period)
         self.last_profile_update_timestamp = now_ts
         self.last_profile_days_ago = days_ago
         return self.avg_delta_profile
 
+    def update_level_deltas(self, start, end, bin_period):
+        """Bin the level (and power) history between start and end and add each bin's change since the one before to level_deltas."""
+        # Get history for both level (SOC/Temp) and Power, in a single request
+        entity_ids = [self.level_entity_id] + ([self.power_entity_id] if self.power_entity_id else [])
+        histories = self.ha.get_stored_history(entity_ids, start_time=start, end_time=end)
+        level_history = histories[self.level_entity_id]
+        b_level = data_helpers.bin_series(level_history.time, level_history.state, bin_period, start, end)
+
+        if len(b_level) < 2:
+            return
+
+        # Only look at deltas where level is known and power is negligible (not charging)
+        deltas = np.diff(b_level.values)
+        usable = ~np.isnan(deltas)
+        if self.power_entity_id: # Optional: Use the power history to filter out charging periods
+            power_history = histories[self.power_entity_id]
+            b_power = data_helpers.bin_series(power_history.time, power_history.state, bin_period, start, end).values
+            usable &= ~(b_power[1:] > 0.05)
+
+        # Each delta is timed at the later bin. Bins after the last level sample only hold its value until the next
+        # one arrives (which spreads the change back over them), so they and the current (incomplete) bin are left
+        # for the next update, which starts from the last written bin
+        sampled = level_history.time[~np.isnan(level_history.state)]
+        if not len(sampled):
+            return
+        last_sampled_bin = sampled[-1] // (bin_period * 60) * (bin_period * 60)
+        complete = (b_level.times[1:] < end.timestamp()) & (b_level.times[1:] <= last_sampled_bin)
+        slots = np.array([(t.hour * 60 + t.minute) // bin_period for t in data_helpers.bin_times(bin_period, start, end)[1:len(b_level)]])
+        self.level_deltas.write(b_level.times[1:][complete], slots[complete], np.where(usable, deltas, np.nan)[complete])
+
     def forecast_level_delta(self, time_index) -> np.ndarray:
         """Predicts the rate of level change based on time of day profile."""
         avg_delta = self.get_level_delta_avg()
-        if not avg_delta:
+        if avg_delta is None or not len(time_index):
             # Default to zero or tiny negative loss if no history
             return np.full(len(time_index), -0.001 if self.load_type == "hot_water" else 0.0)
-        global_avg = sum(avg_delta.values()) / len(avg_delta)
-        return np.array([avg_delta.get(t.time(), global_avg) for t in time_index])
+        return avg_delta.values[avg_delta.slots(time_index[0], len(time_index))]
 
     def build_cvxpy(self, n, dt, mpc_soc, mpc_soc_min_param):
         """Define CVXPY variables, constraints and rewards."""
@@ -224,6 +280,22 @@ class OptionalLoad:
         """Update CVXPY parameters based on latest forecasts/state."""
         raise NotImplementedError("Must implement update_mpc_values in subclass")
 
+    def build_sparse(self, lp, mpc):
+        """Add this load's columns and rows to the sparse LP backend, returning the load power variable."""
+        raise NotImplementedError("Must implement build_sparse in subclass")
+
+    def update_sparse_values(self, lp, mpc):
+        """Write this load's bounds, right-hand sides and costs into the sparse LP backend."""
+        raise NotImplementedError("Must implement update_sparse_values in subclass")
+
+    def set_reward(self, reward_cents_per_kwh):
+        """Change the reward without rebuilding the optimisation. Only the sparse backend picks it up (see MPC.what_if)."""
+        self.reward_cents_per_kwh = reward_cents_per_kwh
+
+    def initial_state(self) -> list:
+        """(initial state parameter, state variable) pairs, used by the plan cache to compare measurements against the plan."""
+        return []
+
     def get_results(self, dt):
         """Extract results from the solver."""
         raise NotImplementedError("Must implement get_results in subclass")
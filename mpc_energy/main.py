@@ -207,6 +207,10 @@ while(started == False):
         ha = HomeAssistantAPI(
             base_url=const.HA_API_URL,
             token=const.HA_TOKEN,
+            subscribe_states=config_manager.ha_websocket_states,
+            tick_snapshots=config_manager.ha_tick_snapshots,
+            use_statistics=config_manager.ha_load_statistics,
+            store_history=config_manager.ha_history_store,
         )
 
         opt_loads = loads.optional_loads.load_optional_load_instances(ha, ha.local_tz, ha_mqtt)
@@ -235,7 +239,8 @@ while(started == False):
             )
             demand_tariff = flow.demand_tarrif
         
-        plant = GetPlant(ha, opt_loads)
+        with ha.tick_snapshot(): # The plant's startup entity checks read ~20 entities
+            plant = GetPlant(ha, opt_loads)
 
         if(ha_mqtt.automatic_control_switch.state == True):
             plant.self_consumption() # Start in self consumption mode for safety until the main loop runs to set the correct mode based on the selected controller
@@ -295,6 +300,13 @@ def update_sensors(price_data):
     set_sensor_if_changed(ha_mqtt.net_profit_sensor, round(plant.daily_net_profit, 2))
     set_sensor_if_changed(ha_mqtt.profit_remaining_today_sensor, round(mpc.profit_remaining_today, 2))
     set_sensor_if_changed(ha_mqtt.profit_tomorrow_sensor, round(mpc.profit_tomorrow, 2))
+    set_sensor_if_changed(ha_mqtt.solver_iterations_sensor, mpc.solver_iterations)
+    set_sensor_if_changed(ha_mqtt.solver_iterations_saved_sensor, mpc.solver_iterations_saved)
+    set_sensor_if_changed(ha_mqtt.solve_timeouts_sensor, mpc.solve_timeouts)
+    set_sensor_if_changed(ha_mqtt.ha_api_requests_sensor, ha.tick_request_count) # Requests made during the previous loop
+    if mpc.plan_cache is not None:
+        set_sensor_if_changed(ha_mqtt.plan_cache_hits_sensor, mpc.plan_cache.hits)
+        set_sensor_if_changed(ha_mqtt.plan_cache_misses_sensor, mpc.plan_cache.misses)
     
     # Note: Target EV charge rate sensor logic should be moved to iterate over all opt_loads in mpc.py
 
@@ -526,7 +538,12 @@ while True:
                 logger.warning(f"Streamlit dashboard process exited with code {streamlit_proc.poll()}. Restarting...")
                 streamlit_proc = start_streamlit_dashboard()
 
-            main_loop_code()
+            with ha.tick_snapshot():
+                main_loop_code()
+
+        # Run what-if sweeps requested from the dashboard, unless a price update is about to be due
+        if(seconds_till_price_update > 20):
+            mpc.process_what_if_requests()
         
         if(time.time() - int(last_alive_time_timestamp) >= 1):
             last_alive_time_timestamp = time.time()
@@ -0,0 +1,129 @@
+"""
+Plan cache for the MPC.
+
+The controller re-runs the optimisation on every price update, whenever an optional load's
+settings change and when a manual override ends. Often the inputs are effectively identical
+to the last solve, so the previous plan (shifted forward by the elapsed time) is reused
+instead of solving again.
+
+Parameters are quantised before comparing. Initial states (battery/load SOC) are compared
+against the cached plan's prediction for the current time rather than the previous
+measurement, so a plan that is being tracked closely is still reused.
+"""
+import hashlib
+import numpy as np
+from mpc_logger import logger
+
+
+class PlanCache:
+    PARAM_QUANTUM = 0.005       # Parameters are quantised to this step before comparing (kW, kWh and $/kWh)
+    STATE_TOLERANCE_KWH = 0.1   # Allowed difference between a measured initial state and the cached plan's prediction
+
+    def __init__(self, max_age_minutes=15):
+        self.max_age_minutes = max_age_minutes
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self.start_time = None
+        self.fingerprint = None
+        self.params = None
+        self.values = None
+
+    @classmethod
+    def quantise(cls, value):
+        return np.round(np.atleast_1d(np.asarray(value, dtype=float)) / cls.PARAM_QUANTUM).astype(np.int64)
+
+    @classmethod
+    def make_fingerprint(cls, params, initial_state_ids):
+        """Hash of every quantised parameter, excluding initial states which are checked against the plan."""
+        digest = hashlib.sha1()
+        for param in sorted(params, key=lambda p: p.id):
+            if param.id in initial_state_ids:
+                continue
+            digest.update(param.name().encode())
+            digest.update(cls.quantise(param.value).tobytes())
+        return digest.hexdigest()
+
+    def store(self, mpc, start_time):
+        """Record the inputs and solution of a successful solve."""
+        initial_state_ids = {param.id for param, _ in mpc.initial_state_pairs()}
+        params = mpc.prob.parameters()
+        self.start_time = start_time
+        self.fingerprint = self.make_fingerprint(params, initial_state_ids)
+        self.params = {param.id: self.quantise(param.value) for param in params}
+        self.values = {var.id: np.array(var.value, dtype=float) for var in mpc.prob.variables()}
+
+    def restore(self, mpc, start_time) -> bool:
+        """
+        If the current parameter values match the cached solve, write the cached plan (shifted to
+        start_time) into the MPC's variables and return True. Otherwise count a miss and return False.
+        """
+        reason = self._mismatch(mpc, start_time)
+        if reason is not None:
+            self.misses += 1
+            logger.debug(f"Plan cache miss ({reason}). Hits: {self.hits}, misses: {self.misses}.")
+            return False
+
+        elapsed_slots = self._elapsed_slots(start_time)
+        step_gather, state_gather = mpc.shift_gather(elapsed_slots)
+        for var in mpc.prob.variables():
+            var.value = var.project(self._gather(self.values[var.id], mpc.N, step_gather, state_gather))
+        for param, var in mpc.initial_state_pairs():
+            if var.value is not None:
+                value = np.array(var.value)
+                value[0] = param.value # Start the shifted plan from the measured state
+                var.value = var.project(value)
+
+        self.hits += 1
+        logger.debug(f"Plan cache hit, reusing the plan solved {elapsed_slots * 5} minutes ago. Hits: {self.hits}, misses: {self.misses}.")
+        return True
+
+    def _elapsed_slots(self, start_time):
+        return int(round((start_time - self.start_time).total_seconds() / 300))
+
+    def _mismatch(self, mpc, start_time):
+        """Return why the cached plan can't be reused, or None if it can."""
+        if self.fingerprint is None:
+            return "empty"
+
+        elapsed_slots = self._elapsed_slots(start_time)
+        if elapsed_slots < 0 or elapsed_slots * 5 > self.max_age_minutes:
+            return f"cached plan is {elapsed_slots * 5} minutes old"
+
+        params = mpc.prob.parameters()
+        initial_states = mpc.initial_state_pairs()
+        initial_state_ids = {param.id for param, _ in initial_states}
+        step_gather, state_gather = mpc.shift_gather(elapsed_slots)
+
+        for param, var in initial_states:
+            predicted = self.values[var.id][state_gather[0]]
+            if abs(float(param.value) - float(predicted)) > self.STATE_TOLERANCE_KWH:
+                return f"{param.name()} is {float(param.value):.2f} but the cached plan predicted {float(predicted):.2f}"
+
+        if elapsed_slots == 0:
+            if self.make_fingerprint(params, initial_state_ids) != self.fingerprint:
+                return "inputs changed"
+            return None
+
+        # Only compare steps that were fully inside the cached horizon, the tail has no cached inputs to compare against
+        valid_steps = mpc.step_offsets + mpc.step_sizes + elapsed_slots <= int(mpc.N_5min)
+        valid_states = np.concatenate(([True], valid_steps))
+        for param in params:
+            if param.id in initial_state_ids:
+                continue
+            current = self.quantise(param.value)
+            cached = self._gather(self.params[param.id], mpc.N, step_gather, state_gather)
+            mask = valid_steps if current.size == mpc.N else valid_states if current.size == mpc.N + 1 else slice(None)
+            if not np.array_equal(current[mask], cached[mask]):
+                return f"{param.name()} changed"
+        return None
+
+    @staticmethod
+    def _gather(values, n_steps, step_gather, state_gather):
+        if values.ndim == 1 and values.size == n_steps:
+            return values[step_gather]
+        if values.ndim == 1 and values.size == n_steps + 1:
+            return values[state_gather]
+        return values
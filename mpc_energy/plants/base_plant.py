@@ -5,14 +5,14 @@ import time
 import numpy as np
 import pandas as pd
 import math
-from collections import defaultdict
 from typing import Any
 import config_manager
 from mpc_logger import logger
 from exceptions import HAAPIError, SigenergyConnectionError, PlantControlError
-from ha_api import HomeAssistantAPI
+from ha_api import HomeAssistantAPI, HistoryArrays
 from loads.optional_loads import OptionalLoad
 import data_helpers
+from load_profile import OnlineLoadProfile
 
 
 class BasePlant(ABC):
@@ -36,8 +36,15 @@ class BasePlant(ABC):
 
         self.last_load_data_retrival_timestamp = 0
         self.avg_load_day = None
+        self.online_load_profile: OnlineLoadProfile | None = None # Created by get_load_avg when enabled
+        self.solcast_forecasts = {} # entity_id -> (last_updated, period start epoch seconds, {estimate: kW}), see get_solcast_forecast
 
         self.history_since_midnight = None
+
+        # Averages of the load and solar power read by update_data, for the current values the MPC starts from
+        self.recent_load_power = data_helpers.RollingAverage(self.time_step_minutes * 60)
+        self.recent_solar_power = data_helpers.RollingAverage(self.time_step_minutes * 60)
+        self.load_power_bins = data_helpers.BinAverages(self.time_step_minutes * 60) # Each bin's load, for the online load profile
         
         self.working_mode = None
 
@@ -177,6 +184,39 @@ class BasePlant(ABC):
             logger.warning(f"Unable to read optional config value '{entry_id}', defaulting to {default_value}.")
             return float(default_value)
         
+    def record_recent_values(self) -> None:
+        """Add the power values just read by update_data to the rolling averages, and the debiased optional loads' power to theirs."""
+        self.recent_load_power.add(self.load_power)
+        self.load_power_bins.add(self.load_power)
+        self.recent_solar_power.add(self.solar_kw)
+        for load in self.optional_loads or []:
+            if load.debias_load:
+                load.record_recent_power()
+        self.update_online_load_profile()
+
+    def update_online_load_profile(self) -> None:
+        """Fold each completed 5 minutes of load (debiased by the optional loads) into the online load profile, once each.
+        Bins that were only partly recorded (ie just after a restart) are skipped."""
+        online = self.online_load_profile
+        if online is None or online.values is None:
+            return
+        for bin_start, load in self.load_power_bins.pop_completed():
+            for optional_load in self.optional_loads or []:
+                if optional_load.debias_load:
+                    load -= optional_load.power_bins.pop(bin_start) or 0.0
+            if bin_start + self.time_step_minutes * 60 > online.updated:
+                online.update(datetime.datetime.fromtimestamp(bin_start, self.local_tz), load)
+
+    def recent_history(self, hours=0.25) -> dict:
+        """The last hours of today's binned history (see get_profit_history), without a history request of its own."""
+        history = self.get_profit_history()
+        rounded_now = data_helpers.round_minutes(time=datetime.datetime.now(self.local_tz), nearest_minute=self.time_step_minutes)
+        cutoff = rounded_now - datetime.timedelta(hours=hours)
+        start = len(history["time_index"])
+        while start > 0 and datetime.datetime.fromisoformat(history["time_index"][start - 1]) >= cutoff:
+            start -= 1
+        return {key: values[start:] for key, values in history.items()}
+
     def get_profit_history(self) -> list[data_helpers.BinnedStateClass]:
         """Get the history required for the profit calcs and use cached data if its not too old to avoid the expensive historical data retrieval and processing if possible."""
         now = datetime.datetime.now(self.local_tz)
@@ -259,21 +299,18 @@ class BasePlant(ABC):
         self.daily_import_cost = np.sum(cost_per_bin)
         self.daily_net_profit = self.daily_export_profit - self.daily_import_cost
     
-    def validate_returned_data_timedelta(self, data: list[data_helpers.BinnedStateClass], requested_start: datetime.datetime, requested_end: datetime.datetime, tollerance_minutes: float = 30) -> bool:
+    def validate_returned_data_timedelta(self, data: HistoryArrays, requested_start: datetime.datetime, requested_end: datetime.datetime, tollerance_minutes: float = 30) -> bool:
         '''
-        data -> array containing datetime objs (data[i].time) for each datapoint
+        data -> history arrays (data.time in epoch seconds)
         returns True if the requested amount of data was returned.
         '''
-        if(not data):
+        if(not len(data)):
             logger.error(f"No data returned from the api for the requested times: Start: {requested_start}, End: {requested_end}")
             return False
         else:
-            first_time = data[0].time
-            last_time = data[-1].time
-
             # Determine if less data time span was returned than requested
             expected_span = requested_end - requested_start
-            actual_span = last_time - first_time 
+            actual_span = datetime.timedelta(seconds=int(data.time[-1] - data.time[0]))
 
             # If 30 mintues less data than expected was returned, use the estimated load energy configured.
             if actual_span < expected_span - datetime.timedelta(minutes=tollerance_minutes):
@@ -286,7 +323,21 @@ class BasePlant(ABC):
                 return False
         return True
 
-    def update_load_avg(self, days_ago=7) -> list[data_helpers.BinnedStateClass]:
+    def get_histories(self, entity_ids: dict, start_time, end_time, string_keys=()) -> dict:
+        """Fetch the history of each {key: entity_id} through the history store (see HomeAssistantAPI.get_stored_history).
+        Numeric histories are returned as HistoryArrays, keys in string_keys as lists of History with string states."""
+        numeric_ids = [entity_id for key, entity_id in entity_ids.items() if key not in string_keys]
+        string_ids = [entity_id for key, entity_id in entity_ids.items() if key in string_keys]
+        histories = self.ha.get_stored_history(numeric_ids, start_time, end_time, string_ids=string_ids) # Only the gap since the history store's last write is fetched
+        history = {}
+        for key, entity_id in entity_ids.items():
+            if key in string_keys:
+                history[key] = self.ha.parse_history(histories[entity_id], str)
+            else:
+                history[key] = HistoryArrays(state=histories[entity_id].state.copy(), time=histories[entity_id].time) # Copied per key, so a sensor used for two keys never shares arrays
+        return history
+
+    def update_load_avg(self, days_ago=7) -> data_helpers.DayProfile:
         '''Calculate the average load power profile for a day based on the past load history.'''
 
         # Determine the start and end datetimes for the requested history based on the number of days ago to look back from
@@ -297,14 +348,8 @@ class BasePlant(ABC):
         start = datetime.datetime.combine(start_date, datetime.time.min, tzinfo=self.local_tz)
         end = datetime.datetime.combine(end_date, datetime.time.max, tzinfo=self.local_tz)
 
-        load_power_history = self.ha.get_history(self.load_power_entity_id, start_time=start, end_time=end)
-        # Apply scaling to the raw history data before binning
-        if self.power_scale_factor != 1.0:
-            for state in load_power_history:
-                try:
-                    state.state = float(state.state) * self.power_scale_factor
-                except:
-                    pass
+        load_power_history = self.ha.get_stored_history(self.load_power_entity_id, start_time=start, end_time=end) # Days of history, only the days since the last update are fetched from HA
+        load_power_history.state = load_power_history.state * self.power_scale_factor # Apply scaling to the raw history data before binning
 
         def get_default_avg_day():
             configured_avg_load = float(config_manager.estimated_daily_load_energy_consumption)
@@ -313,87 +358,45 @@ class BasePlant(ABC):
             # Create a constant load power based on the daily average energy
             # Power (kW) = Energy (kWh) / 24 hours
             constant_load_kw = round(configured_avg_load / 24.0, 2)
-            avg_day = []
-            for i in range(int(24 * 60 / self.time_step_minutes)):
-                t = (datetime.datetime.min + datetime.timedelta(minutes=i * self.time_step_minutes)).time()
-                avg_day.append(data_helpers.BinnedStateClass(avg_state=constant_load_kw, states=[], time=t))
-            return avg_day
+            return data_helpers.DayProfile(values=np.full(int(24 * 60 / self.time_step_minutes), constant_load_kw), step_minutes=self.time_step_minutes)
 
         # Check to see if the requested amount of data was recieved, use the configured default if not
         if(not self.validate_returned_data_timedelta(data=load_power_history, requested_start=start, requested_end=end)):
             return get_default_avg_day()
         
 
-        # Bin whole history first
-        binned_load_history = data_helpers.bin_data(load_power_history, self.time_step_minutes, start, end)
+        # Bin whole history first, the bins line up with whole days from start
+        bin_times = data_helpers.bin_times(self.time_step_minutes, start, end)
+        binned_load_history = data_helpers.bin_series(load_power_history.time, load_power_history.state, self.time_step_minutes, start, end).values
         
         # Debias using optional loads if provided
         if self.optional_loads:
             for load in self.optional_loads:
                 if load.debias_load:
-                    opt_history = load.get_historical_power(start=start, end=end, bin_period=self.time_step_minutes)
-                    if opt_history:
+                    opt_history = load.get_historical_power_array(start=start, end=end, bin_period=self.time_step_minutes)
+                    if opt_history is not None:
                         logger.debug(f"Debiasing load history using optional load: {load.name}")
-                        for i in range(min(len(binned_load_history), len(opt_history))):
-                            opt_val = opt_history[i].avg_state or 0.0
-                            binned_load_history[i].avg_state = max(binned_load_history[i].avg_state - opt_val, 0.0)
+                        count = min(len(binned_load_history), len(opt_history))
+                        binned_load_history[:count] = np.maximum(binned_load_history[:count] - np.nan_to_num(opt_history[:count]), 0.0)
 
         # Split binned history into days
-        history_by_day = defaultdict(list)
-        for b in binned_load_history:
-            try:
-                history_by_day[b.time.date()].append(b)
-            except AttributeError:
-                pass # Handle cases where bin might not have a date
-        
-        # --- Bin history data by day--- 
-        per_day_binned = []
         expected_bins_per_day = int(24 * 60 / self.time_step_minutes)
-        for day, day_data in history_by_day.items():
-            try:
-                # Only include days that have at least the expected number of bins
-                # This avoids partial days (like a single midnight bin) causing index errors.
-                if len(day_data) >= expected_bins_per_day:
-                    per_day_binned.append(day_data[:expected_bins_per_day])
-                else:
-                    logger.debug(f"Day {day} has {len(day_data)} bins, expected {expected_bins_per_day}. Data: {day_data}")
-                    logger.warning(f"Skipping day {day} for average load calculation due to insufficient data bins: expected {expected_bins_per_day}, got {len(day_data)}.")
-            except Exception as e:
-                logger.warning(f"Skipping day {day} due to binning error: {e}")
-
-        if not per_day_binned:
+        days = len(binned_load_history) // expected_bins_per_day
+        if days == 0:
             logger.warning("No valid daily data found after binning load history.")
             return get_default_avg_day()
-        
+        if len(binned_load_history) % expected_bins_per_day:
+            logger.warning(f"Skipping {len(binned_load_history) % expected_bins_per_day} bins of load history that don't make up a full day.")
+        per_day_binned = binned_load_history[:days * expected_bins_per_day].reshape(days, expected_bins_per_day)
 
         # --- Build average day ---
-        num_bins = len(per_day_binned[0])
-        avg_day = []
-
-        for i in range(num_bins):
-            states = []
-
-            for day_bins in per_day_binned:
-                val = day_bins[i].avg_state
-                if val is not None and not math.isnan(val):
-                    states.append(val)
-
-            if states:
-                avg_val = round(sum(states) / len(states), 2)
-                avg_val = max(avg_val, 0.0) # Ensure no negative values
-
-            else:
-                raise PlantControlError(f"No valid data for time bin {per_day_binned[0][i].time.time()} across all days.")
+        valid = ~np.isnan(per_day_binned)
+        if not valid.any(axis=0).all():
+            empty_bin = int(np.argmin(valid.any(axis=0)))
+            raise PlantControlError(f"No valid data for time bin {bin_times[empty_bin].time()} across all days.")
+        avg_values = np.maximum(np.round(np.nanmean(per_day_binned, axis=0), 2), 0.0) # Ensure no negative values
 
-            avg_day.append(
-                data_helpers.BinnedStateClass(
-                    avg_state=avg_val,
-                    states=states,
-                    time=per_day_binned[0][i].time.time()
-                )
-            )
-        
-        return avg_day
+        return data_helpers.DayProfile(values=avg_values, step_minutes=self.time_step_minutes, daily=per_day_binned, start=start_date)
 
     def round_forecast_times(self, forecast_hours_from_now=None, forecast_till_time=None, forecast_start_time=None, forecast_end_time=None):
         if forecast_start_time is not None and forecast_end_time is not None:
@@ -414,16 +417,24 @@ class BasePlant(ABC):
         
         return [rounded_current_time, rounded_forecast_time]
     
-    def get_load_avg(self, days_ago, hours_update_interval=24) -> list[data_helpers.BinnedStateClass]:
-        """Return the average load profile for a day based on the load history. Uses cached value if the last retrieval was within the update interval."""
+    def get_load_avg(self, days_ago, hours_update_interval=24) -> data_helpers.DayProfile:
+        """Return the average load profile for a day based on the load history. Uses cached value if the last retrieval was within the update interval.
+        With the online load profile (see load_profile.py) the history only seeds it, it is then kept current every 5 minutes by record_recent_values."""
+        if config_manager.online_load_profile:
+            if self.online_load_profile is None or self.online_load_profile.days != days_ago + 1:
+                self.online_load_profile = OnlineLoadProfile(self.load_power_entity_id, days=days_ago + 1, step_minutes=self.time_step_minutes) # update_load_avg's days, from days_ago before yesterday
+            if not self.online_load_profile.ready():
+                self.online_load_profile.seed(self.update_load_avg(days_ago))
+            return self.online_load_profile.get_profile()
 
         if(time.time() - self.last_load_data_retrival_timestamp > hours_update_interval*60*60 or self.avg_load_day == None):
             self.avg_load_day = self.update_load_avg(days_ago)
             self.last_load_data_retrival_timestamp = time.time()
         return self.avg_load_day
     
-    def forecast_load_power(self, forecast_hours_from_now=None, forecast_till_time=None, forecast_start_time=None, forecast_end_time=None) -> list[data_helpers.BinnedStateClass]:
-        avg_day = self.get_load_avg(days_ago=self.load_avg_days)
+    def forecast_load_power(self, forecast_hours_from_now=None, forecast_till_time=None, forecast_start_time=None, forecast_end_time=None, quantile=None) -> np.ndarray:
+        """Forecast load power (kW per time step) from the average day. If quantile (0-1) is given, each bin uses that quantile of its daily history instead of the average."""
+        profile = self.get_load_avg(days_ago=self.load_avg_days)
 
         # Determine the current and the end of the forecast datetimes, both rounded to 5 min
         [rounded_current_time, rounded_forecast_time] = self.round_forecast_times(
@@ -432,65 +443,22 @@ class BasePlant(ABC):
             forecast_start_time=forecast_start_time,
             forecast_end_time=forecast_end_time,
         )
-
-        # Create a lookup dict for each time bin: time-of-day → kWh per bin
-        avg_day_kw_lookup = {bin.time: bin.avg_state for bin in avg_day}
-
-        forecast_power = []
         forecast_steps = int((rounded_forecast_time - rounded_current_time).total_seconds() // (self.time_step_minutes * 60))
 
-        avg_kw_per_bin = sum(b.avg_state for b in avg_day) / len(avg_day) # Used below to fallback if no data for specific bin
-
-        for i in range(forecast_steps):
-            point_time = rounded_current_time + datetime.timedelta(minutes=self.time_step_minutes * i)
+        values = profile.values if quantile is None else profile.quantile(quantile)
+        forecast_power = values[profile.slots(rounded_current_time, forecast_steps)]
 
-            # Get kW for this time-of-day bin
-            power = avg_day_kw_lookup.get(point_time.time())
-
-            # Fallback if missing
-            if power is None or math.isnan(power) or power <= 0:
-                power = avg_kw_per_bin
-
-            forecast_power.append(
-                data_helpers.BinnedStateClass(
-                    avg_state=power,
-                    states=[],
-                    time=point_time
-                )
-            )
-
-        return forecast_power
+        # Fallback to the average bin if there's no data for a specific bin
+        return np.where(np.isnan(forecast_power) | (forecast_power <= 0), np.nanmean(profile.values), forecast_power)
             
     def forecast_consumption_amount(self, forecast_hours_from_now=None, forecast_till_time=None, ) -> float:
-        avg_day = self.get_load_avg(days_ago=self.load_avg_days)
+        """Forecast kWh from now, read from the average day's energy index (see DayProfile.energy)."""
+        profile = self.get_load_avg(days_ago=self.load_avg_days)
 
         [rounded_current_time, rounded_forecast_time] = self.round_forecast_times(forecast_hours_from_now, forecast_till_time)
+        forecast_steps = int((rounded_forecast_time - rounded_current_time).total_seconds() // (self.time_step_minutes * 60))
 
-        # Lookup: time-of-day → kW per bin
-        avg_day_kw_lookup = {bin.time: bin.avg_state for bin in avg_day}
-
-        step_minutes = self.time_step_minutes
-        forecast_steps = int(
-            (rounded_forecast_time - rounded_current_time).total_seconds()
-            // (step_minutes * 60)
-        )
-            
-        total_kwh = 0.0
-
-        avg_kw_per_bin = sum(b.avg_state for b in avg_day) / len(avg_day) # Used below to fallback if no data for specific bin
-
-        for i in range(forecast_steps):
-            point_time = rounded_current_time + datetime.timedelta(minutes=step_minutes * i)
-
-            kw = avg_day_kw_lookup.get(point_time.time())
-
-            # Fallback if missing
-            if kw is None or math.isnan(kw):
-                kw = avg_kw_per_bin
-
-            total_kwh += kw * (step_minutes / 60)  # Convert kW to kWh for the time step
-
-        return total_kwh
+        return profile.energy(rounded_current_time, forecast_steps)
     
     def kwh_required_remaining(self) -> float:
         """Returns the forecasted kWh required from now until sunrise tomorrow (6am) based on the average load profile."""
@@ -504,6 +472,10 @@ class BasePlant(ABC):
             
     def forecast_solar_power(self, forecast_hours_from_now, forecast_start_time=None, forecast_end_time=None) -> list[float]:
         """Returns the forecast solar power for the requested time period in 5 minute increments. If start and end times are provided, they will be used to determine the forecast horizon, otherwise the forecast_hours_from_now will be used."""
+        return self.forecast_solar_estimates(forecast_hours_from_now, forecast_start_time, forecast_end_time, estimates=("pv_estimate",))["pv_estimate"]
+
+    def forecast_solar_estimates(self, forecast_hours_from_now, forecast_start_time=None, forecast_end_time=None, estimates=("pv_estimate10", "pv_estimate", "pv_estimate90")) -> dict[str, list[float]]:
+        """Like forecast_solar_power, but for each of the requested Solcast estimate columns (ie the 10th/90th percentile estimates). Missing columns fall back to pv_estimate."""
         if forecast_start_time is not None and forecast_end_time is not None:
             rounded_start_time = data_helpers.round_minutes(forecast_start_time, nearest_minute=self.time_step_minutes)
             rounded_end_time = data_helpers.round_minutes(forecast_end_time, nearest_minute=self.time_step_minutes)
@@ -517,55 +489,60 @@ class BasePlant(ABC):
         N_30min = max(0, int(np.ceil(N_5min / (30 // self.time_step_minutes))))
         interpolation_steps = 30 // self.time_step_minutes
 
-        # Solar Forecast
-        # Get solar forecast list from HA
-        today = self.ha.get_state(config_manager.solcast_forecast_today_entity_id)["attributes"]["detailedForecast"]
-        tomorrow = self.ha.get_state(config_manager.solcast_forecast_tomorrow_entity_id)["attributes"]["detailedForecast"]
-
-        forecast = today + tomorrow # Combine
-
+        # Solar Forecast, the 30 minute periods of each Solcast day entity needed
+        entity_ids = [config_manager.solcast_forecast_today_entity_id, config_manager.solcast_forecast_tomorrow_entity_id]
         if(forecast_hours > 24):
-            day_3_forecast = self.ha.get_state(config_manager.solcast_forecast_day_3_entity_id)["attributes"]["detailedForecast"]
-            forecast = forecast + day_3_forecast # Add day 3's forecast to the list if requesting more than 24 hrs of forecast
-        
+            entity_ids.append(config_manager.solcast_forecast_day_3_entity_id) # Add day 3's forecast if requesting more than 24 hrs of forecast
         if(forecast_hours > 48):
-            day_4_forecast = self.ha.get_state(config_manager.solcast_forecast_day_4_entity_id)["attributes"]["detailedForecast"]
-            forecast = forecast + day_4_forecast # Add day 4's forecast to the list if requesting more than 48 hrs of forecast
-        
-        df = pd.DataFrame(forecast) # Convert to DataFrame for easy time handling
-        
-        df["period_start"] = pd.to_datetime(df["period_start"]) # Parse timestamps (Solcast provides timezone-aware ISO strings)
+            entity_ids.append(config_manager.solcast_forecast_day_4_entity_id) # Add day 4's forecast if requesting more than 48 hrs of forecast
+        forecasts = [self.get_solcast_forecast(entity_id) for entity_id in entity_ids]
+        period_starts = np.concatenate([times for times, _ in forecasts])
+        order = np.argsort(period_starts, kind="stable")
 
-        # Current time in same timezone
+        # Current time, rounded to the time step
         if forecast_start_time is not None:
-            now = pd.Timestamp(data_helpers.round_minutes(forecast_start_time, nearest_minute=self.time_step_minutes))
-            if df["period_start"].dt.tz is not None and now.tzinfo is None:
-                now = now.tz_localize(df["period_start"].dt.tz)
-            elif df["period_start"].dt.tz is not None and now.tzinfo is not None:
-                now = now.tz_convert(df["period_start"].dt.tz)
+            now = data_helpers.round_minutes(forecast_start_time, nearest_minute=self.time_step_minutes).timestamp()
         else:
-            now = pd.Timestamp.now(tz=df["period_start"].dt.tz)
-            now = now.ceil(f"{self.time_step_minutes}min") #round to nearest time step
+            step_seconds = self.time_step_minutes * 60
+            now = math.ceil(time.time() / step_seconds) * step_seconds
 
         # Keep only future (or current) periods
-        df_future = (
-            df[df["period_start"] >= now]
-            .sort_values("period_start")
-            .iloc[:N_30min]
-        )
+        first = int(np.searchsorted(period_starts[order], now, side="left"))
+        future = order[first:first + N_30min]
 
-        # Solar forecast (kW)
-        solar_30min = df_future["pv_estimate"].to_numpy()
-        solar_30min = solar_30min[:N_30min]
-
-        if len(solar_30min) == 0:
+        if len(future) == 0:
             logger.warning("Solcast returned no future 30 minute forecast intervals. Falling back to zero solar forecast.")
-            return np.zeros(N_5min)
+            return {estimate: np.zeros(N_5min) for estimate in estimates}
 
-        if len(solar_30min) < N_30min:
-            logger.warning(f"Solcast forecast shorter than requested horizon. Requested 30 min bins={N_30min}, received={len(solar_30min)}. Extending with last known value.")
+        if len(future) < N_30min:
+            logger.warning(f"Solcast forecast shorter than requested horizon. Requested 30 min bins={N_30min}, received={len(future)}. Extending with last known value.")
 
-        solar_30min_x = np.arange(0, len(solar_30min) * interpolation_steps, interpolation_steps)
-        solar_5min = np.interp(np.arange(N_5min), solar_30min_x, solar_30min)
-        
-        return solar_5min[:N_5min] # return the solar forecast but limit the list length to the requested length
+        solar_30min_x = np.arange(0, len(future) * interpolation_steps, interpolation_steps)
+        solar_5min = {}
+        for estimate in estimates:
+            if not all(estimate in columns for times, columns in forecasts if len(times)):
+                logger.warning(f"Solcast forecast has no '{estimate}' values, using 'pv_estimate' instead.")
+                estimate_column = "pv_estimate"
+            else:
+                estimate_column = estimate
+
+            # Solar forecast (kW)
+            solar_30min = np.concatenate([columns.get(estimate_column, np.full(len(times), np.nan)) for times, columns in forecasts])[future]
+            solar_5min[estimate] = np.interp(np.arange(N_5min), solar_30min_x, solar_30min)[:N_5min] # Limit the list length to the requested length
+
+        return solar_5min
+
+    def get_solcast_forecast(self, entity_id) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """A Solcast day entity's detailedForecast as period start epoch seconds and a kW array per estimate column.
+        Solcast only updates a few times a day, so it's only parsed again when the entity's last_updated moves (last_changed
+        doesn't move when only the forecast attributes change)."""
+        state = self.ha.get_state(entity_id)
+        cached = self.solcast_forecasts.get(entity_id)
+        if cached is not None and cached[0] == state.get("last_updated"):
+            return cached[1], cached[2]
+
+        forecast = state["attributes"]["detailedForecast"]
+        times = pd.to_datetime([period["period_start"] for period in forecast], utc=True, format="ISO8601").as_unit("s").asi8 if forecast else np.empty(0, dtype=np.int64)
+        columns = {column: np.array([period.get(column, np.nan) for period in forecast], dtype=float) for column in (forecast[0] if forecast else {}) if column != "period_start"}
+        self.solcast_forecasts[entity_id] = (state.get("last_updated"), times, columns)
+        return times, columns
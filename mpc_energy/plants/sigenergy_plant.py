@@ -109,9 +109,10 @@ class SigEnergyPlant(BasePlant):
         self.inverter_power = self.get_safe_power_state(self.inverter_power_entity_id)
         self.grid_power = self.get_safe_power_state(self.grid_power_entity_id)
         self.load_power = self.get_safe_power_state(self.load_power_entity_id)
-        self.avg_daily_load = sum(bin.avg_state*(self.time_step_minutes/60) for bin in self.get_load_avg(days_ago=self.load_avg_days))
+        self.avg_daily_load = self.get_load_avg(days_ago=self.load_avg_days).day_energy()
         
 
+        self.record_recent_values()
         self.calculate_today_profit_cost()
         
         self.hours_till_full = 0
@@ -315,96 +316,64 @@ class SigEnergyPlant(BasePlant):
         requested_hours = (end_datetime - start_datetime).total_seconds() / 3600
         logger.debug(f"Requesting historical data from {start_datetime.isoformat()} to {end_datetime.isoformat()} ({round(requested_hours, 2)} hours)")
 
-        battery_soc_state_history = self.ha.get_history(self.battery_soc_entity_id, start_time=start_datetime, end_time=end_datetime)
-        battery_power_state_history = self.ha.get_history(self.battery_power_entity_id, start_time=start_datetime, end_time=end_datetime)
-        for state in battery_power_state_history:
-            try:
-                val = float(state.state) * self.power_scale_factor
-                if(self.battery_power_sign_convention == "+ Charge, - Discharge"):
-                    val = -val
-                state.state = val
-            except:
-                pass
+        # Every sensor is fetched in a single history request
+        entity_ids = {
+            "battery_soc": self.battery_soc_entity_id,
+            "battery_power": self.battery_power_entity_id,
+            "inverter_power": self.inverter_power_entity_id,
+            "solar_power": self.solar_power_entity_id,
+            "load_power": self.load_power_entity_id,
+            "grid_power": self.grid_power_entity_id,
+            "grid_import_kwh": self.plant_daily_import_kwh_entity_id,
+            "grid_export_kwh": self.plant_daily_export_kwh_entity_id,
+            "feed_in_price": "sensor.mpc_energy_manager_device_feed_in_price",
+            "general_price": "sensor.mpc_energy_manager_device_general_price",
+            "working_mode": "sensor.mpc_energy_manager_device_working_mode",
+        }
+        history = self.get_histories(entity_ids, start_datetime, end_datetime, string_keys=("working_mode",))
+
+        # Scaling and sign conventions are applied to the whole history at once
+        battery_power = history["battery_power"].state * self.power_scale_factor
+        if(self.battery_power_sign_convention == "+ Charge, - Discharge"):
+            battery_power = -battery_power
+        history["battery_power"].state = battery_power
         # Internal battery power convention ^^^^^^^:
         #   +kW = discharging (battery supplying power)
         #   -kW = charging (battery absorbing power)
 
-        inverter_power_state_history = self.ha.get_history(self.inverter_power_entity_id, start_time=start_datetime, end_time=end_datetime)
-        for state in inverter_power_state_history:
-            try:
-                state.state = float(state.state) * self.power_scale_factor
-            except:
-                pass
+        for key in ("inverter_power", "solar_power", "load_power"):
+            history[key].state = history[key].state * self.power_scale_factor
 
-        solar_power_state_history = self.ha.get_history(self.solar_power_entity_id, start_time=start_datetime, end_time=end_datetime)
-        for state in solar_power_state_history:
-            try:
-                state.state = float(state.state) * self.power_scale_factor
-            except:
-                pass
-
-        load_power_state_history = self.ha.get_history(self.load_power_entity_id, start_time=start_datetime, end_time=end_datetime)
-        for state in load_power_state_history:
-            try:
-                state.state = float(state.state) * self.power_scale_factor
-            except:
-                pass
-
-        grid_power_state_history = self.ha.get_history(self.grid_power_entity_id, start_time=start_datetime, end_time=end_datetime)
-        for state in grid_power_state_history:
-            try:
-                val = float(state.state) * self.power_scale_factor
-                if(self.grid_power_sign_convention == "- Import, + Export"):
-                    val = -val
-                state.state = val
-            except:
-                pass
+        grid_power = history["grid_power"].state * self.power_scale_factor
+        if(self.grid_power_sign_convention == "- Import, + Export"):
+            grid_power = -grid_power
+        history["grid_power"].state = grid_power
 
-        grid_import_kwh_state_history = self.ha.get_history(self.plant_daily_import_kwh_entity_id, start_time=start_datetime, end_time=end_datetime)
-        grid_export_kwh_state_history = self.ha.get_history(self.plant_daily_export_kwh_entity_id, start_time=start_datetime, end_time=end_datetime)
+        def bin_history(key, interpolation_method="linear"):
+            return data_helpers.bin_series(history[key].time, history[key].state, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime, interpolation_method=interpolation_method).values
 
-        feed_in_state_history = self.ha.get_history("sensor.mpc_energy_manager_device_feed_in_price", start_time=start_datetime, end_time=end_datetime) 
-        general_price_state_history = self.ha.get_history("sensor.mpc_energy_manager_device_general_price", start_time=start_datetime, end_time=end_datetime)
-        working_mode_state_history = self.ha.get_history("sensor.mpc_energy_manager_device_working_mode", start_time=start_datetime, end_time=end_datetime, type=str)
+        binned = {key: bin_history(key) for key in ("battery_soc", "battery_power", "inverter_power", "solar_power", "load_power", "grid_power", "grid_import_kwh", "grid_export_kwh")}
+        binned["feed_in_price"] = bin_history("feed_in_price", interpolation_method="step") # Step Interpolation as prices dont gradually change
+        binned["general_price"] = bin_history("general_price", interpolation_method="step")
+        binned_working_mode_state_history = data_helpers.bin_data(history["working_mode"], bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime, string_state=True)
 
-        #requested_data_received = self.validate_returned_data_timedelta(inverter_power_state_history, start_datetime, end_datetime)
-
-
-        binned_battery_soc_state_history = data_helpers.bin_data(battery_soc_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-        binned_battery_power_state_history = data_helpers.bin_data(battery_power_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-        binned_inverter_power_state_history = data_helpers.bin_data(inverter_power_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-        binned_load_power_state_history = data_helpers.bin_data(load_power_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-        
-        binned_solar_power_state_history = data_helpers.bin_data(solar_power_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-        binned_grid_power_state_history = data_helpers.bin_data(grid_power_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-
-        binned_grid_import_kwh_state_history = data_helpers.bin_data(grid_import_kwh_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-        binned_grid_export_kwh_state_history = data_helpers.bin_data(grid_export_kwh_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime)
-
-        
-        binned_feed_in_state_history = data_helpers.bin_data(feed_in_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime, interpolation_method="step")
-        binned_general_price_state_history = data_helpers.bin_data(general_price_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime, interpolation_method="step")# Step Interpolation as prices dont gradually change
-        binned_working_mode_state_history = data_helpers.bin_data(working_mode_state_history, bin_period=bin_period, start_bin_datetime=start_datetime, end_bin_datetime=end_datetime, string_state=True)
-
-        binned_battery_soc_kwh_history = [(item.avg_state / 100.0) * self.rated_capacity for item in binned_battery_soc_state_history]
-        
-        history_time_index = [item.time.isoformat() for item in binned_battery_soc_state_history] # Get the time marks from the data
+        history_time_index = [bin_time.isoformat() for bin_time in data_helpers.bin_times(bin_period, start_datetime, end_datetime)]
 
         logger.debug(f"Received data bins span from {history_time_index[0]} to {history_time_index[-1]} ({len(history_time_index)} bins), request took {round(time.time()-start_timestamp,2)} seconds to retrieve and process.")
 
         output = {
             "time_index": history_time_index,
-            "soc": binned_battery_soc_kwh_history,
-            "battery_power": [state.avg_state for state in binned_battery_power_state_history],
-            "inverter_power": [state.avg_state for state in binned_inverter_power_state_history],
-            "solar_power": [state.avg_state for state in binned_solar_power_state_history],
-            "load_power": [state.avg_state for state in binned_load_power_state_history],
-            "grid_power": [state.avg_state for state in binned_grid_power_state_history],
-            "prices_sell": [state.avg_state/100.0 for state in binned_feed_in_state_history], # Converted to dollars from cents
-            "prices_buy": [state.avg_state/100.0 for state in binned_general_price_state_history],
+            "soc": ((binned["battery_soc"] / 100.0) * self.rated_capacity).tolist(),
+            "battery_power": binned["battery_power"].tolist(),
+            "inverter_power": binned["inverter_power"].tolist(),
+            "solar_power": binned["solar_power"].tolist(),
+            "load_power": binned["load_power"].tolist(),
+            "grid_power": binned["grid_power"].tolist(),
+            "prices_sell": (binned["feed_in_price"] / 100.0).tolist(), # Converted to dollars from cents
+            "prices_buy": (binned["general_price"] / 100.0).tolist(),
             "plan_modes": [state.avg_state for state in binned_working_mode_state_history],
-            "grid_import_kwh": [state.avg_state for state in binned_grid_import_kwh_state_history],
-            "grid_export_kwh": [state.avg_state for state in binned_grid_export_kwh_state_history],
+            "grid_import_kwh": binned["grid_import_kwh"].tolist(),
+            "grid_export_kwh": binned["grid_export_kwh"].tolist(),
         }
         return output
 
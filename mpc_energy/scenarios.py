@@ -0,0 +1,159 @@
+"""
+Scenario (stochastic) MPC.
+
+Instead of planning against a single forecast, K scenarios are built from the forecast
+uncertainty bands:
+    solar   Solcast pv_estimate10 / pv_estimate / pv_estimate90
+    load    quantiles of each time of day bin's daily load history
+    prices  Amber's advanced price forecast low / predicted / high band
+
+Scenario k sits at a quantile level q_k spread evenly over 10%-90%. Load and prices take their
+q_k quantile and solar its (1 - q_k) quantile, so the scenarios run from "sunny, light load,
+low prices" to "cloudy, heavy load, high prices". The load quantiles replace the flat
+load_inflation_percentage, the per-hour price uncertainty factors still apply on top.
+
+Each scenario is solved independently by the sparse backend, spread over a pool of solve
+worker processes. Only the first step of a plan is executed before the next re-plan, so the
+scenarios are reconciled on their first step: the scenario whose first-step decisions are the
+weighted medoid (smallest total distance to every other scenario's first step) is executed.
+"""
+import time
+from dataclasses import dataclass
+import numpy as np
+from mpc_logger import logger
+from solvers.solve_worker import SolveWorkerPool
+
+
+@dataclass
+class Scenario:
+    quantile: float
+    weight: float
+    solar: np.ndarray       # kW, 5 minute grid
+    load: np.ndarray        # kW, 5 minute grid
+    price_buy: np.ndarray   # Effective $/kWh, 5 minute grid
+    price_sell: np.ndarray
+    status: str = None
+    objective_value: float = None
+    x: np.ndarray = None
+
+
+class ScenarioPlanner:
+    BAND_QUANTILES = (0.1, 0.5, 0.9)    # Quantile each band edge represents (Solcast p10/p50/p90, Amber low/predicted/high)
+    NO_DEADLINE_SECONDS = 300           # Pool solves are abandoned after this when no solve deadline is configured
+
+    def __init__(self, scenario_count=3, worker_count=2):
+        self.scenario_count = max(1, int(scenario_count))
+        self.pool = SolveWorkerPool(worker_count) if int(worker_count) > 0 else None # No workers = solve the scenarios one after another in this process
+        self.solve_time = 0.0
+        self.selected = None
+
+    def quantiles(self) -> np.ndarray:
+        if self.scenario_count == 1:
+            return np.array([0.5])
+        return np.linspace(self.BAND_QUANTILES[0], self.BAND_QUANTILES[-1], self.scenario_count)
+
+    @classmethod
+    def interpolate_band(cls, quantile, low, mid, high):
+        """Linearly interpolate between a band's edges for a quantile level."""
+        q_low, q_mid, q_high = cls.BAND_QUANTILES
+        if quantile <= q_mid:
+            weight = (quantile - q_low) / (q_mid - q_low)
+            return (1 - weight) * low + weight * mid
+        weight = (quantile - q_mid) / (q_high - q_mid)
+        return (1 - weight) * mid + weight * high
+
+    # ---------- Scenario generation ----------
+    def build(self, mpc, amber_data) -> list[Scenario]:
+        """Build the scenarios for this run. Call after mpc.update_values so the current interval's measurements are available."""
+        n = int(mpc.N_5min)
+        solar = mpc.plant.forecast_solar_estimates(forecast_hours_from_now=mpc.forecast_hrs, forecast_start_time=mpc.sim_start, forecast_end_time=mpc.sim_end)
+        solar_band = [np.asarray(solar[estimate][:n], dtype=float) for estimate in ("pv_estimate10", "pv_estimate", "pv_estimate90")]
+
+        # Price bands in $/kWh, Flow Power (or Amber without advanced prices) has no bands so every scenario uses the forecast prices
+        bands = getattr(amber_data, "price_bands", None)
+        if bands:
+            buy_band = [np.asarray(bands["general"]["low"][:n], dtype=float) / 100, mpc.prices_buy, np.asarray(bands["general"]["high"][:n], dtype=float) / 100]
+            sell_band = [np.asarray(bands["feedIn"]["low"][:n], dtype=float) / 100, mpc.prices_sell, np.asarray(bands["feedIn"]["high"][:n], dtype=float) / 100]
+        else:
+            buy_band = [mpc.prices_buy] * 3
+            sell_band = [mpc.prices_sell] * 3
+
+        quantiles = self.quantiles()
+        scenarios = []
+        for quantile in quantiles:
+            load = mpc.plant.forecast_load_power(
+                forecast_hours_from_now=mpc.forecast_hrs,
+                forecast_start_time=mpc.sim_start,
+                forecast_end_time=mpc.sim_end,
+                quantile=quantile,
+            )[:n]
+            solar_q = self.interpolate_band(1 - quantile, *solar_band)
+
+            # The current interval uses the same measured values as the deterministic forecast
+            load[0] = mpc.load_5min[0]
+            solar_q[0] = mpc.solar_5min[0]
+            load = np.clip(load, 0.0, mpc.grid_import_limit)
+            solar_q = np.maximum(solar_q, 0.0)
+
+            buy = self.interpolate_band(quantile, *buy_band)
+            sell = self.interpolate_band(quantile, *sell_band)
+            buy = np.where(buy < sell, sell + 0.10, buy) # Keep buy above sell, as update_values does for the forecast prices
+            price_buy, price_sell = mpc.effective_prices(buy, sell)
+
+            scenarios.append(Scenario(quantile=float(quantile), weight=1 / len(quantiles), solar=solar_q, load=load, price_buy=price_buy, price_sell=price_sell))
+        return scenarios
+
+    @staticmethod
+    def set_parameters(mpc, scenario):
+        """Write a scenario's forecasts into the MPC parameters."""
+        mpc.solar_forecast_param.value = mpc.to_steps(scenario.solar)
+        mpc.load_forecast_param.value = mpc.to_steps(scenario.load)
+        mpc.price_buy_param.value = mpc.to_steps(scenario.price_buy)
+        mpc.price_sell_param.value = mpc.to_steps(scenario.price_sell)
+
+    # ---------- Solve ----------
+    def solve(self, mpc, scenarios, deadline):
+        """Solve every scenario with the sparse backend, in the worker pool if there is one."""
+        lp = mpc.sparse_lp
+        start = time.time()
+
+        def write_variant(scenario):
+            self.set_parameters(mpc, scenario)
+            mpc.update_sparse_values()
+
+        if self.pool is not None:
+            results = self.pool.solve_sparse_lps(lp, [lambda s=scenario: write_variant(s) for scenario in scenarios], deadline)
+            for scenario, (reply, outputs) in zip(scenarios, results):
+                scenario.status = reply["status"]
+                scenario.x = outputs.get("x")
+                scenario.objective_value = reply.get("objective_value")
+        else:
+            for scenario in scenarios:
+                write_variant(scenario)
+                scenario.status = lp.solve()
+                scenario.x = None if lp.x is None else np.array(lp.x)
+                scenario.objective_value = lp.objective_value
+
+        self.solve_time = time.time() - start
+        workers = len(self.pool) if self.pool is not None else 0
+        logger.info(f"Scenario MPC solved {len(scenarios)} scenarios on {workers or 'no'} workers in {self.solve_time:.2f} seconds ({self.solve_time / len(scenarios):.2f} s per scenario).")
+        logger.debug("Scenario objectives: " + ", ".join(
+            f"q={s.quantile:.2f}: {s.objective_value:.3f}" if s.objective_value is not None else f"q={s.quantile:.2f}: {s.status}" for s in scenarios))
+
+    # ---------- Reconciliation ----------
+    def select(self, mpc, scenarios) -> Scenario | None:
+        """Return the scenario whose first-step decisions are the weighted medoid of all solved scenarios, None if none solved."""
+        solved = [s for s in scenarios if s.status in ("optimal", "optimal_inaccurate") and s.x is not None]
+        if not solved:
+            return None
+        solved.sort(key=lambda s: abs(s.quantile - 0.5)) # Ties go to the most central scenario
+
+        # First step of every per-step decision variable (battery, grid, solar, inverter and optional load power)
+        first_step_cols = [cols.start for var, cols in mpc.sparse_lp.variables if var.size == mpc.N]
+        actions = np.array([s.x[first_step_cols] for s in solved])
+        weights = np.array([s.weight for s in solved])
+        distances = np.abs(actions[:, None, :] - actions[None, :, :]).sum(axis=2) @ weights
+
+        self.selected = solved[int(np.argmin(distances))]
+        logger.debug(f"Scenario MPC executing the q={self.selected.quantile:.2f} scenario's first step ({len(solved)} of {len(scenarios)} scenarios solved).")
+        return self.selected
@@ -0,0 +1,188 @@
+"""
+Problem-specific solver for the CVXPY MPC template, generated with CVXPYgen.
+
+The template's structure only changes with the horizon, the optional loads or the settings
+baked into it as constants (efficiency, rewards, penalties), yet every CVXPY solve pays for
+canonicalising the parameters into solver data. CVXPYgen emits C code for the ECOS solve of
+this one problem with the canonicalisation compiled in, which is built into a Python
+extension and cached on disk keyed by structure_key.
+
+The code generation and compile take from under a minute to several minutes, so they run in
+a background process (python -m solvers.codegen) and the regular CVXPY path is used until the
+module is ready. If CVXPYgen or a compiler isn't available, or the generated solver fails,
+the regular CVXPY path is used as before.
+"""
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+from mpc_logger import logger
+
+CACHE_DIR = "/data/mpc_codegen"
+SOLVER = "ECOS"
+MAX_ITERS = 300 # Same as the CVXPY path
+
+# ECOS exit codes, see ecos.h
+ECOS_STATUS = {
+    0: "optimal",
+    10: "optimal_inaccurate",
+    1: "infeasible",
+    11: "infeasible_inaccurate",
+    2: "unbounded",
+    12: "unbounded_inaccurate",
+    -1: "max_iters",
+}
+
+
+def structure_key(mpc) -> str:
+    """Hash of everything the generated solver is specific to: the horizon, the optional loads and the problem's constants."""
+    prob = mpc.prob
+    description = {
+        "N_5min": int(mpc.N_5min),
+        "step_sizes": np.asarray(mpc.step_sizes).tolist(),
+        "optional_loads": [(type(load).__name__, load.name) for load in mpc.optional_loads],
+        "variables": [(var.name(), var.shape) for var in prob.variables()],
+        "parameters": [(param.name(), param.shape) for param in prob.parameters()],
+        "constraints": len(prob.constraints),
+        "solver": SOLVER,
+        "python": sys.implementation.cache_tag,
+    }
+    digest = hashlib.sha256(json.dumps(description).encode())
+    for constant in prob.constants(): # Settings baked into the template, ie battery efficiency and rewards
+        digest.update(np.ascontiguousarray(constant.value, dtype=float).tobytes())
+    return digest.hexdigest()[:16]
+
+
+class CodegenSolver:
+    def __init__(self, prob, key, cache_dir=CACHE_DIR):
+        self.prob = prob
+        self.cache_dir = cache_dir
+        self.module_name = f"cpg_{key}"
+        self.module = None
+        self.process = None
+        self.failed = False
+
+        # The generated code names parameters and variables by their position, see _generate
+        self.parameters = prob.parameters()
+        self.variables = prob.variables()
+
+        # Result of the most recent solve
+        self.status = None
+        self.objective_value = None
+        self.iterations = 0
+        self.solve_time = 0.0
+
+        if os.path.isdir(os.path.join(cache_dir, self.module_name)):
+            self.load()
+
+    def ready(self) -> bool:
+        """True once the generated solver is loaded. Starts the background build on the first call if it isn't cached."""
+        if self.module is not None:
+            return True
+        if self.failed:
+            return False
+        if self.process is None:
+            self.start_build()
+        elif self.process.poll() is not None:
+            if self.process.returncode == 0:
+                self.load()
+            else:
+                self.failed = True
+                logger.warning(f"Generating the custom MPC solver failed (exit code {self.process.returncode}), using the regular CVXPY path.")
+            self.process = None
+        return self.module is not None
+
+    def start_build(self):
+        if importlib.util.find_spec("cvxpygen") is None:
+            self.failed = True
+            logger.warning("cvxpygen is not installed, the custom MPC solver can't be generated. Using the regular CVXPY path.")
+            return
+        if any(param.value is None for param in self.parameters):
+            return # CVXPYgen needs parameter values, wait until the first run has set them
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        problem_path = os.path.join(self.cache_dir, f"{self.module_name}.pickle")
+        with open(problem_path, "wb") as f:
+            pickle.dump(self.prob, f)
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "solvers.codegen", problem_path, self.cache_dir, self.module_name],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.DEVNULL,
+        )
+        logger.info(f"Generating a custom MPC solver in the background (pid {self.process.pid}), the regular CVXPY path is used until it's ready.")
+
+    def load(self):
+        try:
+            if self.cache_dir not in sys.path:
+                sys.path.insert(0, self.cache_dir)
+            self.module = importlib.import_module(f"{self.module_name}.cpg_module")
+            logger.info(f"Loaded the custom MPC solver {self.module_name}.")
+        except ImportError as e: # ie a cache built by a different Python version
+            self.module = None
+            self.failed = True
+            logger.warning(f"Failed to load the custom MPC solver {self.module_name}, using the regular CVXPY path. Error: {e}")
+
+    def solve(self) -> str:
+        """Solve with the generated solver and write the solution into the cvxpy variables."""
+        updated = self.module.cpg_updated()
+        params = self.module.cpg_params()
+        for index, param in enumerate(self.parameters):
+            name = f"param_{index}"
+            value = np.asarray(param.value, dtype=float)
+            setattr(updated, name, True)
+            setattr(params, name, float(value) if value.ndim == 0 else value.flatten(order="F").tolist())
+
+        self.module.set_solver_default_settings()
+        self.module.set_solver_maxit(MAX_ITERS)
+        start = time.time()
+        result = self.module.solve(updated, params)
+        self.solve_time = time.time() - start
+
+        self.iterations = int(result.cpg_info.iter)
+        self.status = ECOS_STATUS.get(int(result.cpg_info.status), "solver_error")
+        self.objective_value = float(result.cpg_info.obj_val)
+        if self.status in ("optimal", "optimal_inaccurate"):
+            for index, var in enumerate(self.variables):
+                value = np.array(getattr(result.cpg_prim, f"var_{index}"), dtype=float)
+                var.value = var.project(value.reshape(var.shape, order="F") if var.shape else float(value))
+        return self.status
+
+
+def _generate(problem_path, cache_dir, module_name):
+    """Generate and compile the solver, run in a separate process (see CodegenSolver.start_build)."""
+    from cvxpygen import cpg
+
+    with open(problem_path, "rb") as f:
+        prob = pickle.load(f)
+    os.remove(problem_path)
+
+    # Optional load names (ie "Hot Water") aren't valid C identifiers, the generated code uses positional names instead
+    for index, param in enumerate(prob.parameters()):
+        param._name = f"param_{index}"
+    for index, var in enumerate(prob.variables()):
+        var._name = f"var_{index}"
+
+    # Build under a temporary name so an interrupted build is never loaded
+    os.chdir(cache_dir)
+    sys.path.insert(0, cache_dir)
+    build_name = f"{module_name}_build"
+    shutil.rmtree(build_name, ignore_errors=True)
+    cpg.generate_code(prob, code_dir=build_name, solver=SOLVER, wrapper=True)
+
+    # Only the compiled extension is needed at runtime
+    for name in os.listdir(build_name):
+        if not name.startswith(("cpg_module", "__init__")):
+            path = os.path.join(build_name, name)
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    os.replace(build_name, module_name)
+
+
+if __name__ == "__main__":
+    _generate(*sys.argv[1:4])
@@ -0,0 +1,390 @@
+"""
+Dedicated worker process for the MPC solve.
+
+The solve runs in a separate process so a slow or stuck solver can be abandoned once its
+wall-clock deadline passes, instead of blocking plant control, charger updates and the
+alive sensor. The worker is restarted after a missed deadline. A SolveWorkerPool runs several workers to
+solve variants of the same LP concurrently (see scenarios.py).
+
+Numerical inputs and outputs travel through shared-memory NumPy arrays (owned by the main
+process), only small metadata goes over the connection. Two kinds of job are supported:
+    sparse_lp   The sparse backend's vectors (and its structure when it changes). The LP and
+                its solver state stay loaded in the worker, so hot/warm starts still apply.
+    conic       CVXPY's canonicalised problem data for ECOS/CLARABEL, unpacked back into the
+                CVXPY problem in the main process.
+"""
+import atexit
+import os
+import socket
+import subprocess
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection, wait
+from types import SimpleNamespace
+import numpy as np
+import scipy.sparse as sp
+from mpc_logger import logger
+from exceptions import MPCSolveTimeoutError
+
+
+class SharedArrays:
+    """Named NumPy arrays packed into one shared memory block, reused (and grown) between solves."""
+    ALIGN = 64
+
+    def __init__(self):
+        self.shm = None
+
+    @classmethod
+    def layout(cls, arrays):
+        layout = []
+        offset = 0
+        for name, array in arrays.items():
+            layout.append((name, array.dtype.str, array.shape, offset))
+            offset += -(-array.nbytes // cls.ALIGN) * cls.ALIGN
+        return layout, offset
+
+    def reserve(self, size):
+        if self.shm is None or self.shm.size < size:
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(int(size), self.ALIGN))
+        return self.shm
+
+    def pack(self, arrays):
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        layout, size = self.layout(arrays)
+        self.reserve(size)
+        self.write(self.shm.buf, layout, arrays)
+        return self.shm.name, layout
+
+    @staticmethod
+    def write(buf, layout, arrays):
+        for name, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)[...] = arrays[name]
+
+    @staticmethod
+    def read(buf, layout, copy=True):
+        arrays = {}
+        for name, dtype, shape, offset in layout:
+            array = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            arrays[name] = array.copy() if copy else array
+        return arrays
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class SolveWorker:
+    """Main process handle for the solve worker."""
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.restarts = 0
+        self.inputs = SharedArrays()
+        self.outputs = SharedArrays()
+        self._lp_key = None # Which SparseLP structure is loaded in the worker
+        self._pending_lp_key = None
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        parent_sock, child_sock = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "solvers.solve_worker", str(child_sock.fileno())],
+            pass_fds=(child_sock.fileno(),),
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        child_sock.close()
+        self.conn = Connection(parent_sock.detach())
+        self.ready = False
+        self._lp_key = None
+        logger.debug(f"Started MPC solve worker (pid {self.process.pid}).")
+
+    def stop(self):
+        if self.conn is not None:
+            try:
+                self.conn.send({"kind": "stop"})
+            except (OSError, ValueError):
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.inputs.close()
+        self.outputs.close()
+
+    def restart(self):
+        """Kill the worker (ie a solver stuck past its deadline) and start a fresh one in the background."""
+        self.process.kill()
+        self.process.wait()
+        self.conn.close()
+        self.restarts += 1
+        self.start()
+
+    def wait_until_ready(self, timeout):
+        """The worker imports the solvers before accepting jobs, wait for it so the first solve isn't charged for start up."""
+        if not self.ready and self.conn.poll(timeout):
+            self.ready = self.conn.recv() == "ready"
+        return self.ready
+
+    def _send(self, job, arrays, output_size, deadline):
+        if not self.wait_until_ready(max(0.0, deadline - time.time())):
+            raise MPCSolveTimeoutError("The MPC solve worker did not start before the solve deadline.")
+
+        job["inputs"] = self.inputs.pack(arrays)
+        job["outputs"] = (self.outputs.reserve(output_size).name, self.outputs.shm.size)
+        self.conn.send(job)
+
+    def _receive(self, deadline):
+        if not self.conn.poll(max(0.0, deadline - time.time())):
+            self.restart()
+            raise MPCSolveTimeoutError("The MPC solve did not finish before its deadline, the solve worker has been restarted.")
+        reply = self.conn.recv()
+        if "error" in reply:
+            logger.error(f"MPC solve worker failed: {reply['error']}")
+        return reply, SharedArrays.read(self.outputs.shm.buf, reply.get("layout", []))
+
+    def _lost(self, error):
+        logger.error(f"MPC solve worker exited unexpectedly ({error}), restarting it.")
+        self.restart()
+        return {"status": "worker_error"}, {}
+
+    def _run(self, job, arrays, output_size, deadline):
+        try:
+            self._send(job, arrays, output_size, deadline)
+            return self._receive(deadline)
+        except (EOFError, OSError) as e:
+            return self._lost(e)
+
+    def submit_sparse_lp(self, lp, shift_gathers, deadline, verbose=False):
+        """Send a compiled SparseLP's current vectors to the worker without waiting for the result, see receive_sparse_lp."""
+        job = {"kind": "sparse_lp", "solver": lp.solver, "verbose": verbose, "structure": self._lp_key != id(lp)}
+        arrays = dict(lp.vector_arrays())
+        if job["structure"]:
+            arrays.update(lp.structure_arrays())
+        if shift_gathers is not None:
+            arrays["step_gather"], arrays["state_gather"] = shift_gathers
+
+        output_size = 2 * (lp.n_rows + lp.n_cols) * 8 + 4 * SharedArrays.ALIGN # x and the duals (OSQP includes the bound rows)
+        self._send(job, arrays, output_size, deadline)
+        self._pending_lp_key = id(lp)
+
+    def receive_sparse_lp(self, deadline):
+        """Wait for the result of submit_sparse_lp. Returns the worker's reply and output arrays (x, y)."""
+        try:
+            reply, outputs = self._receive(deadline)
+        except (EOFError, OSError) as e:
+            reply, outputs = self._lost(e)
+        self._lp_key = self._pending_lp_key if "error" not in reply and reply["status"] != "worker_error" else None
+        return reply, outputs
+
+    def solve_sparse_lp(self, lp, shift_gathers, deadline, verbose=False):
+        """Solve a compiled SparseLP in the worker and load the result back into it."""
+        try:
+            self.submit_sparse_lp(lp, shift_gathers, deadline, verbose=verbose)
+        except (EOFError, OSError) as e:
+            reply, outputs = self._lost(e)
+        else:
+            reply, outputs = self.receive_sparse_lp(deadline)
+        lp.load_result(reply["status"], outputs.get("x"), outputs.get("y"), reply.get("objective_value"),
+                       reply.get("iterations", 0), reply.get("solve_time", 0.0), reply.get("warm_started", False))
+        return lp.status
+
+    def solve_cvxpy(self, prob, solver, solver_opts, deadline, verbose=False):
+        """Canonicalise a CVXPY problem here, solve the conic data in the worker and unpack the result into prob."""
+        from cvxpy.error import SolverError
+
+        data, chain, inverse_data = prob.get_problem_data(solver, solver_opts=solver_opts)
+        arrays, values = {}, {}
+        for key, value in data.items():
+            if key == "param_prob": # CVXPY's parameter mapping, only needed in this process
+                continue
+            if sp.issparse(value):
+                value = sp.csc_matrix(value)
+                arrays.update({f"{key}.data": value.data, f"{key}.indices": value.indices, f"{key}.indptr": value.indptr})
+                values[key] = ("csc", value.shape)
+            elif isinstance(value, np.ndarray):
+                arrays[key] = value
+            else:
+                values[key] = value
+
+        sizes = sum(len(arrays[key]) for key in ("c", "b", "h") if key in arrays)
+        job = {"kind": "conic", "solver": chain.solver, "data": values, "solver_opts": solver_opts, "verbose": verbose}
+        reply, outputs = self._run(job, arrays, 4 * sizes * 8 + 8 * SharedArrays.ALIGN, deadline)
+        if "error" in reply or reply["status"] == "worker_error":
+            return "worker_error"
+
+        solution = {**reply["values"], **outputs}
+        solution = solution if reply["is_dict"] else SimpleNamespace(**solution)
+        try:
+            prob.unpack_results(solution, chain, inverse_data)
+        except SolverError as e:
+            logger.warning(f"{chain.solver.name()} failed in the solve worker: {e}")
+            return "solver_error"
+        return prob.status
+
+
+class SolveWorkerPool:
+    """Several solve workers, used to solve variants of the same SparseLP concurrently."""
+
+    def __init__(self, size):
+        self.workers = [SolveWorker() for _ in range(max(1, int(size)))]
+        for worker in self.workers:
+            if not worker.wait_until_ready(timeout=60):
+                logger.warning("MPC solve worker is still starting, the first solves may miss their deadline.")
+
+    def __len__(self):
+        return len(self.workers)
+
+    def solve_sparse_lps(self, lp, variants, deadline):
+        """
+        Solve one variant of lp per callable in variants. Each callable writes its variant's vectors
+        into lp, which is sent to the next free worker. Returns a (reply, outputs) pair per variant, in order.
+        Raises MPCSolveTimeoutError (after restarting the busy workers) if the deadline passes.
+        """
+        results = [None] * len(variants)
+        pending = list(enumerate(variants))
+        idle = list(self.workers)
+        busy = {} # Connection -> (worker, variant index)
+
+        while pending or busy:
+            while pending and idle:
+                worker = idle.pop()
+                index, write_variant = pending.pop(0)
+                write_variant()
+                try:
+                    worker.submit_sparse_lp(lp, None, deadline)
+                except (EOFError, OSError) as e:
+                    results[index] = worker._lost(e)
+                    idle.append(worker)
+                    continue
+                busy[worker.conn] = (worker, index)
+            if not busy:
+                continue
+
+            ready = wait(list(busy), timeout=max(0.0, deadline - time.time()))
+            if not ready:
+                for worker, _ in busy.values():
+                    worker.restart()
+                raise MPCSolveTimeoutError(f"{len(busy) + len(pending)} of {len(variants)} MPC solves did not finish before the deadline, the busy solve workers have been restarted.")
+            for conn in ready:
+                worker, index = busy.pop(conn)
+                results[index] = worker.receive_sparse_lp(deadline)
+                idle.append(worker)
+        return results
+
+
+# ---------- Worker process ----------
+def _attach(blocks, name):
+    if name not in blocks:
+        blocks[name] = shared_memory.SharedMemory(name=name)
+        # The main process owns (and unlinks) the block, stop this process's resource tracker unlinking it when the worker exits
+        resource_tracker.unregister(blocks[name]._name, "shared_memory")
+    return blocks[name]
+
+
+def _solve_sparse_lp(job, arrays, state):
+    from solvers.sparse_lp import SparseLP
+
+    if job["structure"] or state.get("lp") is None:
+        state["lp"] = SparseLP.from_arrays(arrays, job["solver"])
+    lp = state["lp"]
+    lp.set_vectors(arrays)
+    if "step_gather" in arrays:
+        lp.shift_warm_start(arrays["step_gather"], arrays["state_gather"])
+    status = lp.solve(verbose=job["verbose"])
+
+    outputs = {}
+    if lp.x is not None:
+        outputs["x"] = lp.x
+        if lp.y is not None:
+            outputs["y"] = lp.y
+    reply = {"status": status, "objective_value": lp.objective_value, "iterations": lp.iterations,
+             "solve_time": lp.solve_time, "warm_started": lp.warm_started}
+    return reply, outputs
+
+
+def _solve_conic(job, arrays):
+    data = {}
+    for key, value in job["data"].items():
+        if isinstance(value, tuple) and len(value) == 2 and value[0] == "csc":
+            data[key] = sp.csc_matrix((arrays[f"{key}.data"], arrays[f"{key}.indices"], arrays[f"{key}.indptr"]), shape=value[1])
+        else:
+            data[key] = value
+    data.update({key: value for key, value in arrays.items() if "." not in key})
+
+    raw = job["solver"].solve_via_data(data, False, job["verbose"], dict(job["solver_opts"]))
+
+    # Split the raw solver result into arrays (returned through shared memory) and plain values (returned over the connection)
+    is_dict = isinstance(raw, dict)
+    items = raw.items() if is_dict else ((name, getattr(raw, name)) for name in dir(raw) if not name.startswith("_"))
+    outputs, values = {}, {}
+    for name, value in items:
+        if callable(value):
+            continue
+        if isinstance(value, np.ndarray) or (isinstance(value, list) and all(isinstance(v, float) for v in value)):
+            outputs[name] = np.asarray(value, dtype=float)
+        elif value is None or isinstance(value, (bool, int, float, str, dict)):
+            values[name] = value
+        else:
+            values[name] = str(value) # ie Clarabel's status enum, which CVXPY compares as a string
+    return {"status": "solved", "values": values, "is_dict": is_dict}, outputs
+
+
+def worker_main(fd):
+    conn = Connection(socket.socket(fileno=fd).detach())
+    # Import the solvers up front so the first solve isn't charged for it
+    import cvxpy # noqa: F401
+    try:
+        import highspy # noqa: F401
+    except ImportError:
+        pass
+    conn.send("ready")
+
+    blocks = {}
+    state = {}
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job["kind"] == "stop":
+            break
+
+        try:
+            in_name, in_layout = job["inputs"]
+            arrays = SharedArrays.read(_attach(blocks, in_name).buf, in_layout, copy=False)
+            if job["kind"] == "sparse_lp":
+                reply, outputs = _solve_sparse_lp(job, arrays, state)
+            else:
+                reply, outputs = _solve_conic(job, arrays)
+
+            out_name, out_size = job["outputs"]
+            layout, size = SharedArrays.layout(outputs)
+            if size > out_size:
+                raise ValueError(f"Solve outputs need {size} bytes but only {out_size} were reserved")
+            SharedArrays.write(_attach(blocks, out_name).buf, layout, outputs)
+            reply["layout"] = layout
+        except Exception as e:
+            state["lp"] = None
+            reply = {"status": "worker_error", "error": f"{type(e).__name__}: {e}", "layout": []}
+
+        # Blocks are replaced when they grow, drop any the main process no longer uses
+        for name in list(blocks):
+            if name not in (job["inputs"][0], job["outputs"][0]):
+                blocks.pop(name).close()
+
+        conn.send(reply)
+
+
+if __name__ == "__main__":
+    worker_main(int(sys.argv[1]))
@@ -0,0 +1,441 @@
+"""
+Direct sparse-matrix LP backend for the MPC.
+
+The battery/grid/solar LP (and each optional load block) is assembled once into
+a SciPy CSC matrix. Each run only the cost, row bound and column bound vectors are
+rewritten in place before being handed straight to HiGHS, OSQP or Clarabel, which
+avoids the CVXPY parameter-to-matrix canonicalisation on every control interval.
+
+    minimise    cost @ x + cost_offset
+    subject to  row_lower <= A @ x <= row_upper
+                col_lower <=     x <= col_upper
+"""
+import time
+import numpy as np
+import scipy.sparse as sp
+from mpc_logger import logger
+
+ROW_EQ = 0  # A @ x == rhs
+ROW_LE = 1  # A @ x <= rhs
+ROW_GE = 2  # A @ x >= rhs
+ROW_RANGE = 3  # lower <= A @ x <= upper, set with set_row_bounds
+
+INFINITE_BOUND = 1e20 # Bounds at or above this magnitude are treated as infinite by HiGHS and Clarabel
+
+SUPPORTED_SOLVERS = ("highs", "osqp", "clarabel")
+
+
+class SparseLP:
+    def __init__(self, solver="highs"):
+        if solver not in SUPPORTED_SOLVERS:
+            logger.warning(f"Unknown sparse LP solver '{solver}', defaulting to 'highs'. Supported solvers: {SUPPORTED_SOLVERS}")
+            solver = "highs"
+        self.solver = solver
+
+        self.n_cols = 0
+        self.n_rows = 0
+        self.variables = [] # List of (cvxpy variable, column slice) pairs, used to write the solution back
+        self._var_slices = {}
+        self._declared_lower = []
+        self._declared_upper = []
+        self._initial_lower = []
+        self._initial_upper = []
+
+        self._entry_rows = []
+        self._entry_cols = []
+        self._entry_vals = []
+        self._row_kinds = []
+        self.row_blocks = [] # Row slice of each block added with add_rows, used to time-shift warm starts
+        self.rows = {}       # Name -> row slice of the MPC's own blocks, kept with the LP they index so each LP is written through its own
+        self.load_rows = {}  # Optional load -> {name: row slice} of the load's blocks, set by its build_sparse
+
+        self.A = None
+        self.compiled = False
+
+        # Solver state, kept between runs so only the vectors have to be updated
+        self._highs = None
+        self._osqp = None
+
+        # Result of the most recent solve
+        self.status = None
+        self.x = None
+        self.y = None # Dual values (OSQP: constraint rows then variable bound rows)
+        self.objective_value = None
+        self.iterations = 0
+        self.solve_time = 0.0
+
+        # Warm start state, see shift_warm_start
+        self._basis = None          # HiGHS col/row basis status of the last optimal solve
+        self._warm_x = None
+        self._warm_y = None
+        self._warm_basis = None
+        self.warm_started = False   # Whether the most recent solve used a shifted warm start
+
+    # ---------- Structure ----------
+    def add_variable(self, var, lower=0.0, upper=None) -> slice:
+        """
+        Allocate a column block for a cvxpy variable. Pass None for lower/upper if the
+        variable is unbounded in that direction, the actual bound values are set on each run.
+        """
+        if self.compiled:
+            raise RuntimeError("Cannot add variables to a compiled SparseLP")
+
+        size = int(var.size)
+        cols = slice(self.n_cols, self.n_cols + size)
+        self.n_cols += size
+        self.variables.append((var, cols))
+        self._var_slices[var.id] = cols
+        self._declared_lower.append(np.full(size, lower is not None))
+        self._declared_upper.append(np.full(size, upper is not None))
+        self._initial_lower.append(np.full(size, -np.inf if lower is None else lower, dtype=float))
+        self._initial_upper.append(np.full(size, np.inf if upper is None else upper, dtype=float))
+        return cols
+
+    def cols(self, var, index=None) -> np.ndarray:
+        """Return the column indices for a variable (optionally a subset via index)."""
+        cols = self._var_slices[var.id]
+        idx = np.arange(cols.start, cols.stop)
+        if index is not None:
+            idx = idx[index]
+        return idx
+
+    def add_rows(self, count, terms, kind=ROW_EQ) -> slice:
+        """
+        Add a block of `count` rows. Each term is (variable, index, coeff) where index selects
+        `count` elements of the variable (row i uses element index[i]) and coeff is a scalar
+        or an array of length `count`.
+        """
+        if self.compiled:
+            raise RuntimeError("Cannot add rows to a compiled SparseLP")
+
+        rows = np.arange(self.n_rows, self.n_rows + count)
+        for var, index, coeff in terms:
+            cols = self.cols(var, index)
+            if len(cols) == 1 and count > 1: # Scalar variable shared across every row (ie peak demand)
+                cols = np.repeat(cols, count)
+            if len(cols) != count:
+                raise ValueError(f"Term for variable '{var.name()}' selects {len(cols)} columns but the row block has {count} rows")
+            self._entry_rows.append(rows)
+            self._entry_cols.append(cols)
+            self._entry_vals.append(np.broadcast_to(np.asarray(coeff, dtype=float), (count,)).copy())
+
+        self._row_kinds.append(np.full(count, kind))
+        self.n_rows += count
+        block = slice(rows[0], rows[-1] + 1) if count > 0 else slice(self.n_rows, self.n_rows)
+        self.row_blocks.append(block)
+        return block
+
+    def compile(self):
+        """Assemble the constraint matrix once and allocate the vectors rewritten on each run."""
+        rows = np.concatenate(self._entry_rows) if self._entry_rows else np.zeros(0, dtype=int)
+        cols = np.concatenate(self._entry_cols) if self._entry_cols else np.zeros(0, dtype=int)
+        vals = np.concatenate(self._entry_vals) if self._entry_vals else np.zeros(0)
+        self.A = sp.csc_matrix((vals, (rows, cols)), shape=(self.n_rows, self.n_cols))
+        self.A.sum_duplicates()
+
+        self.row_kinds = np.concatenate(self._row_kinds) if self._row_kinds else np.zeros(0, dtype=int)
+        self.declared_lower = np.concatenate(self._declared_lower)
+        self.declared_upper = np.concatenate(self._declared_upper)
+
+        self.cost = np.zeros(self.n_cols)
+        self.cost_offset = np.zeros(1) # Constant objective term (ie a reward on a state substituted out of the LP)
+        self.row_lower = np.full(self.n_rows, -np.inf)
+        self.row_upper = np.full(self.n_rows, np.inf)
+        self.col_lower = np.concatenate(self._initial_lower)
+        self.col_upper = np.concatenate(self._initial_upper)
+
+        self._entry_rows, self._entry_cols, self._entry_vals = [], [], []
+        self.compiled = True
+        logger.debug(f"Sparse LP compiled with {self.n_cols} variables, {self.n_rows} constraints and {self.A.nnz} non-zeros.")
+
+    # ---------- Per-run values ----------
+    def reset_cost(self):
+        self.cost[:] = 0.0
+        self.cost_offset[:] = 0.0
+
+    def add_cost(self, var, coeff, index=None):
+        self.cost[self.cols(var, index)] += coeff
+
+    def set_rhs(self, rows: slice, rhs):
+        """Write the right-hand side of a row block according to the kind it was declared with."""
+        kinds = self.row_kinds[rows]
+        rhs = np.broadcast_to(np.asarray(rhs, dtype=float), kinds.shape)
+        self.row_lower[rows] = np.where(kinds == ROW_LE, -np.inf, rhs)
+        self.row_upper[rows] = np.where(kinds == ROW_GE, np.inf, rhs)
+
+    def set_row_bounds(self, rows: slice, lower, upper):
+        """Write both sides of a ROW_RANGE block."""
+        self.row_lower[rows] = lower
+        self.row_upper[rows] = upper
+
+    def set_bounds(self, var, lower=None, upper=None, index=None):
+        cols = self.cols(var, index)
+        if lower is not None:
+            self.col_lower[cols] = lower
+        if upper is not None:
+            self.col_upper[cols] = upper
+
+    # ---------- Warm start ----------
+    def shift_warm_start(self, step_gather, state_gather):
+        """
+        Time-shift the last optimal solution to use as the starting point of the next solve.
+        step_gather/state_gather give, for each step (N) or step boundary (N+1) of the new
+        horizon, the index it maps to in the previous horizon. Every variable and row block
+        with one of those lengths is gathered, scalar blocks (initial conditions, peak demand) are kept.
+        """
+        self.clear_warm_start()
+        if self.x is None or self.status not in ("optimal", "optimal_inaccurate"):
+            return False
+
+        col_blocks = [cols for _, cols in self.variables]
+        self._warm_x = self._shift(self.x, col_blocks, step_gather, state_gather)
+        if self.y is not None and len(self.y) == self.n_rows + self.n_cols: # OSQP duals include the variable bound rows
+            self._warm_y = np.concatenate([
+                self._shift(self.y[:self.n_rows], self.row_blocks, step_gather, state_gather),
+                self._shift(self.y[self.n_rows:], col_blocks, step_gather, state_gather),
+            ])
+        if self._basis is not None:
+            col_status, row_status = self._basis
+            self._warm_basis = (
+                self._shift(col_status, col_blocks, step_gather, state_gather),
+                self._shift(row_status, self.row_blocks, step_gather, state_gather),
+            )
+        return True
+
+    def clear_warm_start(self):
+        self._warm_x = None
+        self._warm_y = None
+        self._warm_basis = None
+
+    @staticmethod
+    def _shift(values, blocks, step_gather, state_gather):
+        shifted = values.copy()
+        for block in blocks:
+            length = block.stop - block.start
+            if length == len(step_gather):
+                shifted[block] = values[block.start + step_gather]
+            elif length == len(state_gather):
+                shifted[block] = values[block.start + state_gather]
+        return shifted
+
+    # ---------- Solve ----------
+    def solve(self, verbose=False):
+        if not self.compiled:
+            self.compile()
+
+        start = time.time()
+        if self.solver == "osqp":
+            self.status, self.x = self._solve_osqp(verbose)
+        elif self.solver == "clarabel":
+            self.status, self.x = self._solve_clarabel(verbose)
+        else:
+            self.status, self.x = self._solve_highs(verbose)
+        self.solve_time = time.time() - start
+        self.clear_warm_start()
+
+        self.objective_value = float(self.cost @ self.x + self.cost_offset[0]) if self.x is not None else None
+        return self.status
+
+    def _solve_highs(self, verbose):
+        import highspy
+
+        inf = highspy.kHighsInf
+        col_lower = np.where(np.isfinite(self.col_lower), self.col_lower, -inf)
+        col_upper = np.where(np.isfinite(self.col_upper), self.col_upper, inf)
+        row_lower = np.where(np.isfinite(self.row_lower), self.row_lower, -inf)
+        row_upper = np.where(np.isfinite(self.row_upper), self.row_upper, inf)
+
+        if self._highs is None:
+            h = highspy.Highs()
+            h.setOptionValue("output_flag", False)
+            model = highspy.HighsLp()
+            model.num_col_ = self.n_cols
+            model.num_row_ = self.n_rows
+            model.col_cost_ = self.cost
+            model.col_lower_ = col_lower
+            model.col_upper_ = col_upper
+            model.row_lower_ = row_lower
+            model.row_upper_ = row_upper
+            model.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+            model.a_matrix_.start_ = self.A.indptr
+            model.a_matrix_.index_ = self.A.indices
+            model.a_matrix_.value_ = self.A.data
+            h.passModel(model)
+            self._highs = h
+            self._col_index = np.arange(self.n_cols, dtype=np.int32)
+            self._row_index = np.arange(self.n_rows, dtype=np.int32)
+        else:
+            # Only the vectors change between runs, the matrix stays loaded in HiGHS
+            h = self._highs
+            h.changeColsCost(self.n_cols, self._col_index, self.cost)
+            h.changeColsBounds(self.n_cols, self._col_index, col_lower, col_upper)
+            h.changeRowsBounds(self.n_rows, self._row_index, row_lower, row_upper)
+
+        # Without a shifted basis HiGHS hot starts from the (unshifted) basis of the last solve
+        self.warm_started = False
+        if self._warm_basis is not None:
+            col_status, row_status = self._warm_basis
+            basis = highspy.HighsBasis()
+            basis.col_status = [highspy.HighsBasisStatus(int(s)) for s in col_status]
+            basis.row_status = [highspy.HighsBasisStatus(int(s)) for s in row_status]
+            basis.valid = True
+            self.warm_started = h.setBasis(basis) == highspy.HighsStatus.kOk
+            if not self.warm_started:
+                logger.debug("HiGHS rejected the shifted warm start basis, hot starting from the previous basis instead.")
+
+        h.setOptionValue("output_flag", bool(verbose))
+        h.run()
+
+        model_status = h.getModelStatus()
+        self.iterations = int(h.getInfo().simplex_iteration_count)
+        if model_status == highspy.HighsModelStatus.kOptimal:
+            solution = h.getSolution()
+            basis = h.getBasis()
+            self._basis = (np.array([int(s) for s in basis.col_status], dtype=np.int8),
+                           np.array([int(s) for s in basis.row_status], dtype=np.int8))
+            self.y = np.array(solution.row_dual)
+            return "optimal", np.array(solution.col_value)
+        if model_status == highspy.HighsModelStatus.kInfeasible:
+            return "infeasible", None
+        if model_status in (highspy.HighsModelStatus.kUnbounded, highspy.HighsModelStatus.kUnboundedOrInfeasible):
+            return "unbounded", None
+        return h.modelStatusToString(model_status), None
+
+    def _solve_osqp(self, verbose):
+        import osqp
+
+        # OSQP has no native variable bounds, so they are appended as identity rows
+        lower = np.concatenate([self.row_lower, self.col_lower])
+        upper = np.concatenate([self.row_upper, self.col_upper])
+
+        if self._osqp is None:
+            P = sp.csc_matrix((self.n_cols, self.n_cols))
+            A = sp.vstack([self.A, sp.identity(self.n_cols, format="csc")], format="csc")
+            self._osqp = osqp.OSQP()
+            self._osqp.setup(P=P, q=self.cost, A=A, l=lower, u=upper, verbose=verbose,
+                             eps_abs=1e-4, eps_rel=1e-4, max_iter=10000, polishing=True)
+        else:
+            self._osqp.update(q=self.cost, l=lower, u=upper)
+
+        # OSQP warm starts from its last (unshifted) iterate unless a shifted primal/dual point is given
+        self.warm_started = self._warm_x is not None and self._warm_y is not None
+        if self.warm_started:
+            self._osqp.warm_start(x=self._warm_x, y=self._warm_y)
+
+        results = self._osqp.solve()
+        self.iterations = int(results.info.iter)
+        status = str(results.info.status).lower()
+        if status in ("solved", "solved inaccurate"):
+            self.y = np.array(results.y)
+            return ("optimal" if status == "solved" else "optimal_inaccurate"), np.array(results.x)
+        return status, None
+
+    def _solve_clarabel(self, verbose):
+        import clarabel
+
+        # Clarabel expects A @ x + s == b with s in a cone, so inequalities and declared
+        # variable bounds are expanded into rows of the form (+/-)A @ x <= b.
+        eq = self.row_kinds == ROW_EQ
+        le = self.row_kinds == ROW_LE
+        ge = self.row_kinds == ROW_GE
+        rng = self.row_kinds == ROW_RANGE
+        identity = sp.identity(self.n_cols, format="csr")
+        A_csr = self.A.tocsr()
+
+        blocks = [A_csr[eq], A_csr[le], -A_csr[ge], A_csr[rng], -A_csr[rng], identity[self.declared_upper], -identity[self.declared_lower]]
+        b = np.concatenate([
+            self.row_upper[eq],
+            self.row_upper[le],
+            -self.row_lower[ge],
+            self.row_upper[rng],
+            -self.row_lower[rng],
+            self.col_upper[self.declared_upper],
+            -self.col_lower[self.declared_lower],
+        ])
+        b = np.clip(b, -INFINITE_BOUND, INFINITE_BOUND)
+        A = sp.vstack(blocks, format="csc")
+        cones = [clarabel.ZeroConeT(int(eq.sum())), clarabel.NonnegativeConeT(A.shape[0] - int(eq.sum()))]
+
+        self.warm_started = False # Clarabel has no warm start interface, each solve starts cold
+        settings = clarabel.DefaultSettings()
+        settings.verbose = verbose
+        P = sp.csc_matrix((self.n_cols, self.n_cols))
+        solution = clarabel.DefaultSolver(P, self.cost, A, b, cones, settings).solve()
+
+        self.iterations = int(solution.iterations)
+        status = str(solution.status)
+        if status == "Solved":
+            return "optimal", np.array(solution.x)
+        if status == "AlmostSolved":
+            return "optimal_inaccurate", np.array(solution.x)
+        return status.lower(), None
+
+    # ---------- Worker process support (see solvers/solve_worker.py) ----------
+    def structure_arrays(self) -> dict:
+        """The compiled structure as plain arrays, so the LP can be rebuilt in another process."""
+        if not self.compiled:
+            self.compile()
+        return {
+            "A_data": self.A.data,
+            "A_indices": self.A.indices,
+            "A_indptr": self.A.indptr,
+            "A_shape": np.array(self.A.shape),
+            "row_kinds": self.row_kinds,
+            "declared_lower": self.declared_lower,
+            "declared_upper": self.declared_upper,
+            "col_blocks": np.array([(cols.start, cols.stop) for _, cols in self.variables], dtype=np.int64).reshape(-1, 2),
+            "row_blocks": np.array([(rows.start, rows.stop) for rows in self.row_blocks], dtype=np.int64).reshape(-1, 2),
+        }
+
+    def vector_arrays(self) -> dict:
+        """The per-run vectors written by update_sparse_values."""
+        return {
+            "cost": self.cost,
+            "cost_offset": self.cost_offset,
+            "row_lower": self.row_lower,
+            "row_upper": self.row_upper,
+            "col_lower": self.col_lower,
+            "col_upper": self.col_upper,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, solver="highs"):
+        """Rebuild a compiled LP from structure_arrays (without the cvxpy variables, so write_solution is unavailable)."""
+        arrays = {name: np.array(value) for name, value in arrays.items()} # Copy, the arrays may be views of shared memory
+        lp = cls(solver)
+        n_rows, n_cols = (int(v) for v in arrays["A_shape"])
+        lp.A = sp.csc_matrix((arrays["A_data"], arrays["A_indices"], arrays["A_indptr"]), shape=(n_rows, n_cols))
+        lp.n_rows, lp.n_cols = n_rows, n_cols
+        lp.row_kinds = arrays["row_kinds"]
+        lp.declared_lower = arrays["declared_lower"].astype(bool)
+        lp.declared_upper = arrays["declared_upper"].astype(bool)
+        lp.variables = [(None, slice(int(start), int(stop))) for start, stop in arrays["col_blocks"]]
+        lp.row_blocks = [slice(int(start), int(stop)) for start, stop in arrays["row_blocks"]]
+        lp.cost = np.zeros(n_cols)
+        lp.cost_offset = np.zeros(1)
+        lp.row_lower = np.full(n_rows, -np.inf)
+        lp.row_upper = np.full(n_rows, np.inf)
+        lp.col_lower = np.zeros(n_cols)
+        lp.col_upper = np.full(n_cols, np.inf)
+        lp.compiled = True
+        return lp
+
+    def set_vectors(self, arrays):
+        for name in ("cost", "cost_offset", "row_lower", "row_upper", "col_lower", "col_upper"):
+            getattr(self, name)[:] = arrays[name]
+
+    def load_result(self, status, x, y, objective_value, iterations, solve_time, warm_started):
+        """Store the result of a solve that ran in the worker process."""
+        self.status = status
+        self.x = x
+        self.y = y
+        self.objective_value = objective_value
+        self.iterations = iterations
+        self.solve_time = solve_time
+        self.warm_started = warm_started
+
+    def write_solution(self):
+        """Write the solved values back into the cvxpy variables so results are read the same way as the CVXPY path."""
+        for var, cols in self.variables:
+            value = self.x[cols].reshape(var.shape) if var.shape else float(self.x[cols][0])
+            var.value = var.project(value) # Project to remove tiny solver tolerance violations (ie -1e-9 on a nonneg variable)
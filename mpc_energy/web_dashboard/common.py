@@ -12,6 +12,7 @@ def render_sidebar():
     st.sidebar.page_link("pages/optional_loads_page.py", label="Optional Loads", icon="⚙️")
     st.sidebar.page_link("pages/opt_load_debugger.py", label="Opt Load Debugger", icon="🧪")
     st.sidebar.page_link("pages/load_debugger_page.py", label="Load Debugger", icon="📈")
+    st.sidebar.page_link("pages/what_if_page.py", label="What-If Sweep", icon="🔬")
     
     st.sidebar.divider()
     if st.sidebar.button("🔄 Restart MPC Energy", help="Restarts the main MPC integration. Required after configuration changes.", width='stretch'):
@@ -40,6 +40,38 @@ with st.form("general_settings"):
     notif_options = ["none", "price_spike_warning", "error_warning", "both"]
     notification_option = st.selectbox("Notification Types", notif_options, index=notif_options.index(config.get("notification_target_option", "none")))
 
+    st.subheader("🏠 Home Assistant Connection")
+    col1, col2 = st.columns(2)
+    websocket_states = col1.checkbox("Subscribe To Entity States (WebSocket)", value=config.get("ha_websocket_states", True), help="Keeps the states of the entities MPC Energy reads up to date over Home Assistant's websocket API instead of requesting each one over the REST API every control loop. The REST API is still used while the websocket is disconnected.")
+    tick_snapshots = col2.checkbox("Read All States Once Per Loop", value=config.get("ha_tick_snapshots", True), help="Reads every entity's state with a single REST request per control loop instead of one request per entity, for the reads the websocket subscription doesn't serve (ie while it is disconnected). On Home Assistant installs with a very large number of entities this response can be large.")
+    col1, col2 = st.columns(2)
+    load_statistics = col1.checkbox("Use Statistics For Load Profiles", value=config.get("ha_load_statistics", True), help="Builds the load profile (and the optional load debiasing) from Home Assistant's pre-aggregated 5 minute statistics instead of downloading and binning every state change of the past days. Only sensors with a measurement state_class have statistics, the raw history is used for the others.")
+    history_store = col2.checkbox("Local History Store", value=config.get("ha_history_store", True), help="Keeps the 5 minute averages of the history MPC Energy reads (load, solar, battery, prices and optional loads) in a local database under /data, so only the history since the last update is downloaded from Home Assistant instead of the whole period every time. Bins older than 15 days are removed.")
+
+    st.subheader("🧮 Optimiser")
+    col1, col2 = st.columns(2)
+    solver_backends = ["cvxpy", "sparse"]
+    solver_backend = col1.selectbox("MPC Solver Backend", solver_backends, index=solver_backends.index(config.get("mpc_solver_backend", "cvxpy")), help="'cvxpy' builds the MPC through CVXPY (default). 'sparse' assembles the LP directly into sparse matrices and only updates the changing values each run, which is faster on low power hosts.")
+    sparse_solvers = ["highs", "clarabel", "osqp"]
+    sparse_solver = col2.selectbox("Sparse Backend Solver", sparse_solvers, index=sparse_solvers.index(config.get("mpc_sparse_solver", "highs")), help="Solver used by the sparse backend. HiGHS is recommended. If the selected solver fails the MPC falls back to the CVXPY backend for that run.")
+    col1, col2 = st.columns(2)
+    formulations = ["full", "condensed"]
+    formulation = col1.selectbox("Sparse Backend Formulation", formulations, index=formulations.index(config.get("mpc_formulation", "full")), help="'full' solves the same LP as the CVXPY backend. 'condensed' substitutes out the solar curtailment, inverter power and initial SOC variables (rebuilt after the solve) and drops constraints that can't bind, giving the solver a smaller problem with the same plan.")
+    horizon_modes = ["uniform", "multi_rate"]
+    horizon_mode = col2.selectbox("MPC Horizon Resolution", horizon_modes, index=horizon_modes.index(config.get("mpc_horizon_mode", "uniform")), help="'uniform' plans the full horizon in 5 minute steps. 'multi_rate' keeps 5 minute steps for the first 2 hours, then 15 minute steps until 12 hours and 30 minute steps beyond, which greatly reduces the problem size and solve time.")
+    solve_deadline = st.number_input("Solve Deadline (seconds)", min_value=0, max_value=240, step=5, value=int(config.get("mpc_solve_deadline", 0)), help="Runs the solve in a separate worker process. If it takes longer than this, the last valid plan keeps being executed (or self consumption if there is none) and the worker is restarted. Set to 0 to solve in the main process.")
+    col1, col2 = st.columns(2)
+    plan_cache = col1.checkbox("Reuse Plan When Inputs Are Unchanged", value=config.get("mpc_plan_cache", False), help="Skips the solve and reuses the previous plan (shifted to the current time) when prices, forecasts, limits and optional load settings match the last solve and the battery is tracking the plan.")
+    plan_cache_max_age = col2.number_input("Max Reused Plan Age (minutes)", min_value=0, max_value=60, step=5, value=int(config.get("mpc_plan_cache_max_age", 15)), help="A fresh solve is always run once the cached plan is older than this.")
+    col1, col2, col3 = st.columns(3)
+    scenario_mode = col1.checkbox("Scenario MPC", value=config.get("mpc_scenario_mode", False), help="Plans against several solar, load and price scenarios (from the Solcast 10th/90th percentile estimates, the load history and Amber's advanced price range) and executes the most representative first step. Requires the sparse backend.")
+    scenario_count = col2.number_input("Scenarios", min_value=1, max_value=15, step=1, value=int(config.get("mpc_scenario_count", 3)), help="Number of scenarios solved each run. Solve time grows with the number of scenarios divided by the number of workers.")
+    scenario_workers = col3.number_input("Scenario Workers", min_value=0, max_value=8, step=1, value=int(config.get("mpc_scenario_workers", 2)), help="Worker processes the scenarios are solved on in parallel. Set to 0 to solve them one after another in the main process. More workers than CPU cores won't help.")
+    what_if_workers = st.number_input("What-If Sweep Workers", min_value=0, max_value=8, step=1, value=int(config.get("mpc_what_if_workers", 2)), help="Worker processes the What-If Sweep page's variants are solved on in parallel. Set to 0 to solve them in the main process.")
+    codegen = st.checkbox("Generate Custom Solver (cvxpygen)", value=config.get("mpc_codegen", False), help="Generates and compiles a solver specific to the MPC problem for the CVXPY backend (and the sparse backend's CVXPY fallback), cached until the horizon, optional loads or battery settings change. Requires the cvxpygen package. The first build runs in the background and can take several minutes; until then, or if it fails, the regular CVXPY solve is used. Not used when a solve deadline is set.")
+    online_profile = st.checkbox("Online Load Profile", value=config.get("online_load_profile", True), help="Updates the average day of household load each 5 minutes from the load power read every control loop (less the debiased optional loads), weighting recent days more, instead of rebuilding it from the load history once a day. The history only seeds it, and its state is saved under /data so restarts carry on from it.")
+    backend_parity_check = st.checkbox("Check Sparse Backend Against CVXPY", value=config.get("mpc_backend_parity_check", False), help="Solves each run through both backends and logs the difference in the plan. This roughly doubles the solve time so only enable it when verifying the sparse backend.")
+
     submitted = st.form_submit_button("Save General Configuration")
     if submitted:
         new_cfg = {
@@ -49,7 +81,25 @@ with st.form("general_settings"):
             "spike_price_warning_level": spike_level,
             "notification_target": notification_target,
             "notification_target_option": notification_option,
-            "log_level": log_level
+            "log_level": log_level,
+            "ha_websocket_states": websocket_states,
+            "ha_tick_snapshots": tick_snapshots,
+            "ha_load_statistics": load_statistics,
+            "ha_history_store": history_store,
+            "mpc_solver_backend": solver_backend,
+            "mpc_sparse_solver": sparse_solver,
+            "mpc_formulation": formulation,
+            "mpc_backend_parity_check": backend_parity_check,
+            "online_load_profile": online_profile,
+            "mpc_codegen": codegen,
+            "mpc_horizon_mode": horizon_mode,
+            "mpc_plan_cache": plan_cache,
+            "mpc_plan_cache_max_age": plan_cache_max_age,
+            "mpc_solve_deadline": solve_deadline,
+            "mpc_scenario_mode": scenario_mode,
+            "mpc_scenario_count": scenario_count,
+            "mpc_scenario_workers": scenario_workers,
+            "mpc_what_if_workers": what_if_workers
         }
         config_manager.save_local_config(new_cfg)
         st.success("General configuration saved! Please restart the integration to apply changes.")
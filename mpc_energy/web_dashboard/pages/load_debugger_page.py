@@ -7,6 +7,7 @@ from ha_api import HomeAssistantAPI
 from plants.plant_manager import GetPlant, load_plant_config
 import const
 import data_helpers
+import config_manager
 from loads.optional_loads import load_optional_load_instances
 from mpc_logger import logger
 from web_dashboard.common import render_sidebar
@@ -18,7 +19,7 @@ st.title("📈 Load Profile Debugger")
 st.write("This tool visualizes the data used by `update_load_avg` to predict your household consumption.")
 
 # 1. Initialization
-ha = HomeAssistantAPI(base_url=const.HA_API_URL, token=const.HA_TOKEN)
+ha = HomeAssistantAPI(base_url=const.HA_API_URL, token=const.HA_TOKEN, use_statistics=config_manager.ha_load_statistics, store_history=config_manager.ha_history_store)
 opt_loads = load_optional_load_instances(ha, ha.local_tz, None)
 plant = GetPlant(ha, opt_loads)
 
@@ -41,18 +42,18 @@ if st.button("Fetch and Analyze Data"):
         start = datetime.datetime.combine(start_date, datetime.time.min, tzinfo=ha.local_tz)
         end = datetime.datetime.combine(end_date, datetime.time.max, tzinfo=ha.local_tz)
 
-        # Get raw data
-        load_power_history = ha.get_history(plant.load_power_entity_id, start_time=start, end_time=end)
+        # Read through the history store, only the days since its last update are fetched
+        load_power_history = ha.get_stored_history(plant.load_power_entity_id, start_time=start, end_time=end)
         
-        if not load_power_history:
+        if not len(load_power_history):
             st.error(f"No history found for entity: {plant.load_power_entity_id}")
             st.stop()
 
         # Binning
-        binned_load = data_helpers.bin_data(load_power_history, bin_size, start, end)
+        binned_load = data_helpers.bin_series(load_power_history.time, load_power_history.state, bin_size, start, end).values
         
         # Debiasing
-        total_load_data = [b.avg_state if b.avg_state is not None else 0.0 for b in binned_load]
+        total_load_data = np.nan_to_num(binned_load).tolist()
         debiased_data = list(total_load_data)
         optional_load_data = [0.0] * len(total_load_data)
 
@@ -1,9 +1,11 @@
 import streamlit as st
 import pandas as pd
+from datetime import datetime, timedelta
 import plotly.graph_objects as go
 from loads.optional_loads import load_optional_load_instances
 from ha_api import HomeAssistantAPI
 import const
+import config_manager
 from web_dashboard.common import render_sidebar
 
 st.set_page_config(page_title="Opt Load Debugger", layout="wide", initial_sidebar_state="collapsed")
@@ -13,7 +15,7 @@ st.title("🧪 Optional Load Loss Debugger")
 st.caption("Analyze background degradation (Phantom Drain) for EVs or thermal losses for Hot Water.")
 
 if "ha" not in st.session_state:
-    st.session_state.ha = HomeAssistantAPI(base_url=const.HA_API_URL, token=const.HA_TOKEN)
+    st.session_state.ha = HomeAssistantAPI(base_url=const.HA_API_URL, token=const.HA_TOKEN, use_statistics=config_manager.ha_load_statistics, store_history=config_manager.ha_history_store)
 
 ha = st.session_state.ha
 opt_loads = load_optional_load_instances(ha, ha.local_tz, None)
@@ -37,19 +39,19 @@ cache_key = (selected_load_name, days_to_analyze)
 if (cache_key != st.session_state.debugger_profile_cache.get("last_key") or 
     st.button("Refresh History Data")):
     with st.spinner("Fetching and processing historical deltas..."):
-        avg_delta_dict = load.get_level_delta_avg(days_ago=days_to_analyze, hours_update_interval=0)
+        avg_delta_profile = load.get_level_delta_avg(days_ago=days_to_analyze, hours_update_interval=0)
         st.session_state.debugger_profile_cache["last_key"] = cache_key
-        st.session_state.debugger_profile_cache["avg_delta_dict"] = avg_delta_dict
+        st.session_state.debugger_profile_cache["avg_delta_profile"] = avg_delta_profile
 else:
-    avg_delta_dict = st.session_state.debugger_profile_cache.get("avg_delta_dict")
+    avg_delta_profile = st.session_state.debugger_profile_cache.get("avg_delta_profile")
 
-if not avg_delta_dict:
+if avg_delta_profile is None:
     st.error("No historical data found. Ensure the 'Level Entity ID' is correct and has history.")
     st.stop()
 
 # Calculate Power equivalent of the loss
-sorted_times = sorted(avg_delta_dict.keys())
-deltas = [avg_delta_dict[t] for t in sorted_times]
+sorted_times = [(datetime.min + timedelta(minutes=slot * avg_delta_profile.step_minutes)).time() for slot in range(len(avg_delta_profile))]
+deltas = avg_delta_profile.values.tolist()
 
 if load.load_type == "hot_water":
     unit = "°C"
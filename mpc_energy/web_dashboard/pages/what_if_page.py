@@ -0,0 +1,96 @@
+import streamlit as st
+import pandas as pd
+import json
+import time
+import uuid
+import queue
+import paho.mqtt.client as mqtt
+import config_manager
+import const
+from loads.optional_loads import load_optional_loads
+from web_dashboard.common import render_sidebar
+
+# Must match MPC.WHAT_IF_REQUEST_TOPIC / WHAT_IF_RESULT_TOPIC (not imported, importing MPC connects it to MQTT)
+WHAT_IF_REQUEST_TOPIC = "home/mpc/what_if/request"
+WHAT_IF_RESULT_TOPIC = "home/mpc/what_if/result"
+RESULT_TIMEOUT_SECONDS = 180 # The sweep runs between control loops, so allow for a price update and solve in between
+
+st.set_page_config(page_title="What-If Sweep", layout="wide", initial_sidebar_state="collapsed")
+render_sidebar()
+
+st.title("🔬 What-If Sweep")
+st.write("Re-solves the latest MPC plan's inputs with different costs and rewards and compares the outcome. The running configuration isn't changed.")
+st.caption("Leave a cell empty to keep the current value. Battery discharge cost and optional load rewards are in c/kWh, the grid import penalty and full battery reward in $/kWh.")
+
+# One column per overridable setting, see MPC.WHAT_IF_PARAMETERS
+columns = ["battery_discharge_cost", "grid_import_penalty_cost", "full_battery_reward"]
+columns += [f"{load['name']}.reward_cents_per_kwh" for load in load_optional_loads() if load.get("name")]
+
+if "what_if_variants" not in st.session_state:
+    base_cost = float(config_manager.battery_discharge_cost)
+    st.session_state.what_if_variants = pd.DataFrame(
+        [{}, {"battery_discharge_cost": base_cost / 2}, {"battery_discharge_cost": base_cost * 2}],
+        columns=columns,
+        dtype=float,
+    )
+
+variants = st.data_editor(st.session_state.what_if_variants, num_rows="dynamic", width='stretch', key="what_if_editor")
+
+
+def run_sweep(overrides):
+    """Publish a sweep request and wait for MPC Energy's reply."""
+    request_id = uuid.uuid4().hex
+    replies = queue.Queue()
+
+    def on_message(client, userdata, msg):
+        reply = json.loads(msg.payload)
+        if reply.get("request_id") == request_id:
+            replies.put(reply)
+
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    client.username_pw_set(config_manager.MQTT_USER, config_manager.MQTT_PASS)
+    client.on_message = on_message
+    client.connect(const.MQTT_HOST, const.MQTT_PORT)
+    client.loop_start()
+    try:
+        client.subscribe(WHAT_IF_RESULT_TOPIC)
+        time.sleep(0.5) # Let the subscription settle before the reply can arrive
+        client.publish(WHAT_IF_REQUEST_TOPIC, json.dumps({"request_id": request_id, "overrides": overrides}))
+        return replies.get(timeout=RESULT_TIMEOUT_SECONDS)
+    except queue.Empty:
+        return {"error": f"No reply from MPC Energy within {RESULT_TIMEOUT_SECONDS} seconds. Check the MPC Energy log."}
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+
+if st.button("Run What-If Sweep", type="primary"):
+    overrides = [
+        {key: float(value) for key, value in row.items() if pd.notna(value)}
+        for row in variants.to_dict("records")
+    ]
+    if not overrides:
+        st.warning("Add at least one variant.")
+        st.stop()
+
+    with st.spinner(f"Solving {len(overrides)} variants..."):
+        reply = run_sweep(overrides)
+
+    if "error" in reply:
+        st.error(reply["error"])
+    else:
+        st.success(f"Solved {len(reply['results'])} variants in {reply['solve_time']} seconds, using the inputs of the plan starting {reply['base_start_time']}.")
+        table = []
+        for index, result in enumerate(reply["results"]):
+            row = {"Variant": index + 1, "Overrides": ", ".join(f"{k}={v}" for k, v in result["overrides"].items()) or "Current settings", "Status": result["status"]}
+            row.update({
+                "Expected Profit ($)": result.get("profit"),
+                "Grid Import (kWh)": result.get("grid_import_kwh"),
+                "Grid Export (kWh)": result.get("grid_export_kwh"),
+                "Battery Discharge (kWh)": result.get("battery_discharge_kwh"),
+                "Battery Cycles": result.get("battery_cycles"),
+                "Objective": result.get("objective"),
+            })
+            table.append(row)
+        st.dataframe(pd.DataFrame(table), hide_index=True, width='stretch')
+        st.caption("Profit, energy and cycles are totals over the whole planning horizon, at the forecast prices.")